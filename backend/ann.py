@@ -0,0 +1,221 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+from similarity import SIMILARITY_BLOCK_SIZE
+
+# Dimension of the dense embedding of the user rows that is hashed. Sparse
+# rating rows have low cosine similarities even between like-minded users,
+# which random hyperplanes cannot tell apart from noise; in a low-rank
+# embedding such users point in nearly the same direction.
+LSH_FACTORS = 32
+
+# Defaults of the random-projection index. More tables and probes raise
+# recall and query time; more bits per table make buckets smaller, which
+# lowers both.
+LSH_TABLES = 8
+LSH_BITS = 12
+LSH_PROBES = 2
+# Maximum number of candidates taken from a single bucket, which bounds the
+# query time when many users hash alike
+LSH_MAX_BUCKET = 256
+
+
+class LSHIndex:
+    """
+    Random-projection (SimHash) index for cosine similarity.
+
+    Every vector gets one `n_bits`-bit code per table, made of the signs of
+    its projections on random hyperplanes. Vectors with a small angle between
+    them agree on most signs and so tend to share a bucket in at least one
+    table. Each table is kept as a sorted array of codes, so a bucket is a
+    binary search away and the index costs `n_tables` codes and ids per
+    vector.
+
+    A query looks up its own bucket in every table and, with `n_probes`, the
+    buckets obtained by flipping its least certain bits (those whose
+    projection is closest to zero). The candidates are then ranked by their
+    exact similarity, see `top_k_neighbors_lsh`. Works on dense arrays and
+    CSR matrices alike.
+
+    The index is built with the model and dropped once the neighbour lists
+    are found: incremental updates recompute the lists they change exactly,
+    so it is never updated in place.
+
+    Args:
+        dim: Dimension of the indexed vectors
+        n_tables: Number of hash tables
+        n_bits: Number of hyperplanes per table, at most 62
+        n_probes: Number of extra buckets probed per table
+        max_bucket: Maximum number of candidates taken from one bucket
+        seed: Seed for the random hyperplanes
+    """
+
+    def __init__(self, dim: int, n_tables: int = LSH_TABLES, n_bits: int = LSH_BITS,
+                 n_probes: int = LSH_PROBES, max_bucket: int = LSH_MAX_BUCKET, seed: int = 0):
+        if not 0 < n_bits <= 62:
+            raise ValueError("n_bits must be between 1 and 62")
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = min(n_probes, n_bits)
+        self.max_bucket = max_bucket
+        rng = np.random.default_rng(seed)
+        self._planes = rng.standard_normal((dim, n_tables * n_bits)).astype(np.float32)
+        self._weights = np.left_shift(np.int64(1), np.arange(n_bits, dtype=np.int64))
+        # Per table: codes sorted ascending and the id stored with each code
+        self._codes = [np.empty(0, dtype=np.int64) for _ in range(n_tables)]
+        self._ids = [np.empty(0, dtype=np.int64) for _ in range(n_tables)]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, vectors, ids=None, block_size: int = SIMILARITY_BLOCK_SIZE):
+        """
+        Insert vectors into the index.
+
+        Insertion merges the new codes into each sorted table.
+
+        Args:
+            vectors: Dense array or CSR matrix with one vector per row
+            ids: Id of each vector; defaults to consecutive ids following
+                the last insertion
+            block_size: Number of vectors hashed at once
+        """
+        n = vectors.shape[0]
+        if ids is None:
+            ids = np.arange(self._size, self._size + n, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        codes = self.codes(vectors, block_size)
+        for table in range(self.n_tables):
+            order = np.argsort(codes[:, table], kind="stable")
+            new_codes = codes[order, table]
+            positions = np.searchsorted(self._codes[table], new_codes, side="right")
+            self._codes[table] = np.insert(self._codes[table], positions, new_codes)
+            self._ids[table] = np.insert(self._ids[table], positions, ids[order])
+        self._size += n
+
+    def codes(self, vectors, block_size: int = SIMILARITY_BLOCK_SIZE):
+        """Return the bucket code of every vector in every table, one row per vector."""
+        codes = np.empty((vectors.shape[0], self.n_tables), dtype=np.int64)
+        for start in range(0, vectors.shape[0], block_size):
+            codes[start:start + block_size], _ = self._hash(vectors[start:start + block_size])
+        return codes
+
+    def candidates(self, vectors):
+        """
+        Find the candidate neighbours of a block of query vectors.
+
+        Returns:
+            Tuple of (rows, ids): parallel arrays pairing each query row with
+            the distinct ids found in its buckets
+        """
+        codes, projections = self._hash(vectors)
+        probes = [codes]
+        if self.n_probes:
+            # Flip the bits whose hyperplane the query lies closest to
+            margins = np.abs(projections).reshape(len(codes), self.n_tables, self.n_bits)
+            uncertain = np.argsort(margins, axis=2)[:, :, :self.n_probes]
+            for probe in range(self.n_probes):
+                probes.append(codes ^ self._weights[uncertain[:, :, probe]])
+
+        n_queries = vectors.shape[0]
+        pair_rows, pair_ids = [], []
+        for table in range(self.n_tables):
+            table_codes = self._codes[table]
+            for probe_codes in probes:
+                lo = np.searchsorted(table_codes, probe_codes[:, table], side="left")
+                hi = np.searchsorted(table_codes, probe_codes[:, table], side="right")
+                counts = np.minimum(hi - lo, self.max_bucket)
+                rows = np.repeat(np.arange(n_queries), counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                pair_rows.append(rows)
+                pair_ids.append(self._ids[table][np.repeat(lo, counts) + offsets])
+
+        if not pair_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        rows = np.concatenate(pair_rows)
+        ids = np.concatenate(pair_ids)
+        width = max(self._size, int(ids.max()) + 1 if len(ids) else 0)
+        pairs = np.unique(rows * width + ids)
+        return pairs // max(width, 1), pairs % max(width, 1)
+
+    def _hash(self, vectors):
+        projections = vectors @ self._planes
+        if sparse.issparse(projections):
+            projections = projections.toarray()
+        projections = np.asarray(projections)
+        bits = (projections > 0).reshape(len(projections), self.n_tables, self.n_bits)
+        return bits @ self._weights, projections
+
+
+def embed_rows(normalized, n_factors: int = LSH_FACTORS):
+    """
+    Project unit-length rows onto their top singular vectors.
+
+    Args:
+        normalized: CSR matrix of unit-length user rows
+        n_factors: Dimension of the embedding
+
+    Returns:
+        The embedded rows, scaled to unit length
+    """
+    n_factors = min(n_factors, min(normalized.shape) - 1)
+    if n_factors < 1:
+        projection = np.zeros((normalized.shape[1], 1))
+    else:
+        _, _, vt = svds(normalized, k=n_factors, random_state=0)
+        projection = np.ascontiguousarray(vt.T)
+    embedding = np.asarray(normalized @ projection)
+    norms = np.linalg.norm(embedding, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embedding / norms
+
+
+def top_k_neighbors_lsh(normalized, k, index: LSHIndex, embedding, block_size: int = SIMILARITY_BLOCK_SIZE):
+    """
+    Approximate `top_k_neighbors` with an LSH index.
+
+    Each user is only compared with the candidates the index proposes for
+    them, at most `n_tables * (n_probes + 1) * max_bucket` users, instead of
+    with every user who rated one of the same products. The work per user is
+    thus bounded however popular their products are. The similarities that
+    are kept are exact; recall depends on the index settings, see
+    `benchmarks/bench_ann.py`.
+
+    Args:
+        normalized: CSR matrix of unit-length user rows
+        k: Number of neighbours to keep per user
+        index: Index holding the rows of `embedding` under their row numbers
+        embedding: Embedded rows, as returned by `embed_rows`
+        block_size: Number of users queried at once
+
+    Returns:
+        Tuple of (neighbor_idx, neighbor_sim) in the layout of `top_k_neighbors`
+    """
+    n_users = normalized.shape[0]
+    neighbor_idx = np.full((n_users, k), -1, dtype=np.int32)
+    neighbor_sim = np.zeros((n_users, k), dtype=np.float64)
+    if k == 0:
+        return neighbor_idx, neighbor_sim
+
+    for start in range(0, n_users, block_size):
+        block = normalized[start:start + block_size]
+        rows, ids = index.candidates(embedding[start:start + block.shape[0]])
+        keep = ids != rows + start
+        rows, ids = rows[keep], ids[keep]
+
+        sims = np.asarray(block[rows].multiply(normalized[ids]).sum(axis=1)).ravel()
+        positive = sims > 0
+        rows, ids, sims = rows[positive], ids[positive], sims[positive]
+
+        # Rank each user's candidates by decreasing similarity, then index
+        order = np.lexsort((ids, -sims, rows))
+        rows, ids, sims = rows[order], ids[order], sims[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, np.arange(block.shape[0]))[rows]
+        top = rank < k
+        neighbor_idx[start + rows[top], rank[top]] = ids[top]
+        neighbor_sim[start + rows[top], rank[top]] = sims[top]
+
+    return neighbor_idx, neighbor_sim
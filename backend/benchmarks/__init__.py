@@ -0,0 +1 @@
+"""Benchmarks for the recommendation backend. Run them from the backend directory."""
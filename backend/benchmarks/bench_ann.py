@@ -0,0 +1,85 @@
+"""
+Measure recall@K and build time of the LSH neighbour search against the
+exact cosine neighbours.
+
+Usage:
+    python -m benchmarks.bench_ann [--users 20000] [--ratings-per-user 100] [--settings 8:12:0 8:12:2]
+
+Each setting is tables:bits:probes. Recall@K is the fraction of each user's
+exact top K neighbours that the approximate search also returns. The index
+pays off when users rate many popular products, which the defaults model;
+with few ratings per user the exact search is usually faster.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ann import LSH_FACTORS, LSHIndex, embed_rows, top_k_neighbors_lsh
+from benchmarks.synthetic import generate_clustered_ratings
+from similarity import build_rating_matrix, normalize_rows, row_norms, top_k_neighbors
+
+
+def recall_at_k(exact_idx, approx_idx):
+    """Fraction of the exact neighbours that are also in the approximate lists."""
+    found = total = 0
+    for exact, approx in zip(exact_idx, approx_idx):
+        exact = exact[exact >= 0]
+        found += len(np.intersect1d(exact, approx[approx >= 0]))
+        total += len(exact)
+    return found / total if total else 1.0
+
+
+def run(n_users, n_products, ratings_per_user, n_clusters, k, n_factors, settings):
+    data = generate_clustered_ratings(n_users, n_products, ratings_per_user, n_clusters)
+    matrix = build_rating_matrix(*data)
+    normalized = normalize_rows(matrix, row_norms(matrix))
+
+    start = time.perf_counter()
+    exact_idx, _ = top_k_neighbors(normalized, k)
+    exact_time = time.perf_counter() - start
+    print(f"{n_users:>9} users  exact {exact_time:8.2f}s")
+
+    start = time.perf_counter()
+    embedding = embed_rows(normalized, n_factors)
+    embed_time = time.perf_counter() - start
+
+    for n_tables, n_bits, n_probes in settings:
+        index = LSHIndex(embedding.shape[1], n_tables=n_tables, n_bits=n_bits, n_probes=n_probes)
+        start = time.perf_counter()
+        index.add(embedding)
+        add_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        approx_idx, _ = top_k_neighbors_lsh(normalized, k, index, embedding)
+        query_time = time.perf_counter() - start
+
+        total = embed_time + add_time + query_time
+        print(f"{'':>9}  lsh {n_tables:>3}:{n_bits:>2}:{n_probes}  embed {embed_time:6.2f}s  "
+              f"index {add_time:6.2f}s  search {query_time:8.2f}s  total {total:8.2f}s  "
+              f"recall@{k} {recall_at_k(exact_idx, approx_idx):.3f}")
+
+
+def parse_setting(value):
+    n_tables, n_bits, n_probes = (int(part) for part in value.split(":"))
+    return n_tables, n_bits, n_probes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[20000])
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--ratings-per-user", type=int, default=100)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--factors", type=int, default=LSH_FACTORS)
+    parser.add_argument("--settings", type=parse_setting, nargs="+",
+                        default=[(8, 12, 0), (8, 12, 2)])
+    args = parser.parse_args()
+
+    for n_users in args.users:
+        run(n_users, args.products, args.ratings_per_user, args.clusters, args.k, args.factors, args.settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Load-test the HTTP API in-process on a synthetic power-law dataset.
+
+Usage:
+    python -m benchmarks.bench_http [--users 50000] [--concurrency 16] [--seconds 10] [--json results.json]
+
+The FastAPI app is driven through httpx's ASGI transport, so the whole
+request path is measured (routing, middleware, handlers, serialization)
+without sockets. The API starts up as it would in production, building any
+missing model first. Clients then send a mix of requests for --seconds:
+recommendations for users drawn with the dataset's activity skew, pages of
+products, popular products and new ratings, in the proportions of --mix.
+Reported per endpoint: requests/sec, latency percentiles and errors.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+import numpy as np
+
+from benchmarks.harness import add_dataset_arguments, load_backend, prepare_dataset, summarize, write_results
+
+# Share of each kind of request in the default mix
+DEFAULT_MIX = "recommendations=0.7,products=0.1,popular=0.1,ratings=0.1"
+
+
+def parse_mix(mix):
+    kinds = dict(part.split("=") for part in mix.split(","))
+    weights = np.array([float(w) for w in kinds.values()])
+    return list(kinds), weights / weights.sum()
+
+
+def make_request(kind, rng, args, active_users):
+    if kind == "recommendations":
+        return "GET", f"/recommendations/{int(rng.choice(active_users))}?limit={args.limit}", None
+    if kind == "products":
+        return "GET", f"/products?offset={int(rng.integers(0, args.products))}&limit=20", None
+    if kind == "popular":
+        return "GET", f"/popular?limit={args.limit}", None
+    if kind == "ratings":
+        rating = {"userId": int(rng.choice(active_users)), "productId": int(rng.integers(1, args.products + 1)),
+                  "rating": float(rng.integers(1, 11) / 2)}
+        return "POST", "/ratings", rating
+    raise ValueError(f"Unknown request kind {kind!r}")
+
+
+async def client_loop(client, rng, args, kinds, weights, active_users, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        kind = kinds[rng.choice(len(kinds), p=weights)]
+        method, url, body = make_request(kind, rng, args, active_users)
+        start = time.perf_counter()
+        response = await client.request(method, url, json=body)
+        latencies[kind].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            errors[kind] += 1
+
+
+async def run_load(main, args, active_users):
+    kinds, weights = parse_mix(args.mix)
+    latencies = {kind: [] for kind in kinds}
+    errors = {kind: 0 for kind in kinds}
+
+    await main.startup_event()
+    try:
+        # Wait for the models the startup may have started building, so that
+        # no build competes with the load
+        registries = (main.registry, main.fallback_registry, main.svd_registry, main.item_registry)
+        while any(registry.get().model is None for registry in registries):
+            await asyncio.sleep(0.5)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def load(seconds, latencies, errors, round_):
+                deadline = time.perf_counter() + seconds
+                await asyncio.gather(*(
+                    client_loop(client, np.random.default_rng([args.seed, round_, i]), args, kinds, weights,
+                                active_users, deadline, latencies, errors)
+                    for i in range(args.concurrency)
+                ))
+
+            # Warm up the caches, then measure
+            await load(args.warmup, {kind: [] for kind in kinds}, dict(errors), 0)
+            start = time.perf_counter()
+            await load(args.seconds, latencies, errors, 1)
+            elapsed = time.perf_counter() - start
+    finally:
+        await main.shutdown_event()
+
+    results = {}
+    for kind in kinds:
+        result = summarize(latencies[kind])
+        result.update(requests_per_second=len(latencies[kind]) / elapsed, errors=errors[kind])
+        results[kind] = result
+    total = sum(len(seconds) for seconds in latencies.values())
+    results["total"] = dict(summarize([s for seconds in latencies.values() for s in seconds]),
+                            requests_per_second=total / elapsed, errors=sum(errors.values()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_dataset_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of load before measuring")
+    parser.add_argument("--limit", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Share of each kind of request")
+    args = parser.parse_args()
+
+    params = prepare_dataset(args)
+    main_module = load_backend(args.data_dir)
+
+    # Users are drawn in proportion to their number of ratings, as active
+    # users also request the most recommendations
+    active_users = main_module.collect_ratings(main_module.ratings_log.rating_chunks())[0]
+
+    results = asyncio.run(run_load(main_module, args, active_users))
+    for kind, result in results.items():
+        print(f"{kind:>16}  {result['requests_per_second']:8.1f} req/s  p50 {result.get('p50_ms', 0):7.2f} ms  "
+              f"p95 {result.get('p95_ms', 0):7.2f} ms  p99 {result.get('p99_ms', 0):7.2f} ms  "
+              f"errors {result['errors']}")
+    if args.json:
+        write_results(args.json, "http", dict(params, concurrency=args.concurrency, seconds=args.seconds,
+                                              limit=args.limit, mix=args.mix), results)
+
+
+if __name__ == "__main__":
+    main()
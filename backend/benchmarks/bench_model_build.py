@@ -0,0 +1,56 @@
+"""
+Measure memory and build time of the sparse training path.
+
+Usage:
+    python -m benchmarks.bench_model_build [--users 10000 100000 1000000] [--workers 1 8 32]
+"""
+import argparse
+import time
+import tracemalloc
+
+from similarity import build_rating_matrix, normalize_rows, row_norms, top_k_neighbors
+from benchmarks.synthetic import generate_ratings
+
+
+def run(n_users, n_products, ratings_per_user, k, workers):
+    data = generate_ratings(n_users, n_products, ratings_per_user)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    matrix = build_rating_matrix(*data)
+    matrix_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    norms = row_norms(matrix)
+    neighbor_idx, neighbor_sim = top_k_neighbors(normalize_rows(matrix, norms), k, workers=workers)
+    similarity_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    model_bytes = (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+                   + norms.nbytes + neighbor_idx.nbytes + neighbor_sim.nbytes)
+    dense_bytes = 8 * n_users * (n_products + n_users)
+
+    # Memory of worker processes is not traced
+    print(f"{n_users:>9} users  {workers:>3} workers  {matrix.nnz:>10} ratings  "
+          f"matrix {matrix_time:7.2f}s  neighbours {similarity_time:8.2f}s  "
+          f"model {model_bytes / 2**20:9.1f} MiB  peak {peak / 2**20:9.1f} MiB  "
+          f"dense {dense_bytes / 2**30:9.1f} GiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[10**4, 10**5, 10**6])
+    parser.add_argument("--products", type=int, default=50000)
+    parser.add_argument("--ratings-per-user", type=int, default=20)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    args = parser.parse_args()
+
+    for n_users in args.users:
+        for workers in args.workers:
+            run(n_users, args.products, args.ratings_per_user, args.k, workers)
+
+
+if __name__ == "__main__":
+    main()
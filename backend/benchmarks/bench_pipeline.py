@@ -0,0 +1,115 @@
+"""
+Measure the API's own functions on a synthetic power-law dataset.
+
+Usage:
+    python -m benchmarks.bench_pipeline [--users 50000] [--products 10000] [--requests 2000] [--json results.json]
+
+Runs, in one process and in this order: the neighbour model build
+(`generate_recommendation_model`) and the SVD model build, with the time
+of each stage; `get_recommendations` with an empty cache ("cold"), again
+for the same users ("warm") and with the SVD engine; the popularity
+fallback; `add_rating`; and the incremental update applying those ratings
+to the served model.
+
+The dataset is generated into --data-dir on the first run and reused by
+the following ones with the same parameters.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.harness import add_dataset_arguments, load_backend, prepare_dataset, summarize, write_results
+from metrics import StageTimer
+
+
+def timed_calls(call, args_list):
+    """Call `call` with each argument and return the duration of every call."""
+    seconds = []
+    for args in args_list:
+        start = time.perf_counter()
+        call(*args)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def bench_build(generate):
+    """Time a model build, keeping the time of each stage."""
+    stages = StageTimer()
+    start = time.perf_counter()
+    generate(stages)
+    return {"seconds": time.perf_counter() - start, "stage_seconds": stages.seconds}
+
+
+def bench_recommendations(main, user_ids, limit, engine):
+    """Time `get_recommendations`, keeping the mean time of each stage."""
+    seconds, stage_totals = [], {}
+    for user_id in user_ids:
+        stages = StageTimer()
+        start = time.perf_counter()
+        main.get_recommendations(user_id, limit, engine=engine, stages=stages)
+        seconds.append(time.perf_counter() - start)
+        for stage, elapsed in stages.seconds.items():
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + elapsed
+    result = summarize(seconds)
+    result["stage_mean_ms"] = {stage: total / len(user_ids) * 1000 for stage, total in stage_totals.items()}
+    return result
+
+
+def run(args):
+    params = prepare_dataset(args)
+    main = load_backend(args.data_dir)
+    main.ratings_log.open()
+    rng = np.random.default_rng(args.seed)
+    results = {}
+
+    try:
+        results["generate_recommendation_model"] = bench_build(main.generate_recommendation_model)
+        main.registry.reload()
+        main.fallback_registry.reload()
+        results["generate_svd_model"] = bench_build(main.generate_svd_model)
+        main.svd_registry.reload()
+
+        user_ids = rng.integers(1, args.users + 1, args.requests).tolist()
+        main.recommendation_cache.clear()
+        results["get_recommendations.cold"] = bench_recommendations(main, user_ids, args.limit, "neighbors")
+        results["get_recommendations.warm"] = bench_recommendations(main, user_ids, args.limit, "neighbors")
+        results["get_recommendations.svd"] = bench_recommendations(main, user_ids, args.limit, "svd")
+        results["fallback_recommendations"] = summarize(
+            timed_calls(main.fallback_recommendations, [(args.limit,)] * args.requests))
+
+        ratings = [main.Rating(userId=int(u), productId=int(p), rating=float(r)) for u, p, r in zip(
+            rng.integers(1, args.users + 1, args.ratings),
+            rng.integers(1, args.products + 1, args.ratings),
+            rng.integers(1, 11, args.ratings) / 2,
+        )]
+        results["add_rating"] = summarize(timed_calls(main.add_rating, [(rating,) for rating in ratings]))
+        start = time.perf_counter()
+        main.apply_pending_updates()
+        results["apply_pending_updates"] = {"ratings": len(ratings), "seconds": time.perf_counter() - start}
+    finally:
+        main.ratings_log.close()
+
+    for name, result in results.items():
+        shown = {key: round(value, 3) if isinstance(value, float) else value
+                 for key, value in result.items() if not isinstance(value, dict)}
+        print(f"{name:>32}  {shown}")
+        for key, value in result.items():
+            if isinstance(value, dict):
+                print(f"{'':>32}  {key}: " + "  ".join(f"{k} {v:.3f}" for k, v in value.items()))
+    if args.json:
+        write_results(args.json, "pipeline", dict(params, requests=args.requests, limit=args.limit,
+                                                  ratings_added=args.ratings), results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_dataset_arguments(parser)
+    parser.add_argument("--requests", type=int, default=2000, help="Recommendation requests per path")
+    parser.add_argument("--limit", type=int, default=8)
+    parser.add_argument("--ratings", type=int, default=500, help="Ratings added through add_rating")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
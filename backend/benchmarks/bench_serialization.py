@@ -0,0 +1,97 @@
+"""
+Compare the cost of serializing product lists through the response paths.
+
+Usage:
+    python -m benchmarks.bench_serialization [--products 10000] [--limit 20] [--seconds 3]
+
+"validated" is the former path: the endpoint returns product dicts, which
+FastAPI validates against the response model and encodes with the json
+module. "fragments" assembles the body from the catalog's cached JSON of
+each product, encoded with the json module or, for "fragments-orjson",
+orjson. Each path is measured on its own (encodes/sec) and through an
+in-process HTTP client (requests/sec).
+"""
+import argparse
+import time
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from catalog import Catalog
+from main import Product, json_response, sample_products
+from serialization import json_encoder, orjson
+from storage import PRODUCT_COLUMNS, Table
+
+
+def make_catalog(n_products, fast):
+    records = [dict(sample_products[i % len(sample_products)], id=i + 1) for i in range(n_products)]
+    return Catalog(Table.from_records(records, PRODUCT_COLUMNS), "category", encode=json_encoder(fast))
+
+
+def make_app(catalogs, limit, seed=0):
+    rng = np.random.default_rng(seed)
+    n_products = len(catalogs["fragments"])
+    pages = [rng.choice(n_products, limit, replace=False) + 1 for _ in range(256)]
+    app = FastAPI()
+
+    @app.get("/validated/{page}", response_model=List[Product])
+    def validated(page: int):
+        products = catalogs["fragments"]
+        return [products.get(int(product_id)) for product_id in pages[page % len(pages)]]
+
+    for name, products in catalogs.items():
+        app.get(f"/{name}/{{page}}", response_model=List[Product])(fragments_route(products, pages))
+
+    return app, pages
+
+
+def fragments_route(products, pages):
+    def fragments(page: int):
+        return json_response(products.to_json_ids(pages[page % len(pages)]))
+    return fragments
+
+
+def rate(call, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        call(count)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    catalogs = {"fragments": make_catalog(args.products, fast=False)}
+    if orjson is not None:
+        catalogs["fragments-orjson"] = make_catalog(args.products, fast=True)
+    else:
+        print("orjson is not installed, skipping fragments-orjson")
+    app, pages = make_app(catalogs, args.limit)
+
+    # Encoding alone, with every fragment already cached
+    from pydantic import TypeAdapter
+    adapter = TypeAdapter(List[Product])
+    products = catalogs["fragments"]
+    encoders = {"validated": lambda i: json_encoder()(adapter.dump_python(adapter.validate_python(
+        [products.get(int(product_id)) for product_id in pages[i % len(pages)]])))}
+    for name, catalog in catalogs.items():
+        encoders[name] = lambda i, catalog=catalog: catalog.to_json_ids(pages[i % len(pages)])
+
+    with TestClient(app) as client:
+        for name, encode in encoders.items():
+            rate(encode, 0.2)  # Warm up the fragment caches
+            encodes = rate(encode, args.seconds)
+            requests = rate(lambda i: client.get(f"/{name}/{i}"), args.seconds)
+            print(f"{name:>17}  {encodes:10.0f} encodes/s  {requests:8.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare two benchmark result files, such as runs on two commits.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 0.1]
+
+Every numeric result present in both files is listed with its relative
+change. Times (keys ending in _ms or seconds) and errors are better lower,
+rates (keys ending in per_second) better higher. Changes for the worse beyond
+--threshold are flagged, and make the command exit with status 1, so it
+can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(results, prefix=""):
+    """Flatten nested results into {"name.key": value} for the numeric values."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def direction(name):
+    """Return 1 if higher values of a result are better, -1 if lower are, 0 if neither."""
+    key = name.rsplit(".", 1)[-1]
+    if key.endswith("per_second"):
+        return 1
+    if key.endswith("_ms") or key.endswith("seconds") or key == "errors":
+        return -1
+    return 0
+
+
+def compare(baseline, candidate, threshold):
+    """
+    Return the rows of the comparison and the names of the regressions.
+
+    Returns:
+        Tuple of (rows, regressions); each row is (name, baseline, candidate, change)
+    """
+    old, new = flatten(baseline["results"]), flatten(candidate["results"])
+    rows, regressions = [], []
+    for name in old.keys() & new.keys():
+        if old[name]:
+            change = (new[name] - old[name]) / old[name]
+        else:
+            change = 0.0 if new[name] == old[name] else float("inf") if new[name] > 0 else float("-inf")
+        rows.append((name, old[name], new[name], change))
+        if direction(name) * change < -threshold:
+            regressions.append(name)
+    rows.sort()
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change flagged as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["benchmark"] != candidate["benchmark"]:
+        sys.exit(f"Cannot compare {baseline['benchmark']} results with {candidate['benchmark']} results")
+    if baseline["params"] != candidate["params"]:
+        print("Warning: the runs used different parameters")
+
+    print(f"{baseline['environment']['commit']} -> {candidate['environment']['commit']}")
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    for name, old, new, change in rows:
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<56} {old:>12.4g} {new:>12.4g} {change:>+8.1%}{flag}")
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
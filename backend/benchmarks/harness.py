@@ -0,0 +1,134 @@
+"""
+Shared setup and result files of the benchmarks that run the API code on a
+synthetic dataset.
+
+Results are written as JSON so that runs on different commits can be
+compared with `python -m benchmarks.compare`:
+
+    {
+        "benchmark": "pipeline",
+        "environment": {"commit": ..., "python": ..., ...},
+        "params": {"users": 50000, ...},
+        "results": {"get_recommendations.cold": {"p50_ms": ..., ...}, ...}
+    }
+"""
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.synthetic import write_dataset
+
+# Dataset parameters recorded next to a generated dataset, so that it is
+# only generated again when they change
+DATASET_FILE = "dataset.json"
+
+
+def add_dataset_arguments(parser):
+    """Add the options of the synthetic dataset to an argument parser."""
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--products", type=int, default=10_000)
+    parser.add_argument("--ratings-per-user", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=Path, default=Path("benchmarks/data"),
+                        help="Directory the dataset is generated into, and reused from")
+    parser.add_argument("--json", type=Path, help="File the results are written to as JSON")
+
+
+def dataset_params(args):
+    return {
+        "users": args.users,
+        "products": args.products,
+        "ratings_per_user": args.ratings_per_user,
+        "categories": args.categories,
+        "seed": args.seed,
+    }
+
+
+def prepare_dataset(args):
+    """
+    Generate the dataset in `args.data_dir`, unless it already holds it.
+
+    Ratings added by earlier runs are discarded, so every run starts from
+    the same ratings.
+
+    Returns:
+        Dataset parameters, with the number of ratings
+    """
+    params = dataset_params(args)
+    data_dir = Path(args.data_dir)
+    for name in ("ratings.log", "ratings.log.pending"):
+        (data_dir / name).unlink(missing_ok=True)
+    params_file = data_dir / DATASET_FILE
+    if params_file.exists():
+        stored = json.loads(params_file.read_text())
+        if stored["params"] == params:
+            return dict(params, ratings=stored["ratings"])
+
+    print(f"Generating {args.users} users, {args.products} products in {data_dir}")
+    start = time.perf_counter()
+    n_ratings = write_dataset(data_dir, args.users, args.products, args.ratings_per_user,
+                              args.categories, seed=args.seed)
+    params_file.write_text(json.dumps({"params": params, "ratings": n_ratings}))
+    print(f"Generated {n_ratings} ratings in {time.perf_counter() - start:.1f}s")
+    return dict(params, ratings=n_ratings)
+
+
+def load_backend(data_dir):
+    """
+    Import the API module serving `data_dir`.
+
+    The data directory is read from the environment when the module is
+    imported, and by the worker processes it spawns.
+    """
+    os.environ["DATA_DIR"] = str(Path(data_dir).resolve())
+    return importlib.import_module("main")
+
+
+def summarize(seconds):
+    """Summarize a list of durations in seconds as count, mean and percentiles in milliseconds."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(ms):
+        return {"count": 0}
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def environment():
+    """Describe the code and machine the benchmark ran on."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def write_results(path, benchmark, params, results):
+    """Write benchmark results as JSON, see the module docstring."""
+    document = {"benchmark": benchmark, "environment": environment(), "params": params, "results": results}
+    Path(path).write_text(json.dumps(document, indent=2) + "\n")
+    print(f"Wrote results to {path}")
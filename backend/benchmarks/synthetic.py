@@ -0,0 +1,212 @@
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Number of times products drawn twice for the same user are redrawn
+DRAW_ROUNDS = 10
+
+
+def generate_ratings(n_users, n_products, ratings_per_user=20, seed=0):
+    """
+    Generate a random set of ratings as parallel arrays.
+
+    Args:
+        n_users: Number of users
+        n_products: Number of products
+        ratings_per_user: Average number of ratings per user
+        seed: Seed for the random generator
+
+    Returns:
+        Tuple of (user_ids, product_ids, rating_users, rating_products, rating_values)
+    """
+    rng = np.random.default_rng(seed)
+    n_ratings = n_users * ratings_per_user
+
+    user_ids = np.arange(1, n_users + 1, dtype=np.int64)
+    product_ids = np.arange(1, n_products + 1, dtype=np.int64)
+    rating_users = rng.integers(1, n_users + 1, n_ratings)
+    rating_products = rng.integers(1, n_products + 1, n_ratings)
+    rating_values = rng.integers(2, 11, n_ratings) / 2.0
+
+    return user_ids, product_ids, rating_users, rating_products, rating_values
+
+
+def generate_clustered_ratings(n_users, n_products, ratings_per_user=20, n_clusters=100,
+                               taste_size=200, noise=0.2, seed=0):
+    """
+    Generate ratings from users who fall into groups of similar taste.
+
+    Each group likes its own random set of `taste_size` products. A user
+    draws all but a `noise` fraction of their ratings from the set of their
+    group and the rest uniformly, so users of the same group are clearly
+    more similar than others, as in real rating data.
+
+    Args:
+        n_users: Number of users
+        n_products: Number of products
+        ratings_per_user: Number of ratings per user
+        n_clusters: Number of taste groups
+        taste_size: Number of products liked by each group
+        noise: Fraction of ratings drawn uniformly from all products
+        seed: Seed for the random generator
+
+    Returns:
+        Tuple of (user_ids, product_ids, rating_users, rating_products, rating_values)
+    """
+    rng = np.random.default_rng(seed)
+    n_ratings = n_users * ratings_per_user
+    taste_size = min(taste_size, n_products)
+
+    user_ids = np.arange(1, n_users + 1, dtype=np.int64)
+    product_ids = np.arange(1, n_products + 1, dtype=np.int64)
+    tastes = np.stack([rng.choice(n_products, taste_size, replace=False) for _ in range(n_clusters)])
+
+    rating_users = np.repeat(user_ids, ratings_per_user)
+    clusters = rng.integers(0, n_clusters, n_users)[rating_users - 1]
+    liked = tastes[clusters, rng.integers(0, taste_size, n_ratings)]
+    uniform = rng.integers(0, n_products, n_ratings)
+    from_taste = rng.random(n_ratings) >= noise
+    rating_products = np.where(from_taste, liked, uniform) + 1
+    rating_values = np.where(from_taste, rng.integers(7, 11, n_ratings), rng.integers(2, 11, n_ratings)) / 2.0
+
+    return user_ids, product_ids, rating_users, rating_products, rating_values
+
+
+def generate_power_law_ratings(n_users, n_products, ratings_per_user=20, n_categories=50,
+                               activity_exponent=2.0, popularity_exponent=1.0, affinity=0.6,
+                               seed=0):
+    """
+    Generate ratings shaped like production data.
+
+    User activity and product popularity both follow power laws: most users
+    rate a handful of products while a few rate hundreds, and a few products
+    collect most of the ratings. Each product belongs to a category, see
+    `product_categories`, and each user has a favourite category that an
+    `affinity` fraction of their ratings is drawn from, rated higher than
+    the rest. A user rates a product at most once; the heaviest users of
+    small categories may end up with slightly fewer ratings than drawn.
+
+    Args:
+        n_users: Number of users
+        n_products: Number of products
+        ratings_per_user: Average number of ratings drawn per user
+        n_categories: Number of product categories
+        activity_exponent: Tail exponent of the number of ratings per user;
+            lower is heavier-tailed, and it must be above 1
+        popularity_exponent: Zipf exponent of product popularity
+        affinity: Fraction of ratings drawn from the user's favourite category
+        seed: Seed for the random generator
+
+    Returns:
+        Tuple of (user_ids, product_ids, rating_users, rating_products, rating_values)
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = np.arange(1, n_users + 1, dtype=np.int64)
+    product_ids = np.arange(1, n_products + 1, dtype=np.int64)
+    categories = product_categories(n_products, n_categories, seed)
+
+    # Ratings per user: 1 plus a Lomax draw scaled to the requested mean
+    scale = max(ratings_per_user - 1, 0) * (activity_exponent - 1)
+    counts = 1 + np.floor(rng.pareto(activity_exponent, n_users) * scale).astype(np.int64)
+    counts = np.minimum(counts, n_products)
+    rating_users = np.repeat(user_ids, counts)
+    n_ratings = len(rating_users)
+
+    # Zipf weights over a random popularity order, so that popularity does
+    # not follow product ids. Products are sorted by category, so the
+    # products of a category are one block of the cumulative weights.
+    weights = rng.permutation(n_products).astype(np.float64) + 1
+    weights **= -popularity_exponent
+    by_category = np.argsort(categories, kind="stable")
+    cdf = np.cumsum(weights[by_category])
+    bounds = np.concatenate([[0.0], cdf[np.searchsorted(categories[by_category], np.arange(n_categories),
+                                                         side="right") - 1]])
+    bounds[1:][np.bincount(categories, minlength=n_categories) == 0] = np.nan
+
+    favourites = rng.integers(0, n_categories, n_users)
+
+    def draw(users):
+        favourite = favourites[users - 1]
+        low, high = bounds[favourite], bounds[favourite + 1]
+        in_favourite = (rng.random(len(users)) < affinity) & ~np.isnan(high)
+        low = np.where(in_favourite, low, 0.0)
+        high = np.where(in_favourite, high, cdf[-1])
+        drawn = np.searchsorted(cdf, low + rng.random(len(users)) * (high - low), side="right")
+        return by_category[np.minimum(drawn, n_products - 1)]
+
+    # A user rates a product at most once: redraw repeated products a few
+    # times, then drop those still repeated
+    rating_products = draw(rating_users)
+    for _ in range(DRAW_ROUNDS):
+        _, first = np.unique(rating_users * n_products + rating_products, return_index=True)
+        repeated = np.ones(n_ratings, dtype=bool)
+        repeated[first] = False
+        if not repeated.any():
+            break
+        rating_products[repeated] = draw(rating_users[repeated])
+    _, first = np.unique(rating_users * n_products + rating_products, return_index=True)
+    rating_users, rating_products = rating_users[first], rating_products[first]
+    n_ratings = len(first)
+    favourite = favourites[rating_users - 1]
+
+    # Rating: product quality plus user bias, a bonus for the favourite
+    # category, and noise, in half stars
+    quality = rng.normal(0.0, 0.5, n_products)
+    bias = rng.normal(0.0, 0.4, n_users)
+    values = (3.4 + quality[rating_products] + bias[rating_users - 1]
+              + 0.8 * (categories[rating_products] == favourite) + rng.normal(0.0, 0.6, n_ratings))
+    rating_values = np.clip(np.round(values * 2) / 2, 0.5, 5.0)
+
+    return user_ids, product_ids, rating_users, rating_products + 1, rating_values
+
+
+def product_categories(n_products, n_categories=50, seed=0):
+    """
+    Assign each product a category, with Zipf-distributed category sizes.
+
+    Returns:
+        Array of the category index of every product, in product id order
+    """
+    rng = np.random.default_rng([seed, 1])
+    sizes = 1.0 / np.arange(1, n_categories + 1)
+    return rng.choice(n_categories, n_products, p=sizes / sizes.sum())
+
+
+def write_dataset(data_dir, n_users, n_products, ratings_per_user=20, n_categories=50, days=30, seed=0,
+                  **options):
+    """
+    Write a power-law dataset in the layout of the backend's data directory.
+
+    Users, products and ratings are stored as the binary tables the API
+    reads, with the ratings spread over the last `days` days. Extra options
+    are passed to `generate_power_law_ratings`.
+
+    Returns:
+        Number of ratings written
+    """
+    from storage import PRODUCT_COLUMNS, USER_COLUMNS, Table, save_ratings, save_table
+
+    user_ids, product_ids, rating_users, rating_products, rating_values = generate_power_law_ratings(
+        n_users, n_products, ratings_per_user, n_categories, seed=seed, **options)
+    categories = product_categories(n_products, n_categories, seed)
+
+    rng = np.random.default_rng([seed, 2])
+    users = Table.from_records(({"id": int(i), "name": f"User {i}"} for i in user_ids), USER_COLUMNS)
+    products = Table.from_records((
+        {
+            "id": int(i),
+            "name": f"Product {i}",
+            "category": f"Category {categories[i - 1]}",
+            "description": f"Synthetic product {i}",
+            "rating": float(np.round(rng.uniform(2.5, 5.0), 1)),
+            "image_url": None,
+        }
+        for i in product_ids
+    ), PRODUCT_COLUMNS)
+    ts = time.time() - rng.random(len(rating_users)) * days * 24 * 3600
+
+    save_table(Path(data_dir) / "users", "users", users)
+    save_table(Path(data_dir) / "products", "products", products)
+    save_ratings(Path(data_dir) / "ratings", rating_users, rating_products, rating_values, ts)
+    return len(rating_users)
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+# Rough per-entry cost of the key tuple, the OrderedDict slot and the index
+# bookkeeping, on top of 8 bytes per stored id
+ENTRY_OVERHEAD_BYTES = 400
+
+
+class RecommendationCache:
+    """
+    LRU cache of top-N recommendations.
+
+    Entries are keyed by (user, limit, n_neighbors, model version, variant),
+    the variant telling apart results computed differently for the same
+    user, such as with a product filter, and hold the recommended product
+    ids. Each entry also remembers the neighbours it
+    was computed from, so that a new rating only invalidates the rater's own
+    entries and the entries of users who have the rater as a neighbour.
+
+    Args:
+        max_bytes: Approximate memory bound; least recently used entries are
+            evicted once the estimated size exceeds it
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple, Tuple[List[int], Tuple[int, ...], int]]" = OrderedDict()
+        self._by_user: Dict[int, Set[Tuple]] = {}
+        self._by_neighbor: Dict[int, Set[Tuple]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int, limit: int, n_neighbors: int, version: Hashable,
+            variant: Hashable = None) -> Optional[List[int]]:
+        """Return the cached product ids, or None on a miss."""
+        key = (user_id, limit, n_neighbors, version, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id: int, limit: int, n_neighbors: int, version: Hashable,
+            product_ids: List[int], neighbor_ids: Iterable[int], variant: Hashable = None):
+        """Store recommendations computed from the given neighbours."""
+        key = (user_id, limit, n_neighbors, version, variant)
+        neighbor_ids = tuple(neighbor_ids)
+        size = ENTRY_OVERHEAD_BYTES + 8 * (len(product_ids) + len(neighbor_ids))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (product_ids, neighbor_ids, size)
+            self._bytes += size
+            self._by_user.setdefault(user_id, set()).add(key)
+            for neighbor_id in neighbor_ids:
+                self._by_neighbor.setdefault(neighbor_id, set()).add(key)
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int) -> int:
+        """
+        Drop every entry affected by a change to a user's ratings.
+
+        Returns:
+            Number of entries removed
+        """
+        with self._lock:
+            keys = self._by_user.get(user_id, set()) | self._by_neighbor.get(user_id, set())
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._by_neighbor.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Counters and size, for sizing the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key: Tuple):
+        _, neighbor_ids, size = self._entries.pop(key)
+        self._bytes -= size
+        _discard(self._by_user, key[0], key)
+        for neighbor_id in neighbor_ids:
+            _discard(self._by_neighbor, neighbor_id, key)
+
+
+def _discard(index: Dict[int, Set[Tuple]], user_id: int, key: Tuple):
+    keys = index.get(user_id)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[user_id]
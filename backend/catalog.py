@@ -0,0 +1,168 @@
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from serialization import json_encoder
+from storage import Table
+
+
+class ProductFilter(NamedTuple):
+    """
+    Constraints on the products a recommendation request may return.
+
+    Filters are hashable, so that results computed with one can be cached.
+
+    Args:
+        category: Only return products of this category
+        exclude: Ids of products never to return, sorted
+        min_rating: Only return products whose catalog rating is at least this
+    """
+
+    category: Optional[str] = None
+    exclude: Tuple[int, ...] = ()
+    min_rating: Optional[float] = None
+
+
+class Catalog(Sequence):
+    """
+    Serving index over a users or products table.
+
+    Rows are found by id through the table's id index and, if a category
+    column is given, by category through one sorted array of row positions
+    per category. Every row is decoded and serialized to JSON at most once,
+    the first time it is served; responses are then assembled from the
+    cached JSON fragments, without building or validating any objects.
+    A catalog lives as long as the registry snapshot that holds it.
+
+    Args:
+        table: Table to index
+        category_column: String column to index rows by, if any
+        encode: Function serializing a row to JSON bytes
+        rating_column: Numeric column the `min_rating` of a filter applies to
+    """
+
+    def __init__(self, table: Table, category_column: Optional[str] = None,
+                 encode: Optional[Callable[[Any], bytes]] = None, rating_column: Optional[str] = None):
+        self.table = table
+        self.rating_column = rating_column
+        self._encode = encode or json_encoder()
+        # Positions of the id arrays of the served models, by id() of the array
+        self._positions: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self._rows: List[Optional[Dict[str, Any]]] = [None] * len(table)
+        self._fragments: List[Optional[bytes]] = [None] * len(table)
+        self._categories: Dict[str, np.ndarray] = {}
+        if category_column is not None:
+            codes = np.asarray(table.arrays[category_column])
+            order = np.argsort(codes, kind="stable")
+            bounds = np.flatnonzero(np.diff(codes[order])) + 1
+            for positions in np.split(order, bounds):
+                if len(positions) and codes[positions[0]] >= 0:
+                    self._categories[table.strings[int(codes[positions[0]])]] = positions
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        row = self._rows[position]
+        if row is None:
+            row = self._rows[position] = self.table[position]
+        return row
+
+    def position(self, id_) -> Optional[int]:
+        """Return the position of the row with the given id, or None."""
+        return self.table.index.get(id_)
+
+    def get(self, id_, default=None):
+        """Return the row with the given id, or `default` if there is none."""
+        position = self.position(id_)
+        return default if position is None else self[position]
+
+    def categories(self) -> List[str]:
+        return sorted(self._categories)
+
+    def page(self, offset: int = 0, limit: Optional[int] = None,
+             category: Optional[str] = None) -> Tuple[np.ndarray, int]:
+        """
+        Select a page of rows in table order, optionally of a single category.
+
+        Returns:
+            Tuple of (positions, total): the positions of the rows on the
+            page, and the number of rows matching the filter
+        """
+        if category is None:
+            total = len(self)
+            stop = total if limit is None else min(offset + limit, total)
+            return np.arange(min(offset, stop), stop), total
+        positions = self._categories.get(category, np.empty(0, dtype=np.int64))
+        stop = len(positions) if limit is None else offset + limit
+        return positions[offset:stop], len(positions)
+
+    def mask(self, product_filter: ProductFilter, ids: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Select the rows a filter allows.
+
+        The category is looked up in the per-category position arrays, so
+        building the mask costs a pass over the rows whatever the filter.
+
+        Args:
+            product_filter: Filter to apply
+            ids: Ids to return the mask in the order of, such as the product
+                columns of a model; ids missing from the table are never
+                allowed. The rows of the table by default.
+
+        Returns:
+            Boolean array, True for the allowed rows or ids
+        """
+        if product_filter.category is None:
+            allowed = np.ones(len(self), dtype=bool)
+        else:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[self._categories.get(product_filter.category, [])] = True
+        if product_filter.min_rating is not None:
+            # Missing ratings are NaN and never reach the minimum
+            allowed &= np.asarray(self.table.arrays[self.rating_column]) >= product_filter.min_rating
+        if product_filter.exclude:
+            excluded = self.table.index.lookup(np.array(product_filter.exclude, dtype=np.int64))
+            allowed[excluded[excluded >= 0]] = False
+        if ids is None:
+            return allowed
+        if not len(self):
+            return np.zeros(len(ids), dtype=bool)
+        positions = self.positions(ids)
+        return (positions >= 0) & allowed[positions]
+
+    def positions(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Return the position of every id, or -1 for ids missing from the table.
+
+        The positions of the last few arrays looked up are kept, so that
+        the product ids of a served model are looked up once rather than on
+        every request.
+        """
+        cached = self._positions.get(id(ids))
+        if cached is not None and cached[0] is ids:
+            return cached[1]
+        positions = self.table.index.lookup(ids)
+        if len(self._positions) >= 8:
+            self._positions.clear()
+        self._positions[id(ids)] = (ids, positions)
+        return positions
+
+    def fragment(self, position: int) -> bytes:
+        """Return the JSON serialization of a row."""
+        fragment = self._fragments[position]
+        if fragment is None:
+            fragment = self._fragments[position] = self._encode(self[position])
+        return fragment
+
+    def to_json(self, positions: Iterable[int]) -> bytes:
+        """Serialize rows as a JSON array from their cached fragments."""
+        return b"[" + b", ".join(self.fragment(int(position)) for position in positions) + b"]"
+
+    def to_json_ids(self, ids: Iterable[int]) -> bytes:
+        """Serialize the rows with the given ids as a JSON array, skipping unknown ids."""
+        positions = self.table.index.lookup(np.fromiter(ids, dtype=np.int64))
+        return self.to_json(positions[positions >= 0])
@@ -0,0 +1,503 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from item_based import ITEM_NEIGHBOR_K, build_item_model
+from item_based import score_products as score_item_products
+from model_store import IdIndex
+from modeling import N_FACTORS, build_svd_model
+from modeling import recommend as recommend_svd
+from ratings_log import RatingsLog
+from scoring import build_neighbor_model, score_products, select_neighbors
+from similarity import build_rating_matrix, top_k_indices
+from storage import open_table
+
+# Number of recommendations the ranking metrics are computed on
+EVALUATION_K = 10
+
+# Test ratings at or above this value count as products the user liked,
+# which the ranking metrics look for among the recommendations
+RELEVANT_RATING = 4.0
+
+# Fraction of the ratings held out for testing by a time split
+TEST_FRACTION = 0.2
+
+# Maximum number of test users scored per fold; more only narrow the
+# confidence interval of the metrics
+MAX_EVALUATION_USERS = 5000
+
+# Parameters of each engine that change the model it builds. The other
+# parameters of a configuration only change how the model is scored, so
+# configurations differing only in those share one model per fold.
+BUILD_PARAMS = {
+    "neighbors": ("neighbor_k", "search"),
+    "svd": ("n_factors",),
+    "items": ("item_k",),
+}
+
+
+def load_ratings(data_dir: Path):
+    """
+    Load the catalog ids and the ratings of a data directory, with the time each rating was written.
+
+    Ratings of users or products missing from the catalog are dropped, as
+    when the API builds its models.
+
+    Returns:
+        Tuple of (user_ids, product_ids, rating_users, rating_products, rating_values, rating_ts)
+    """
+    data_dir = Path(data_dir)
+    rating_users, rating_products, rating_values, rating_ts = RatingsLog(
+        data_dir / "ratings", data_dir / "ratings.log").rating_arrays()
+    users = open_table(data_dir / "users", "users")
+    products = open_table(data_dir / "products", "products")
+    user_ids = np.unique(rating_users) if users is None else np.asarray(users.ids)
+    product_ids = np.unique(rating_products) if products is None else np.asarray(products.ids)
+
+    known = (IdIndex(user_ids).lookup(rating_users) >= 0) & (IdIndex(product_ids).lookup(rating_products) >= 0)
+    return (user_ids.astype(np.int64), product_ids.astype(np.int64), rating_users[known].astype(np.int64),
+            rating_products[known].astype(np.int64), rating_values[known].astype(np.float64),
+            rating_ts[known].astype(np.float64))
+
+
+def time_split(rating_ts, n_folds: int = 1, test_fraction: float = TEST_FRACTION):
+    """
+    Split ratings by the time they were written.
+
+    The most recent `test_fraction` of the ratings is cut into `n_folds`
+    consecutive windows. Each fold trains on every rating written before its
+    window and tests on the ratings in it, as if the model had been built
+    when the window started.
+
+    Args:
+        rating_ts: Time every rating was written
+        n_folds: Number of folds
+        test_fraction: Fraction of the ratings tested on over all folds
+
+    Returns:
+        List of (train, test) boolean masks over the ratings, one per fold
+
+    Raises:
+        ValueError: If all ratings were written at the same time, as
+            imported ratings are
+    """
+    rating_ts = np.asarray(rating_ts)
+    if not len(rating_ts) or rating_ts.min() == rating_ts.max():
+        raise ValueError("The ratings have no distinct times to split on, use a leave-one-out split")
+
+    order = np.argsort(rating_ts, kind="stable")
+    first_test = len(rating_ts) - int(round(len(rating_ts) * test_fraction))
+    bounds = np.linspace(first_test, len(rating_ts), n_folds + 1).astype(np.int64)
+    folds = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        train = np.zeros(len(rating_ts), dtype=bool)
+        test = np.zeros(len(rating_ts), dtype=bool)
+        train[order[:start]] = True
+        test[order[start:end]] = True
+        folds.append((train, test))
+    return folds
+
+
+def leave_one_out_split(rating_users, n_folds: int = 1, seed: int = 0):
+    """
+    Hold out one rating of every user who has at least two.
+
+    Each fold holds out a different random draw of ratings and trains on
+    all the others.
+
+    Args:
+        rating_users: User id of every rating
+        n_folds: Number of folds
+        seed: Seed for the random generator
+
+    Returns:
+        List of (train, test) boolean masks over the ratings, one per fold
+    """
+    rating_users = np.asarray(rating_users)
+    folds = []
+    for fold in range(n_folds):
+        # Sorting each user's ratings by a random key and holding out the
+        # last one draws one rating per user uniformly
+        keys = np.random.default_rng([seed, fold]).random(len(rating_users))
+        order = np.lexsort((keys, rating_users))
+        sorted_users = rating_users[order]
+        first = np.r_[True, sorted_users[1:] != sorted_users[:-1]]
+        last = np.r_[sorted_users[1:] != sorted_users[:-1], True]
+        test = np.zeros(len(rating_users), dtype=bool)
+        test[order[last & ~first]] = True
+        folds.append((~test, test))
+    return folds
+
+
+def configurations(engines=("neighbors", "svd", "items"), n_neighbors=(3,), neighbor_k=(20,),
+                   search=("exact",), n_factors=(N_FACTORS,), item_k=(ITEM_NEIGHBOR_K,)):
+    """
+    List every combination of the given parameters, engine by engine.
+
+    Returns:
+        List of configurations, each a dict of the engine and its parameters
+    """
+    grids = {
+        "neighbors": {"n_neighbors": n_neighbors, "neighbor_k": neighbor_k, "search": search},
+        "svd": {"n_factors": n_factors},
+        "items": {"item_k": item_k},
+    }
+    configs = []
+    for engine in engines:
+        names = list(grids[engine])
+        for values in itertools.product(*(grids[engine][name] for name in names)):
+            configs.append(dict(zip(names, values), engine=engine))
+    return configs
+
+
+def build_model(config, user_ids, product_ids, rating_users, rating_products, rating_values):
+    """Build the model of a configuration from training ratings."""
+    engine = config["engine"]
+    if engine == "neighbors":
+        return build_neighbor_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                                    config["neighbor_k"], search=config["search"])
+    if engine == "svd":
+        return build_svd_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                               n_factors=config["n_factors"])
+    if engine == "items":
+        return build_item_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                                k=config["item_k"])
+    raise ValueError(f"Unknown engine {engine!r}")
+
+
+def model_nbytes(model) -> int:
+    """
+    Return the number of bytes of the arrays a model holds.
+
+    Arrays referenced twice, such as the ids behind an IdIndex, are counted
+    once. The item engine reads the users' ratings from the matrix of the
+    neighbour model, which is not included in its own size.
+    """
+    arrays = {}
+    for value in model.values():
+        if sparse.issparse(value):
+            parts = (value.data, value.indices, value.indptr)
+        elif isinstance(value, IdIndex):
+            parts = (value.ids, value.order, value.sorted_ids)
+        elif isinstance(value, np.ndarray):
+            parts = (value,)
+        else:
+            continue
+        for array in parts:
+            arrays[id(array)] = array.nbytes
+    return sum(arrays.values())
+
+
+def recommender(config, model, train_matrix, k: int):
+    """
+    Return a function scoring one user with a model as the API would.
+
+    The function takes a matrix row and returns the indices of the top `k`
+    products, best first, and a function predicting the user's rating of
+    given products. It returns the predicted ratings and a mask of the
+    products it could score.
+    """
+    engine = config["engine"]
+    if engine == "svd":
+        def recommend(user_idx):
+            top, _ = recommend_svd(model, user_idx, k)
+
+            def predict(product_indices):
+                scores = model["item_factors"][product_indices] @ model["user_factors"][user_idx]
+                return scores + model["user_ratings_mean"][user_idx], np.ones(len(product_indices), dtype=bool)
+            return top, predict
+        return recommend
+
+    def recommend(user_idx):
+        if engine == "neighbors":
+            neighbors, sims = select_neighbors(model["neighbor_idx"], model["neighbor_sim"], user_idx,
+                                               config["n_neighbors"])
+            scored, scores = score_products(model["matrix"], user_idx, neighbors, sims)
+        else:
+            row = slice(train_matrix.indptr[user_idx], train_matrix.indptr[user_idx + 1])
+            scored, scores = score_item_products(model, model["product_ids"][train_matrix.indices[row]],
+                                                 train_matrix.data[row])
+        top = scored[top_k_indices(scores, k)]
+
+        def predict(product_indices):
+            if not len(scored):
+                return np.zeros(len(product_indices)), np.zeros(len(product_indices), dtype=bool)
+            # Scored products come in increasing index order
+            pos = np.minimum(np.searchsorted(scored, product_indices), len(scored) - 1)
+            return scores[pos], scored[pos] == product_indices
+        return top, predict
+    return recommend
+
+
+def evaluate_model(config, model, train_matrix, test_matrix, user_indices, k: int):
+    """
+    Score the given users with a model and compare the results with their test ratings.
+
+    Returns:
+        Dict of metric sums over the users, see `summarize_results`, with
+        the scoring time of every user in "latencies"
+    """
+    recommend = recommender(config, model, train_matrix, k)
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    totals = {"precision": 0.0, "recall": 0.0, "ndcg": 0.0, "ranked_users": 0,
+              "squared_error": 0.0, "predicted": 0, "test_ratings": 0, "latencies": []}
+
+    for user_idx in user_indices:
+        start = time.perf_counter()
+        top, predict = recommend(user_idx)
+        totals["latencies"].append(time.perf_counter() - start)
+
+        row = slice(test_matrix.indptr[user_idx], test_matrix.indptr[user_idx + 1])
+        test_products, test_values = test_matrix.indices[row], test_matrix.data[row]
+        relevant = test_products[test_values >= RELEVANT_RATING]
+        if len(relevant):
+            hits = np.isin(top, relevant)
+            totals["precision"] += hits.sum() / k
+            totals["recall"] += hits.sum() / len(relevant)
+            totals["ndcg"] += discounts[:len(top)][hits].sum() / discounts[:min(len(relevant), k)].sum()
+            totals["ranked_users"] += 1
+
+        predictions, found = predict(test_products)
+        totals["squared_error"] += float(((predictions[found] - test_values[found]) ** 2).sum())
+        totals["predicted"] += int(found.sum())
+        totals["test_ratings"] += len(test_products)
+    return totals
+
+
+def evaluate_fold(fold: int, configs, k: int = EVALUATION_K, max_users: int = MAX_EVALUATION_USERS,
+                  seed: int = 0):
+    """
+    Evaluate configurations sharing one model on one fold of the ratings.
+
+    The data and folds are those passed to `_set_dataset`, in this process.
+
+    Returns:
+        List of (config, totals) with the totals of `evaluate_model`, plus
+        the model's "build_seconds" and "memory_bytes"
+    """
+    user_ids, product_ids, rating_users, rating_products, rating_values, _ = _dataset["data"]
+    train, test = _dataset["folds"][fold]
+    train_matrix = build_rating_matrix(user_ids, product_ids, rating_users[train], rating_products[train],
+                                       rating_values[train])
+    test_matrix = build_rating_matrix(user_ids, product_ids, rating_users[test], rating_products[test],
+                                      rating_values[test])
+
+    # Users without training ratings get the popularity fallback, whatever
+    # the engine
+    evaluated = np.flatnonzero((np.diff(test_matrix.indptr) > 0) & (np.diff(train_matrix.indptr) > 0))
+    if len(evaluated) > max_users:
+        evaluated = np.sort(np.random.default_rng([seed, fold]).choice(evaluated, max_users, replace=False))
+
+    start = time.perf_counter()
+    model = build_model(configs[0], user_ids, product_ids, rating_users[train], rating_products[train],
+                        rating_values[train])
+    build_seconds = time.perf_counter() - start
+    memory_bytes = model_nbytes(model)
+
+    results = []
+    for config in configs:
+        totals = evaluate_model(config, model, train_matrix, test_matrix, evaluated, k)
+        totals.update(build_seconds=build_seconds, memory_bytes=memory_bytes)
+        results.append((config, totals))
+    return results
+
+
+# Dataset and folds of the process evaluating them, set once per worker
+_dataset = {}
+
+
+def _set_dataset(data, folds):
+    _dataset["data"] = data
+    _dataset["folds"] = folds
+
+
+def evaluate(data, configs, split: str = "time", n_folds: int = 3, k: int = EVALUATION_K,
+             test_fraction: float = TEST_FRACTION, max_users: int = MAX_EVALUATION_USERS,
+             workers: int = 0, seed: int = 0):
+    """
+    Evaluate recommendation configurations on held-out ratings.
+
+    Every fold builds one model per engine and build parameters, and scores
+    its test users with each configuration using that model. Folds and
+    models are evaluated in parallel over `workers` processes. Latencies
+    are measured while the other workers run, so they are higher than on an
+    idle machine; pass workers=1 to measure them alone.
+
+    Args:
+        data: Tuple of arrays as returned by `load_ratings`
+        configs: Configurations as returned by `configurations`
+        split: "time" (see `time_split`) or "leave-one-out" (see
+            `leave_one_out_split`)
+        n_folds: Number of folds
+        k: Number of recommendations the ranking metrics are computed on
+        test_fraction: Fraction of the ratings tested on by a time split
+        max_users: Maximum number of test users scored per fold
+        workers: Number of processes; one per model and fold, up to the
+            number of cores, if 0
+        seed: Seed for the leave-one-out draws and the sampling of users
+
+    Returns:
+        List of results, see `summarize_results`, in the order of `configs`
+    """
+    if split == "time":
+        folds = time_split(data[5], n_folds, test_fraction)
+    elif split == "leave-one-out":
+        folds = leave_one_out_split(data[2], n_folds, seed)
+    else:
+        raise ValueError(f"Unknown split {split!r}")
+
+    groups = {}
+    for config in configs:
+        key = (config["engine"],) + tuple(config[name] for name in BUILD_PARAMS[config["engine"]])
+        groups.setdefault(key, []).append(config)
+    tasks = [(fold, group) for fold in range(n_folds) for group in groups.values()]
+
+    workers = workers or min(len(tasks), os.cpu_count() or 1)
+    if workers == 1:
+        _set_dataset(data, folds)
+        fold_results = [evaluate_fold(fold, group, k, max_users, seed) for fold, group in tasks]
+    else:
+        # Spawn rather than fork so that workers do not inherit the caller's
+        # threads and locks
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_set_dataset, initargs=(data, folds)) as pool:
+            futures = [pool.submit(evaluate_fold, fold, group, k, max_users, seed) for fold, group in tasks]
+            fold_results = [future.result() for future in futures]
+
+    totals = [[] for _ in configs]
+    for config, fold_totals in itertools.chain.from_iterable(fold_results):
+        totals[configs.index(config)].append(fold_totals)
+    return [summarize_results(config, config_totals, k) for config, config_totals in zip(configs, totals)]
+
+
+def summarize_results(config, fold_totals, k: int):
+    """
+    Combine the totals of every fold of a configuration.
+
+    Ranking metrics are averaged over the test users who liked at least one
+    test product, RMSE over the test ratings the engine could predict, and
+    "rating_coverage" is the fraction of test ratings it could predict.
+    Latencies are in milliseconds, over every scored user.
+    """
+    def total(name):
+        return sum(totals[name] for totals in fold_totals)
+
+    ranked_users = max(total("ranked_users"), 1)
+    latencies = np.array([s for totals in fold_totals for s in totals["latencies"]]) * 1000
+    if not len(latencies):
+        latencies = np.zeros(1)
+    return {
+        "config": config,
+        "folds": len(fold_totals),
+        "users": len(latencies),
+        f"precision@{k}": total("precision") / ranked_users,
+        f"recall@{k}": total("recall") / ranked_users,
+        f"ndcg@{k}": total("ndcg") / ranked_users,
+        "rmse": float(np.sqrt(total("squared_error") / max(total("predicted"), 1))),
+        "rating_coverage": total("predicted") / max(total("test_ratings"), 1),
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+        },
+        "memory_bytes": max(totals["memory_bytes"] for totals in fold_totals),
+        "build_seconds": total("build_seconds") / len(fold_totals),
+    }
+
+
+def fastest_configuration(results, metric: str, minimum: float, percentile: str = "p95"):
+    """
+    Pick the result with the lowest scoring latency whose `metric` is at least `minimum`.
+
+    Lower is better for "rmse", for which the result must be at most
+    `minimum`.
+
+    Returns:
+        The result, or None if no configuration meets the bar
+    """
+    if metric == "rmse":
+        passing = [result for result in results if result[metric] <= minimum]
+    else:
+        passing = [result for result in results if result[metric] >= minimum]
+    return min(passing, key=lambda result: result["latency_ms"][percentile], default=None)
+
+
+def describe(config) -> str:
+    """Format a configuration as `engine name=value ...`."""
+    params = " ".join(f"{name}={value}" for name, value in config.items() if name != "engine")
+    return f"{config['engine']} {params}"
+
+
+def print_results(results, k: int):
+    print(f"{'configuration':<52} {'P@' + str(k):>7} {'R@' + str(k):>7} {'NDCG@' + str(k):>8} {'RMSE':>6} "
+          f"{'cover':>6} {'p50 ms':>7} {'p95 ms':>7} {'MB':>8} {'build s':>8}")
+    for result in results:
+        print(f"{describe(result['config']):<52} {result[f'precision@{k}']:>7.4f} {result[f'recall@{k}']:>7.4f} "
+              f"{result[f'ndcg@{k}']:>8.4f} {result['rmse']:>6.3f} {result['rating_coverage']:>6.1%} "
+              f"{result['latency_ms']['p50']:>7.3f} {result['latency_ms']['p95']:>7.3f} "
+              f"{result['memory_bytes'] / 2**20:>8.1f} {result['build_seconds']:>8.2f}")
+
+
+def main():
+    """
+    Measure the quality and scoring cost of recommendation configurations.
+
+    Usage:
+        python evaluation.py [--data-dir data] [--split time|leave-one-out] [--folds 3]
+                             [--engines neighbors svd items] [--n-neighbors 1 3 5 10]
+                             [--n-factors 10 20 50] [--min-ndcg 0.05] [--json results.json]
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__.strip().splitlines()[0])
+    parser.add_argument("--data-dir", type=Path, default=Path(__file__).parent / "data")
+    parser.add_argument("--split", choices=("time", "leave-one-out"), default="time")
+    parser.add_argument("--folds", type=int, default=3)
+    parser.add_argument("--test-fraction", type=float, default=TEST_FRACTION)
+    parser.add_argument("--k", type=int, default=EVALUATION_K)
+    parser.add_argument("--max-users", type=int, default=MAX_EVALUATION_USERS)
+    parser.add_argument("--workers", type=int, default=0, help="Number of processes, one per core if 0")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engines", nargs="+", choices=tuple(BUILD_PARAMS), default=list(BUILD_PARAMS))
+    # The served values are N_NEIGHBORS, NEIGHBOR_K and NEIGHBOR_SEARCH in main.py
+    parser.add_argument("--n-neighbors", type=int, nargs="+", default=[3])
+    parser.add_argument("--neighbor-k", type=int, nargs="+", default=[20])
+    parser.add_argument("--search", nargs="+", choices=("exact", "lsh"), default=["exact"])
+    parser.add_argument("--n-factors", type=int, nargs="+", default=[N_FACTORS])
+    parser.add_argument("--item-k", type=int, nargs="+", default=[ITEM_NEIGHBOR_K])
+    parser.add_argument("--min-ndcg", type=float,
+                        help="Print the fastest configuration reaching this NDCG@k")
+    parser.add_argument("--json", type=Path, help="File the results are written to as JSON")
+    args = parser.parse_args()
+
+    data = load_ratings(args.data_dir)
+    print(f"Evaluating on {len(data[2])} ratings of {len(data[0])} users and {len(data[1])} products")
+    configs = configurations(args.engines, args.n_neighbors, args.neighbor_k, args.search, args.n_factors,
+                             args.item_k)
+    start = time.perf_counter()
+    results = evaluate(data, configs, args.split, args.folds, args.k, args.test_fraction, args.max_users,
+                       args.workers, args.seed)
+    print(f"Evaluated {len(configs)} configurations on {args.folds} folds in {time.perf_counter() - start:.1f}s")
+    print_results(results, args.k)
+
+    if args.min_ndcg is not None:
+        best = fastest_configuration(results, f"ndcg@{args.k}", args.min_ndcg)
+        if best is None:
+            print(f"No configuration reaches NDCG@{args.k} >= {args.min_ndcg}")
+        else:
+            print(f"Fastest configuration with NDCG@{args.k} >= {args.min_ndcg}: {describe(best['config'])}")
+    if args.json:
+        args.json.write_text(json.dumps({"split": args.split, "folds": args.folds, "k": args.k,
+                                         "results": results}, indent=2) + "\n")
+        print(f"Wrote results to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import time
+
+import numpy as np
+
+from model_store import IdIndex, open_arrays, save_arrays
+
+# Weight of the global mean rating in a product's Bayesian average, in
+# ratings: a product needs about this many ratings before its own average
+# outweighs the global one, so a single 5-star rating does not top the list
+POPULARITY_PRIOR_WEIGHT = 10
+
+# Ratings younger than TRENDING_WINDOW seconds count towards the trending
+# list, each with a weight that halves every TRENDING_HALF_LIFE seconds
+TRENDING_WINDOW = 7 * 24 * 3600
+TRENDING_HALF_LIFE = 24 * 3600
+
+
+class FallbackLists:
+    """
+    Precomputed product rankings for users without personal recommendations.
+
+    Every list is a ranked array of product ids, so serving one is a slice
+    of its first `limit` entries. The per-category lists are stored back to
+    back with the offset at which each category starts.
+
+    Args:
+        arrays: Ranked id arrays, as built by `build_fallback`
+        categories: Category names, in the order of the category offsets
+    """
+
+    def __init__(self, arrays, categories):
+        self.arrays = arrays
+        self.categories = list(categories)
+        self._category_index = {name: i for i, name in enumerate(self.categories)}
+
+    def popular(self, limit: int, category=None):
+        """Return the ids of the `limit` products with the best Bayesian-average rating."""
+        if limit <= 0:
+            return []
+        return self.ranked(category)[:limit].tolist()
+
+    def ranked(self, category=None):
+        """Return the ids of every rated product, or of every rated product of a category, best first."""
+        if category is None:
+            return self.arrays["popular_ids"]
+        i = self._category_index.get(category)
+        if i is None:
+            return self.arrays["category_ids"][:0]
+        offsets = self.arrays["category_offsets"]
+        return self.arrays["category_ids"][offsets[i]:offsets[i + 1]]
+
+    def trending(self, limit: int):
+        """Return the ids of the `limit` products rated well most often lately."""
+        if limit <= 0:
+            return []
+        return self.arrays["trending_ids"][:limit].tolist()
+
+
+def bayesian_average(counts, sums, prior_mean, prior_weight=POPULARITY_PRIOR_WEIGHT):
+    """Average rating of each product, shrunk towards `prior_mean` by `prior_weight` ratings."""
+    return (prior_mean * prior_weight + sums) / (prior_weight + counts)
+
+
+def build_fallback(product_ids, product_categories, rating_products, rating_values, recent_products,
+                   recent_values, recent_ts, now=None, prior_weight=POPULARITY_PRIOR_WEIGHT,
+                   half_life=TRENDING_HALF_LIFE):
+    """
+    Rank products globally, per category and by recent activity.
+
+    Args:
+        product_ids: Array of product ids
+        product_categories: Category of each product, or None
+        rating_products: Product id of every rating, one per (user, product) pair
+        rating_values: Value of every rating
+        recent_products: Product id of every rating of the trending window, one per pair
+        recent_values: Value of each of those ratings
+        recent_ts: Time each of those ratings was written
+        now: Time the trending weights are computed at
+        prior_weight: See POPULARITY_PRIOR_WEIGHT
+        half_life: See TRENDING_HALF_LIFE
+
+    Returns:
+        Tuple of (arrays, categories) for `FallbackLists`
+    """
+    products = IdIndex(product_ids)
+    n_products = len(products)
+    now = time.time() if now is None else now
+
+    # Popularity, over the products that have been rated
+    cols = products.lookup(rating_products)
+    known = cols >= 0
+    cols, values = cols[known], np.asarray(rating_values, dtype=np.float64)[known]
+    counts = np.bincount(cols, minlength=n_products)
+    sums = np.bincount(cols, weights=values, minlength=n_products)
+    prior_mean = values.mean() if len(values) else 0.0
+    scores = bayesian_average(counts, sums, prior_mean, prior_weight)
+    rated = np.flatnonzero(counts > 0)
+    popular = rated[np.lexsort((rated, -scores[rated]))]
+
+    # The same ranking split by category, keeping the popularity order
+    names = sorted({category for category in product_categories if category is not None})
+    codes = {name: i for i, name in enumerate(names)}
+    category_of = np.array([-1 if c is None else codes[c] for c in product_categories], dtype=np.int64)
+    popular_codes = category_of[popular] if len(popular) else np.empty(0, dtype=np.int64)
+    by_category = popular[np.argsort(popular_codes, kind="stable")]
+    by_category = by_category[category_of[by_category] >= 0]
+    offsets = np.searchsorted(category_of[by_category], np.arange(len(names) + 1))
+
+    # Trending: recent ratings at or above the mean, each weighted by its age
+    cols = products.lookup(recent_products)
+    liked = (cols >= 0) & (np.asarray(recent_values, dtype=np.float64) >= prior_mean)
+    ages = np.maximum(now - np.asarray(recent_ts, dtype=np.float64)[liked], 0)
+    trend = np.bincount(cols[liked], weights=0.5 ** (ages / half_life), minlength=n_products)
+    active = np.flatnonzero(trend > 0)
+    trending = active[np.lexsort((active, -trend[active]))]
+
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+    arrays = {
+        "popular_ids": product_ids[popular],
+        "popular_scores": scores[popular],
+        "category_ids": product_ids[by_category],
+        "category_offsets": offsets.astype(np.int64),
+        "trending_ids": product_ids[trending],
+        "trending_scores": trend[trending],
+    }
+    return arrays, names
+
+
+def save_fallback(fallback_dir, arrays, categories, version=None):
+    """Save fallback lists as memory-mappable arrays."""
+    version = time.time_ns() if version is None else version
+    return save_arrays(fallback_dir, "fallback", version, arrays, {"categories": categories})
+
+
+def open_fallback(fallback_dir, verify: bool = False):
+    """
+    Open saved fallback lists.
+
+    Returns:
+        The lists, or None if none have been saved yet
+    """
+    stored = open_arrays(fallback_dir, "fallback", verify)
+    if stored is None:
+        return None
+    arrays, manifest = stored
+    return FallbackLists(arrays, manifest["categories"])
@@ -0,0 +1,266 @@
+import numpy as np
+from scipy import sparse
+
+from similarity import row_norms
+
+# Number of rows in each block of a `RowBlocks` array
+ROW_BLOCK_SIZE = 1024
+
+# Number of neighbour lists recomputed from one sparse product, which holds a
+# dot product for every user sharing a product with them
+EXACT_BATCH_SIZE = 256
+
+
+class RowBlocks:
+    """
+    Rows of an array held in blocks, copied block by block on write.
+
+    A copy with a few rows replaced shares every other block with the
+    original, see `with_rows`. Rows are read like those of an ndarray: `blocks[i]` is one row,
+    `blocks[indices]` stacks several, and `np.asarray(blocks)` joins the
+    blocks into a single array.
+
+    Args:
+        blocks: Arrays with the same trailing dimensions, every one but the
+            last holding `block_size` rows
+        block_size: Number of rows in each block
+    """
+
+    def __init__(self, blocks, block_size: int = ROW_BLOCK_SIZE):
+        self.blocks = blocks
+        self.block_size = block_size
+        self.shape = (sum(len(block) for block in blocks),) + blocks[0].shape[1:]
+        self.dtype = blocks[0].dtype
+
+    @classmethod
+    def from_array(cls, array, block_size: int = ROW_BLOCK_SIZE) -> "RowBlocks":
+        """Split an array into blocks of rows, without copying it."""
+        if isinstance(array, RowBlocks):
+            return array
+        return cls([array[start:start + block_size] for start in range(0, max(len(array), 1), block_size)],
+                   block_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.blocks[index // self.block_size][index % self.block_size]
+        index = np.asarray(index, dtype=np.int64)
+        rows = np.empty(index.shape + self.shape[1:], dtype=self.dtype)
+        flat = index.ravel()
+        out = rows.reshape((len(flat),) + self.shape[1:])
+        for block, positions in self._by_block(flat):
+            out[positions] = self.blocks[block][flat[positions] - block * self.block_size]
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.concatenate(self.blocks)
+        return array if dtype is None else array.astype(dtype)
+
+    def with_rows(self, rows, values) -> "RowBlocks":
+        """Return a copy with some rows replaced, copying only the blocks that hold them."""
+        rows = np.asarray(rows, dtype=np.int64)
+        blocks = list(self.blocks)
+        for block, positions in self._by_block(rows):
+            blocks[block] = blocks[block].copy()
+            blocks[block][rows[positions] - block * self.block_size] = values[positions]
+        return RowBlocks(blocks, self.block_size)
+
+    def _by_block(self, rows):
+        """Yield (block, positions in `rows`) for each block the rows fall in."""
+        block_of = rows // self.block_size
+        order = np.argsort(block_of, kind="stable")
+        for positions in np.split(order, np.flatnonzero(np.diff(block_of[order])) + 1):
+            if len(positions):
+                yield int(block_of[positions[0]]), positions
+
+
+def apply_rating_updates(model, updates):
+    """
+    Apply new ratings to a model without rebuilding it.
+
+    Only the rows of the users who rated are rewritten. One sparse product of
+    the matrix with their rows gives every similarity that changed: the
+    updated users' own neighbour lists are recomputed from it, and every other
+    user who shares a product with them or lists one of them merges the new
+    similarities into their list. A list whose weakest entry may have been
+    beaten by a user outside of it, because an updated user in it became
+    less similar, is recomputed with a second product. The resulting lists
+    are the same as a full rebuild would produce.
+
+    The model passed in is never modified, so readers holding it are not
+    affected. The neighbour lists of the new model are `RowBlocks` sharing
+    every block without a changed row with the old model.
+
+    Args:
+        model: Recommendation model as built by `build_neighbor_model`
+        updates: Iterable of (user_id, product_id, rating), applied in order.
+            Ratings for users or products unknown to the model are skipped.
+
+    Returns:
+        Tuple of (new_model, changed_user_ids), where changed_user_ids are the
+        users whose ratings or neighbour lists changed
+    """
+    user_to_idx = model["user_to_idx"]
+    product_to_idx = model["product_to_idx"]
+
+    # Group the updates by matrix row, the last rating of a pair winning
+    by_row = {}
+    for user_id, product_id, rating in updates:
+        user_idx = user_to_idx.get(user_id)
+        product_idx = product_to_idx.get(product_id)
+        if user_idx is not None and product_idx is not None:
+            by_row.setdefault(user_idx, {})[product_idx] = rating
+    if not by_row:
+        return model, []
+
+    touched = np.array(sorted(by_row), dtype=np.int64)
+    matrix = _replace_rows(model["matrix"], touched, [by_row[row] for row in touched])
+    norms = model["norms"].copy()
+    norms[touched] = row_norms(matrix[touched])
+
+    neighbor_idx = RowBlocks.from_array(model["neighbor_idx"])
+    neighbor_sim = RowBlocks.from_array(model["neighbor_sim"])
+    rows, idx, sims = _update_neighbors(matrix, norms, neighbor_idx, neighbor_sim, touched)
+
+    new_model = dict(model, matrix=matrix, norms=norms, neighbor_idx=neighbor_idx.with_rows(rows, idx),
+                     neighbor_sim=neighbor_sim.with_rows(rows, sims), revision=model.get("revision", 0) + 1)
+    return new_model, [int(model["user_ids"][i]) for i in np.union1d(rows, touched)]
+
+
+def _replace_rows(matrix, rows, row_updates):
+    """Copy a CSR matrix with some rows rewritten, in one pass over its arrays."""
+    indptr = matrix.indptr
+    lengths = np.diff(indptr)
+    pieces_indices, pieces_data = [], []
+    previous = 0
+
+    for row, updates in zip(rows, row_updates):
+        pieces_indices.append(matrix.indices[indptr[previous]:indptr[row]])
+        pieces_data.append(matrix.data[indptr[previous]:indptr[row]])
+
+        old_indices = matrix.indices[indptr[row]:indptr[row + 1]]
+        old_data = matrix.data[indptr[row]:indptr[row + 1]]
+        cols = np.fromiter(updates.keys(), dtype=old_indices.dtype, count=len(updates))
+        values = np.fromiter(updates.values(), dtype=np.float64, count=len(updates))
+
+        keep = ~np.isin(old_indices, cols)
+        indices = np.r_[old_indices[keep], cols]
+        data = np.r_[old_data[keep], values]
+        nonzero = data != 0
+        order = np.argsort(indices[nonzero], kind="stable")
+        pieces_indices.append(indices[nonzero][order])
+        pieces_data.append(data[nonzero][order])
+
+        lengths[row] = len(order)
+        previous = row + 1
+
+    pieces_indices.append(matrix.indices[indptr[previous]:])
+    pieces_data.append(matrix.data[indptr[previous]:])
+
+    new_indptr = np.zeros(len(indptr), dtype=indptr.dtype)
+    np.cumsum(lengths, out=new_indptr[1:])
+    return sparse.csr_matrix((np.concatenate(pieces_data), np.concatenate(pieces_indices), new_indptr),
+                             shape=matrix.shape)
+
+
+def _update_neighbors(matrix, norms, neighbor_idx, neighbor_sim, touched):
+    """
+    Compute the neighbour lists that new ratings of some users change.
+
+    Returns:
+        Tuple of (rows, idx, sims): the rows whose list changed, the touched
+        users' included, and their new lists
+    """
+    n_users, k = neighbor_idx.shape
+    if k == 0:
+        return touched, np.empty((len(touched), 0), neighbor_idx.dtype), np.empty((len(touched), 0), neighbor_sim.dtype)
+    is_touched = np.zeros(n_users, dtype=bool)
+    is_touched[touched] = True
+
+    # Dot products of each touched user with every user, one row each
+    transposed = sparse.csr_matrix(matrix.T)
+    dots = matrix[touched] @ transposed
+    touched_idx, touched_sim = _exact_lists(dots, norms, touched, k, neighbor_idx.dtype, neighbor_sim.dtype)
+
+    # Everyone else who shares a product with a touched user or lists one
+    listing = [start + np.flatnonzero((is_touched[np.maximum(block, 0)] & (block >= 0)).any(axis=1))
+               for start, block in zip(range(0, n_users, neighbor_idx.block_size), neighbor_idx.blocks)]
+    affected = np.setdiff1d(np.union1d(dots.indices, np.concatenate(listing)), touched)
+    position = np.full(n_users, -1)
+    position[affected] = np.arange(len(affected))
+    old_idx = neighbor_idx[affected]
+    old_sim = neighbor_sim[affected]
+
+    # Their entries for untouched users keep their similarity, and the
+    # similarities to the touched users are merged in, leaving out those
+    # that do not beat the weakest entry of a full list
+    kept = (old_idx >= 0) & ~is_touched[np.maximum(old_idx, 0)]
+    kept_rows, kept_slots = np.nonzero(kept)
+    new = dots.tocoo()
+    new_rows = position[new.col]
+    new_sims = new.data / (norms[new.col] * norms[touched[new.row]])
+    weakest_idx, weakest_sim = old_idx[:, -1], old_sim[:, -1]
+    candidates = (new_rows >= 0) & (new_sims > 0)
+    candidates[candidates] = ((weakest_idx[new_rows[candidates]] < 0)
+                              | (new_sims[candidates] >= weakest_sim[new_rows[candidates]]))
+    idx, sims = _top_entries(len(affected), k,
+                             np.r_[kept_rows, new_rows[candidates]],
+                             np.r_[old_idx[kept_rows, kept_slots], touched[new.row[candidates]]],
+                             np.r_[old_sim[kept_rows, kept_slots], new_sims[candidates]],
+                             neighbor_idx.dtype, neighbor_sim.dtype)
+
+    # A user outside of a full list may only have overtaken its weakest
+    # entry if a touched user in it became less similar, making room. The
+    # merged list is complete if its last entry still comes no later than
+    # that weakest entry, and is recomputed otherwise
+    lost = ((old_idx >= 0) & ~kept).any(axis=1)
+    last_idx, last_sim = idx[:, -1], sims[:, -1]
+    settled = (last_idx >= 0) & ((last_sim > weakest_sim) | ((last_sim == weakest_sim) & (last_idx <= weakest_idx)))
+    stale = np.flatnonzero(lost & (weakest_idx >= 0) & ~settled)
+    for start in range(0, len(stale), EXACT_BATCH_SIZE):
+        rows = stale[start:start + EXACT_BATCH_SIZE]
+        idx[rows], sims[rows] = _exact_lists(matrix[affected[rows]] @ transposed, norms, affected[rows], k,
+                                             neighbor_idx.dtype, neighbor_sim.dtype)
+
+    changed = ((idx != old_idx) | (sims != old_sim)).any(axis=1)
+    return (np.r_[touched, affected[changed]], np.concatenate([touched_idx, idx[changed]]),
+            np.concatenate([touched_sim, sims[changed]]))
+
+
+def _exact_lists(dots, norms, users, k, idx_dtype, sim_dtype):
+    """Compute the neighbour lists of some users from the dot products of their rows with every row."""
+    dots = sparse.csr_matrix(dots)
+    sims = dots.data / (norms[dots.indices] * np.repeat(norms[users], np.diff(dots.indptr)))
+    top_idx = np.full((len(users), k), -1, dtype=idx_dtype)
+    top_sim = np.zeros((len(users), k), dtype=sim_dtype)
+    for j, user_idx in enumerate(users):
+        others = dots.indices[dots.indptr[j]:dots.indptr[j + 1]]
+        user_sims = sims[dots.indptr[j]:dots.indptr[j + 1]]
+        keep = (user_sims > 0) & (others != user_idx)
+        others, user_sims = others[keep], user_sims[keep]
+        if len(user_sims) > k:
+            # Keep everything tied with the k-th largest, the lower index
+            # winning a tie as in a full build
+            candidates = user_sims >= np.partition(user_sims, len(user_sims) - k)[len(user_sims) - k]
+            others, user_sims = others[candidates], user_sims[candidates]
+        top = np.lexsort((others, -user_sims))[:k]
+        top_idx[j, :len(top)] = others[top]
+        top_sim[j, :len(top)] = user_sims[top]
+    return top_idx, top_sim
+
+
+def _top_entries(n_rows, k, rows, idx, sims, idx_dtype, sim_dtype):
+    """Arrange (row, index, similarity) entries into the best k of each row, in neighbour list order."""
+    order = np.lexsort((idx, -sims, rows))
+    rows, idx, sims = rows[order], idx[order], sims[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    top = rank < k
+    top_idx = np.full((n_rows, k), -1, dtype=idx_dtype)
+    top_sim = np.zeros((n_rows, k), dtype=sim_dtype)
+    top_idx[rows[top], rank[top]] = idx[top]
+    top_sim[rows[top], rank[top]] = sims[top]
+    return top_idx, top_sim
@@ -0,0 +1,193 @@
+import codecs
+import csv
+import io
+import json
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+from model_store import IdIndex
+
+# Number of ratings parsed into one chunk of arrays. Parsing holds one chunk
+# of Python objects at a time, whatever the size of the file.
+INGEST_CHUNK_SIZE = 100_000
+
+# Number of characters read from a JSON array at once
+JSON_READ_SIZE = 1 << 16
+
+# File suffixes of each supported format
+FORMATS = {".json": "json", ".ndjson": "ndjson", ".jsonl": "ndjson", ".log": "ndjson", ".csv": "csv"}
+
+
+def read_rating_chunks(path, chunk_size: int = INGEST_CHUNK_SIZE, fmt=None):
+    """
+    Stream the ratings of a file as chunks of arrays.
+
+    Args:
+        path: JSON array, NDJSON or CSV file of ratings with the fields
+            userId, productId and rating
+        chunk_size: Number of ratings per chunk
+        fmt: "json", "ndjson" or "csv"; guessed from the suffix if omitted
+
+    Yields:
+        Tuple of (rating_users, rating_products, rating_values) arrays, in
+        file order
+    """
+    path = Path(path)
+    fmt = fmt or FORMATS.get(path.suffix.lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the format of {path}; expected one of {sorted(FORMATS)}")
+    with open(path, "rb") as f:
+        yield from chunk_ratings(iter_ratings(f, fmt), chunk_size)
+
+
+def iter_ratings(f, fmt: str):
+    """
+    Parse a binary file of ratings one record at a time.
+
+    Yields:
+        Tuple of (userId, productId, rating) for each record
+    """
+    if fmt == "json":
+        records = iter_json_array(f)
+    elif fmt == "ndjson":
+        records = (json.loads(line) for line in f if line.strip())
+    elif fmt == "csv":
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [header.index(name) for name in ("userId", "productId", "rating")]
+        for row in reader:
+            if row:
+                yield tuple(row[column] for column in columns)
+        return
+    else:
+        raise ValueError(f"Unknown ratings format {fmt!r}")
+
+    for record in records:
+        yield record["userId"], record["productId"], record["rating"]
+
+
+def iter_json_array(f, read_size: int = JSON_READ_SIZE):
+    """
+    Yield the items of a top-level JSON array without loading the whole file.
+
+    The file is read `read_size` characters at a time and each item is
+    decoded as soon as it is complete, so memory is bounded by the largest
+    item plus one read.
+
+    Args:
+        f: Binary file holding a JSON array
+
+    Raises:
+        ValueError: If the file is not a well-formed JSON array
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buf, pos, eof = "", 0, False
+    expect = "["
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = f.read(read_size)
+        eof = not data
+        buf = buf[pos:] + text.decode(data, final=eof)
+        pos = 0
+
+    while True:
+        # Skip whitespace, then check the punctuation between items
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            fill()
+        if pos == len(buf):
+            raise ValueError("Unexpected end of JSON array")
+
+        char = buf[pos]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            expect = "first"
+            continue
+        if char == "]" and expect in ("first", ","):
+            return
+        if expect == ",":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {char!r}")
+            pos += 1
+            expect = "item"
+            continue
+
+        # Decode the next item, reading on while it is incomplete. An item
+        # ending exactly at the end of the buffer may be a truncated number.
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise ValueError("Malformed or truncated JSON array")
+            fill()
+        pos = end
+        expect = ","
+        yield item
+
+
+def chunk_ratings(ratings, chunk_size: int = INGEST_CHUNK_SIZE):
+    """
+    Group (userId, productId, rating) tuples into chunks of arrays.
+
+    Yields:
+        Tuple of (rating_users, rating_products, rating_values) arrays
+    """
+    ratings = iter(ratings)
+    while True:
+        batch = list(islice(ratings, chunk_size))
+        if not batch:
+            return
+        count = len(batch)
+        yield (
+            np.fromiter((int(r[0]) for r in batch), dtype=np.int64, count=count),
+            np.fromiter((int(r[1]) for r in batch), dtype=np.int64, count=count),
+            np.fromiter((float(r[2]) for r in batch), dtype=np.float64, count=count),
+        )
+
+
+def collect_ratings(chunks, user_ids=None, product_ids=None):
+    """
+    Concatenate rating chunks, dropping ratings of unknown users or products.
+
+    Ratings are filtered chunk by chunk as they arrive, so memory holds the
+    kept ratings as arrays plus a single chunk. The order of the ratings is
+    preserved, which lets `build_rating_matrix` keep the last rating of each
+    (user, product) pair.
+
+    Args:
+        chunks: Iterable of (rating_users, rating_products, rating_values)
+        user_ids: Known user ids; all users are kept if omitted
+        product_ids: Known product ids; all products are kept if omitted
+
+    Returns:
+        Tuple of (rating_users, rating_products, rating_values) arrays
+    """
+    users = None if user_ids is None else IdIndex(user_ids)
+    products = None if product_ids is None else IdIndex(product_ids)
+    kept = ([], [], [])
+    for rating_users, rating_products, rating_values in chunks:
+        known = np.ones(len(rating_users), dtype=bool)
+        if users is not None:
+            known &= users.lookup(rating_users) >= 0
+        if products is not None:
+            known &= products.lookup(rating_products) >= 0
+        for parts, values in zip(kept, (rating_users, rating_products, rating_values)):
+            parts.append(values[known])
+
+    dtypes = (np.int64, np.int64, np.float64)
+    return tuple(np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+                 for parts, dtype in zip(kept, dtypes))
@@ -0,0 +1,144 @@
+import time
+
+import numpy as np
+from scipy import sparse
+
+from model_store import IdIndex, open_arrays, save_arrays
+from similarity import build_rating_matrix, normalize_rows, row_norms, top_k_indices, top_k_neighbors
+
+# Number of most similar products stored per product
+ITEM_NEIGHBOR_K = 50
+
+
+def build_item_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                     k: int = ITEM_NEIGHBOR_K, ratings_as_of=None, workers: int = 1):
+    """
+    Build the top-K item-item neighbour table.
+
+    Products are compared by the cosine similarity of their rating columns,
+    in blocks exactly like users are in `top_k_neighbors`, and only the k
+    most similar products of each product are kept. The table holds
+    products x k entries however many users there are, and it does not
+    depend on any single user's ratings, so it goes stale slowly.
+
+    Args:
+        user_ids: Array of user ids
+        product_ids: Array of product ids, in table order
+        rating_users: User id of every rating
+        rating_products: Product id of every rating
+        rating_values: Value of every rating
+        k: Number of neighbours to keep per product
+        ratings_as_of: Time the ratings were read
+        workers: Number of processes the neighbours are computed with
+
+    Returns:
+        The item model
+    """
+    matrix = build_rating_matrix(user_ids, product_ids, rating_users, rating_products, rating_values)
+    items = sparse.csr_matrix(matrix.T)
+    neighbor_idx, neighbor_sim = top_k_neighbors(normalize_rows(items, row_norms(items)), k,
+                                               workers=workers)
+    return {
+        "neighbor_idx": neighbor_idx,
+        "neighbor_sim": neighbor_sim,
+        "product_ids": np.asarray(product_ids),
+        "product_to_idx": IdIndex(product_ids),
+        "version": time.time_ns(),
+        "ratings_as_of": time.time() if ratings_as_of is None else ratings_as_of,
+    }
+
+
+def save_item_model(model, model_dir):
+    """Save the neighbour table of an item model as memory-mappable arrays."""
+    products = model["product_to_idx"]
+    arrays = {
+        "neighbor_idx": model["neighbor_idx"],
+        "neighbor_sim": model["neighbor_sim"],
+        "product_ids": products.ids,
+        "product_order": products.order,
+        "product_sorted_ids": products.sorted_ids,
+    }
+    return save_arrays(model_dir, "items", model["version"], arrays, {"ratings_as_of": model["ratings_as_of"]})
+
+
+def open_item_model(model_dir, verify: bool = False):
+    """
+    Open a saved item model with its arrays memory-mapped.
+
+    Returns:
+        The model, or None if none has been saved yet
+    """
+    stored = open_arrays(model_dir, "items", verify)
+    if stored is None:
+        return None
+    arrays, manifest = stored
+    return {
+        "neighbor_idx": arrays["neighbor_idx"],
+        "neighbor_sim": arrays["neighbor_sim"],
+        "product_ids": arrays["product_ids"],
+        "product_to_idx": IdIndex(arrays["product_ids"], arrays["product_order"],
+                                  arrays["product_sorted_ids"]),
+        "version": manifest["version"],
+        "ratings_as_of": manifest["ratings_as_of"],
+    }
+
+
+def score_products(model, rated_products, ratings, allowed=None):
+    """
+    Predict a rating for the products similar to those a user rated.
+
+    The predicted rating of a product is the similarity-weighted average of
+    the user's ratings of the products it is a neighbour of. Only the
+    neighbour rows of the rated products are read, so the cost grows with
+    the length of the user's history and not with the number of users.
+
+    Args:
+        model: Item model as built by `build_item_model`
+        rated_products: Ids of the products the user rated
+        ratings: The user's rating of each of them
+        allowed: Boolean mask of the products that may be scored; all if omitted
+
+    Returns:
+        Tuple of (product_indices, scores) for every product that can be
+        scored, in increasing product index order
+    """
+    items = model["product_to_idx"].lookup(rated_products)
+    ratings = np.asarray(ratings, dtype=np.float64)
+    rated = items[items >= 0]
+    liked = (items >= 0) & (ratings > 0)
+    items, ratings = items[liked], ratings[liked]
+
+    neighbors = model["neighbor_idx"][items]
+    sims = model["neighbor_sim"][items]
+    valid = neighbors >= 0
+    candidates, inverse = np.unique(neighbors[valid], return_inverse=True)
+    weights = sims[valid]
+    weighted_sum = np.bincount(inverse, weights=weights * np.broadcast_to(ratings[:, None], neighbors.shape)[valid],
+                               minlength=len(candidates))
+    sim_sum = np.bincount(inverse, weights=weights, minlength=len(candidates))
+
+    # Leave out the products the user has already rated
+    unrated = ~np.isin(candidates, rated) & (sim_sum > 0)
+    if allowed is not None:
+        unrated &= allowed[candidates]
+    return candidates[unrated], weighted_sum[unrated] / sim_sum[unrated]
+
+
+def recommend(model, rated_products, ratings, limit, allowed=None):
+    """
+    Rank the best products for a user from the products they rated.
+
+    Args:
+        model: Item model as built by `build_item_model`
+        rated_products: Ids of the products the user rated
+        ratings: The user's rating of each of them
+        limit: Number of products to return
+        allowed: Boolean mask of the products that may be returned; all if omitted
+
+    Returns:
+        Tuple of (product_indices, scores) into the model's products, ordered
+        by decreasing score, ties broken by the lower product index
+    """
+    candidates, scores = score_products(model, rated_products, ratings, allowed)
+    top = top_k_indices(scores, limit)
+    return candidates[top], scores[top]
@@ -0,0 +1,138 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+
+class ModelBuildJobs:
+    """
+    Runs model builds in a separate process and tracks their status.
+
+    Only one build runs at a time. Submitting while a build is queued or
+    running returns that build instead of starting another one, so concurrent
+    rebuild requests are deduplicated. The served model is untouched until
+    the build has finished and `publish` has swapped the new one in.
+
+    Args:
+        build: Module-level function run in the worker process. It must
+            write the model to disk and may return a dict of extra details.
+        publish: Called in this process once a build succeeded, to load and
+            publish the new model
+        max_history: Number of finished jobs whose status is kept
+        on_finish: Called in this process with the final status of every
+            job, whether it succeeded or failed
+    """
+
+    def __init__(self, build: Callable[[], Optional[Dict[str, Any]]], publish: Callable[[], Any],
+                 max_history: int = 20, on_finish: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        self._build = build
+        self._publish = publish
+        self._on_finish = on_finish
+        self._max_history = max_history
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._futures = {}
+        self._active: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def submit(self) -> Dict[str, Any]:
+        """Start a build, or return the one already queued or running."""
+        with self._lock:
+            if self._active is not None:
+                return self._status_locked(self._active)
+
+            if self._executor is None:
+                # Spawn rather than fork so the worker does not inherit the
+                # server's threads and locks
+                self._executor = ProcessPoolExecutor(max_workers=1,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "build_seconds": None,
+                "publish_seconds": None,
+                "error": None,
+                "details": None,
+            }
+            self._active = job_id
+            future = self._executor.submit(_timed, self._build)
+            self._futures[job_id] = future
+            self._trim_history_locked()
+
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status of a job, or None if it is unknown."""
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+            return self._status_locked(job_id)
+
+    def shutdown(self):
+        """Stop the worker process, abandoning a build in progress."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _finish(self, job_id: str, future):
+        update = {}
+        try:
+            timings = future.result()
+            with self._lock:
+                self._jobs[job_id].update(status="running", started_at=timings["started_at"],
+                                          build_seconds=timings["finished_at"] - timings["started_at"],
+                                          details=timings.get("details"))
+
+            publish_start = time.time()
+            self._publish()
+            update = {"status": "done", "publish_seconds": time.time() - publish_start}
+        except Exception as e:
+            print(f"Model build {job_id} failed: {e}")
+            update = {"status": "failed", "error": str(e)}
+            if isinstance(e, BrokenProcessPool):
+                # The worker died; start a fresh one for the next build
+                with self._lock:
+                    self._executor = None
+        finally:
+            with self._lock:
+                self._jobs[job_id].update(update, finished_at=time.time())
+                self._futures.pop(job_id, None)
+                if self._active == job_id:
+                    self._active = None
+                status = self._status_locked(job_id)
+            if self._on_finish is not None:
+                try:
+                    self._on_finish(status)
+                except Exception as e:
+                    print(f"Error reporting model build {job_id}: {e}")
+
+    def _status_locked(self, job_id: str) -> Dict[str, Any]:
+        job = dict(self._jobs[job_id])
+        future = self._futures.get(job_id)
+        if job["status"] == "queued" and future is not None and future.running():
+            job["status"] = "running"
+        return job
+
+    def _trim_history_locked(self):
+        while len(self._jobs) > self._max_history:
+            oldest = next(iter(self._jobs))
+            if oldest == self._active:
+                break
+            del self._jobs[oldest]
+
+
+def _timed(build):
+    started_at = time.time()
+    details = build()
+    return {"started_at": started_at, "finished_at": time.time(), "details": details}
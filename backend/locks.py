@@ -0,0 +1,80 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+# flock is only available on Unix. Without it the locks below always succeed,
+# which is only safe while a single process serves the data directory.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HAVE_FILE_LOCKS = fcntl is not None
+
+
+class FileLock:
+    """
+    Advisory lock shared by the processes using a data directory.
+
+    The lock is an flock on `path`, which is created if needed. It is
+    released when the process exits, however it exits, so a lock held for
+    the lifetime of a process (such as the leader lock of the API workers)
+    passes to another process as soon as its holder dies.
+
+    flock locks belong to the open file, which the threads of a process
+    share: callers must not take the lock from two threads at once.
+
+    Args:
+        path: Lock file
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.held = False
+        self._fd = None
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        """
+        Take the lock.
+
+        Args:
+            shared: Take a shared lock, which other shared holders may hold
+                at the same time, rather than an exclusive one
+            blocking: Wait for the lock; otherwise give up at once if it is held
+
+        Returns:
+            True if the lock was taken
+        """
+        if fcntl is None:
+            self.held = True
+            return True
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self._fd, operation if blocking else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.held = True
+        return True
+
+    def release(self):
+        if self.held and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self.held = False
+
+    def close(self):
+        """Release the lock and close the lock file."""
+        self.release()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def locked(self, shared: bool = False):
+        """Hold the lock, waiting for it, while the enclosed code runs."""
+        self.acquire(shared=shared)
+        try:
+            yield
+        finally:
+            self.release()
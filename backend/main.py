@@ -1,15 +1,45 @@
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import pickle
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 import numpy as np
 from typing import List, Dict, Any, Optional
 import os
 from pathlib import Path
-import json
+import time
+import asyncio
+from contextlib import contextmanager
+from itertools import islice
+from cache import RecommendationCache
+from catalog import Catalog, ProductFilter
+from fallback import TRENDING_WINDOW, build_fallback, open_fallback, save_fallback
+from incremental import apply_rating_updates
+from ingest import collect_ratings
+from item_based import build_item_model, open_item_model, save_item_model
+from item_based import recommend as recommend_items
+from jobs import ModelBuildJobs
+from locks import HAVE_FILE_LOCKS, FileLock
+from metrics import Metrics, RequestMetrics, StageTimer
+from offload import BlockingPool
+from model_store import open_model, save_model
+from modeling import build_svd_model, open_svd_model, save_svd_model
+from modeling import recommend as recommend_svd, recommend_batch as recommend_svd_batch
+from ratings_log import LogTail, RatingsLog
+from registry import ModelRegistry
+from scoring import build_neighbor_model, recommend_batch, score_products, select_neighbors
+from serialization import json_encoder, response_class
+from storage import PRODUCT_COLUMNS, USER_COLUMNS, Table, import_json, import_ratings, open_table
+from storage import merge_ratings, save_ratings, save_table
+from similarity import top_k_indices
 
-app = FastAPI(title="Recommendation API")
+# Encode responses with orjson, if it is installed. Catalog responses are
+# always assembled from cached JSON fragments without pydantic validation;
+# this also makes the fragments and every other response faster to encode.
+FAST_JSON = os.environ.get("FAST_JSON", "0") == "1"
+encode_json = json_encoder(FAST_JSON)
+
+app = FastAPI(title="Recommendation API", default_response_class=response_class(FAST_JSON))
 
 # Configure CORS to allow requests from the frontend
 app.add_middleware(
@@ -34,20 +64,133 @@ class Product(BaseModel):
     image_url: Optional[str] = None
 
 class Rating(BaseModel):
-    userId: int
-    productId: int
+    # Ids are stored in 32-bit columns
+    userId: int = Field(ge=0, le=2**31 - 1)
+    productId: int = Field(ge=0, le=2**31 - 1)
     rating: float
 
-# Sample data path
-DATA_DIR = Path(__file__).parent / "data"
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[int]
+    limit: int = Field(8, ge=1)
+    engine: Optional[str] = None
+
+# Sample data path; DATA_DIR points the API at another data directory, such
+# as a synthetic dataset written by the benchmarks
+DATA_DIR = Path(os.environ.get("DATA_DIR", Path(__file__).parent / "data"))
+USERS_DIR = DATA_DIR / "users"
+PRODUCTS_DIR = DATA_DIR / "products"
+RATINGS_DIR = DATA_DIR / "ratings"
+# JSON files imported into the directories above if they do not exist yet
 USERS_FILE = DATA_DIR / "users.json"
 PRODUCTS_FILE = DATA_DIR / "products.json"
 RATINGS_FILE = DATA_DIR / "ratings.json"
-MODEL_FILE = DATA_DIR / "recommendation_model.pkl"
+RATINGS_LOG_FILE = DATA_DIR / "ratings.log"
+MODEL_DIR = DATA_DIR / "model"
+SVD_MODEL_DIR = DATA_DIR / "svd_model"
+ITEM_MODEL_DIR = DATA_DIR / "item_model"
+FALLBACK_DIR = DATA_DIR / "fallback"
+
+# Number of most similar users stored per user in the model
+NEIGHBOR_K = 20
+
+# How the neighbour lists are found when the model is built: "exact"
+# compares every user with every user who rated one of the same products,
+# "lsh" only with the candidates proposed by a random-projection index (see
+# ann.py), which bounds the work per user at the cost of some recall. The
+# index is only used by full builds: incremental updates always use exact
+# similarities.
+NEIGHBOR_SEARCH = os.environ.get("NEIGHBOR_SEARCH", "exact")
+
+# Number of processes the neighbour lists are computed with when a model is
+# built. Each one takes blocks of users from the rating matrix, which is
+# shared between them rather than copied.
+TRAINING_WORKERS = int(os.environ.get("TRAINING_WORKERS", os.cpu_count() or 1))
+
+# Number of most similar users whose ratings are used to score products. It
+# is capped by NEIGHBOR_K.
+N_NEIGHBORS = 3
+
+# Recommendation engines: "neighbors" scores products from the ratings of the
+# most similar users, "svd" from a low-rank factorization of the ratings,
+# "items" from the products most similar to those the user rated.
+# Requests may pick one; RECOMMENDATION_ENGINE is used otherwise.
+ENGINES = ("neighbors", "svd", "items")
+RECOMMENDATION_ENGINE = os.environ.get("RECOMMENDATION_ENGINE", "neighbors")
+
+# Number of users scored together by the batch recommendation path
+BATCH_BLOCK_SIZE = 1024
+
+# Maximum number of seconds a new rating may stay in the OS page cache before
+# it is fsynced, and number of log records that triggers a compaction of the
+# ratings log into ratings.json
+RATINGS_FSYNC_INTERVAL = 0.05
+RATINGS_COMPACT_THRESHOLD = 100_000
+
+# Number of seconds between incremental model updates with new ratings, and
+# between full rebuilds of the model, and maximum number of new ratings applied
+# by one update, the others waiting for the next ones
+INCREMENTAL_UPDATE_INTERVAL = 2.0
+MODEL_REBUILD_INTERVAL = 6 * 3600
+INCREMENTAL_UPDATE_BATCH = 500
+
+# Number of API worker processes serving the data directory, as started with
+# `WEB_CONCURRENCY=4 uvicorn main:app` (uvicorn reads its --workers default
+# from the same variable). One of them, the leader, builds the models,
+# applies new ratings and compacts the ratings log; with several workers it
+# saves the updated neighbour model every MODEL_PUBLISH_INTERVAL seconds, and
+# the others switch to it between requests. Every worker maps the same model
+# files, so they share one copy of the model in memory.
+SERVER_WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+MODEL_PUBLISH_INTERVAL = float(os.environ.get("MODEL_PUBLISH_INTERVAL", "10"))
+
+# Number of seconds between rebuilds of the item-item table. Products and
+# their rating patterns change far more slowly than users come and go, and
+# the item engine reads each user's latest ratings from the served model, so
+# the table is rebuilt much less often.
+ITEM_MODEL_REBUILD_INTERVAL = 24 * 3600
+
+# Check every model array against its checksum when loading it. This reads
+# the whole model, so it is off by default to keep loading instant.
+MODEL_VERIFY_CHECKSUMS = os.environ.get("MODEL_VERIFY_CHECKSUMS", "0") == "1"
+
+# Default and maximum number of products returned by one page of /products
+PRODUCTS_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Number of threads running the blocking work of request handlers, such as
+# large catalog pages and the scoring of users with unusually many
+# neighbour ratings. Work below these sizes runs on the event loop, as
+# handing it to a thread costs more: scoring takes about 0.2ms plus 50ns per
+# rating of the neighbours, so SCORING_INLINE_RATINGS is about 1ms of work.
+REQUEST_THREADS = int(os.environ.get("REQUEST_THREADS", min(32, (os.cpu_count() or 1) + 4)))
+INLINE_PAGE_SIZE = 100
+SCORING_INLINE_RATINGS = 20_000
+SCORING_INLINE_PRODUCTS = 100_000
+
+# Approximate memory bound of the recommendation cache
+RECOMMENDATION_CACHE_BYTES = int(os.environ.get("RECOMMENDATION_CACHE_BYTES", 64 * 2**20))
+
+# Let clients profile a request by sending an X-Profile header; the response
+# is then replaced by the profile report. Off by default, as profiling slows
+# down every other request served meanwhile.
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+
+if SERVER_WORKERS > 1 and not HAVE_FILE_LOCKS:
+    raise RuntimeError("Serving with several worker processes needs flock, which this platform lacks")
 
 # Make sure the data directory exists
 DATA_DIR.mkdir(exist_ok=True)
 
+# New ratings are appended to a log that is replayed on top of the ratings
+# stored in RATINGS_DIR. Every worker process appends to it; the leader
+# follows it to apply every worker's ratings to the model.
+ratings_log = RatingsLog(RATINGS_DIR, RATINGS_LOG_FILE, fsync_interval=RATINGS_FSYNC_INTERVAL,
+                         compact_threshold=RATINGS_COMPACT_THRESHOLD, shared=True)
+ratings_tail = LogTail(RATINGS_LOG_FILE)
+
+# Held for its whole life by the worker process that leads, see SERVER_WORKERS
+leader_lock = FileLock(DATA_DIR / "leader.lock")
+
 # Sample data
 sample_users = [
     {"id": 1, "name": "Alice Smith"},
@@ -189,180 +332,737 @@ sample_ratings = [
 
 # Utility functions for data management
 def initialize_data():
-    """Initialize data files with sample data if they don't exist."""
-    if not USERS_FILE.exists():
-        with open(USERS_FILE, 'w') as f:
-            json.dump(sample_users, f)
+    """
+    Create the data directories if they don't exist.
     
-    if not PRODUCTS_FILE.exists():
-        with open(PRODUCTS_FILE, 'w') as f:
-            json.dump(sample_products, f)
+    Users, products and ratings are stored as binary columnar tables. JSON
+    files left from earlier versions are imported; otherwise the tables are
+    filled with sample data.
+    """
+    for table_dir, json_file, kind, columns, sample in (
+        (USERS_DIR, USERS_FILE, "users", USER_COLUMNS, sample_users),
+        (PRODUCTS_DIR, PRODUCTS_FILE, "products", PRODUCT_COLUMNS, sample_products),
+    ):
+        if not (table_dir / "CURRENT").exists():
+            if json_file.exists():
+                import_json(json_file, table_dir, kind, columns)
+            else:
+                save_table(table_dir, kind, Table.from_records(sample, columns))
     
-    if not RATINGS_FILE.exists():
-        with open(RATINGS_FILE, 'w') as f:
-            json.dump(sample_ratings, f)
+    if not (RATINGS_DIR / "CURRENT").exists():
+        if RATINGS_FILE.exists():
+            import_ratings(RATINGS_FILE, RATINGS_DIR)
+        else:
+            save_ratings(RATINGS_DIR, [r["userId"] for r in sample_ratings],
+                         [r["productId"] for r in sample_ratings],
+                         [r["rating"] for r in sample_ratings], [0.0] * len(sample_ratings))
 
-def load_data():
-    """Load data from JSON files."""
+def load_catalog():
+    """Open the users and products tables, memory-mapped."""
     try:
-        with open(USERS_FILE, 'r') as f:
-            users = json.load(f)
-        
-        with open(PRODUCTS_FILE, 'r') as f:
-            products = json.load(f)
-        
-        with open(RATINGS_FILE, 'r') as f:
-            ratings = json.load(f)
-        
-        return users, products, ratings
+        users = open_table(USERS_DIR, "users")
+        products = open_table(PRODUCTS_DIR, "products")
+        if users is not None and products is not None:
+            return users, products
+        print("Catalog not found, serving sample data")
+    except Exception as e:
+        print(f"Error loading catalog: {e}")
+    return Table.from_records(sample_users, USER_COLUMNS), Table.from_records(sample_products, PRODUCT_COLUMNS)
+
+def load_data(stages: Optional[StageTimer] = None):
+    """
+    Load the training data: catalog ids and the ratings as parallel arrays.
+    
+    The ratings snapshot and log are streamed in chunks, dropping ratings of
+    unknown users or products as they are read, so memory holds the rating
+    arrays rather than one Python object per rating.
+    
+    Args:
+        stages: Timer the catalog and ratings loading times are recorded in
+    
+    Returns:
+        Tuple of (user_ids, product_ids, rating_users, rating_products, rating_values)
+    """
+    stages = stages or StageTimer()
+    try:
+        with stages.stage("load_catalog"):
+            users, products = load_catalog()
+            user_ids = users.ids.astype(np.int64)
+            product_ids = products.ids.astype(np.int64)
+        with stages.stage("load_ratings"):
+            ratings = collect_ratings(ratings_log.rating_chunks(), user_ids, product_ids)
+        return (user_ids, product_ids) + ratings
     except Exception as e:
         print(f"Error loading data: {e}")
-        return sample_users, sample_products, sample_ratings
+        count = len(sample_ratings)
+        return (
+            np.array([user["id"] for user in sample_users], dtype=np.int64),
+            np.array([product["id"] for product in sample_products], dtype=np.int64),
+            np.fromiter((r["userId"] for r in sample_ratings), dtype=np.int64, count=count),
+            np.fromiter((r["productId"] for r in sample_ratings), dtype=np.int64, count=count),
+            np.fromiter((r["rating"] for r in sample_ratings), dtype=np.float64, count=count),
+        )
+
+def build_recommendation_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                               n_neighbors: int = NEIGHBOR_K, ratings_as_of: Optional[float] = None):
+    """
+    Build the collaborative filtering model from rating arrays.
+    
+    `ratings_as_of` is the time the ratings were read. Ratings written after
+    it are applied incrementally once the model is loaded.
+    """
+    return build_neighbor_model(user_ids, product_ids, rating_users, rating_products, rating_values, n_neighbors,
+                                search=NEIGHBOR_SEARCH, workers=TRAINING_WORKERS, ratings_as_of=ratings_as_of)
 
-def generate_recommendation_model():
+def generate_recommendation_model(stages: Optional[StageTimer] = None):
     """Generate a simple recommendation model based on user ratings."""
-    users, products, ratings = load_data()
-    
-    # Create a user-item matrix
-    user_ids = [user["id"] for user in users]
-    product_ids = [product["id"] for product in products]
-    
-    # Create mappings for user and product IDs to matrix indices
-    user_to_idx = {user_id: i for i, user_id in enumerate(user_ids)}
-    product_to_idx = {product_id: i for i, product_id in enumerate(product_ids)}
-    idx_to_product = {i: product_id for product_id, i in product_to_idx.items()}
-    
-    # Create the ratings matrix (users x products)
-    matrix = np.zeros((len(user_ids), len(product_ids)))
-    
-    # Fill in the ratings
-    for rating in ratings:
-        user_idx = user_to_idx.get(rating["userId"])
-        product_idx = product_to_idx.get(rating["productId"])
-        if user_idx is not None and product_idx is not None:
-            matrix[user_idx, product_idx] = rating["rating"]
-    
-    # Create a simple model using collaborative filtering
-    # For simplicity, we're just computing similarity between users
-    # and will recommend products that similar users rated highly
-    
-    # Compute similarity matrix (cosine similarity)
-    # Handle zero vectors to avoid division by zero
-    norms = np.sqrt(np.sum(matrix ** 2, axis=1))
-    norms[norms == 0] = 1  # Avoid division by zero
-    normalized = matrix / norms[:, np.newaxis]
-    
-    # Calculate similarity matrix
-    similarity = np.dot(normalized, normalized.T)
-    
-    # Create a simple model with the necessary components
-    model = {
-        "matrix": matrix,
-        "similarity": similarity,
-        "user_to_idx": user_to_idx,
-        "product_to_idx": product_to_idx,
-        "idx_to_product": idx_to_product
-    }
+    stages = stages or StageTimer()
+    ratings_as_of = time.time()
+    data = load_data(stages)
+    with stages.stage("build"):
+        model = build_recommendation_model(*data, ratings_as_of=ratings_as_of)
+    
+    # Save the model; readers switch to it once it is completely written
+    with stages.stage("save"):
+        save_model(model, MODEL_DIR)
     
-    # Save the model
-    with open(MODEL_FILE, 'wb') as f:
-        pickle.dump(model, f)
+    # The fallback lists are rebuilt with every model, from the same ratings
+    try:
+        with stages.stage("fallback"):
+            generate_fallback(data[2], data[3], data[4], ratings_as_of)
+    except Exception as e:
+        print(f"Error building fallback lists: {e}")
     
     return model
 
-def load_or_create_model():
-    """Load the recommendation model, or create it if it doesn't exist."""
-    if MODEL_FILE.exists():
-        try:
-            with open(MODEL_FILE, 'rb') as f:
-                model = pickle.load(f)
-            return model
-        except Exception as e:
-            print(f"Error loading model: {e}")
+def generate_fallback(rating_users, rating_products, rating_values, ratings_as_of: float):
+    """
+    Rank the products served to users without recommendations.
+    
+    The popular and per-category lists are ranked from all ratings, the
+    trending list from those written in the last TRENDING_WINDOW seconds.
+    Only the latest rating of each (user, product) pair counts, as in the
+    model: the log keeps every rating a user posted.
+    """
+    _, products = load_catalog()
+    categories = [products.strings[int(code)] for code in products.arrays["category"]]
+    _, rating_products, rating_values, _ = merge_ratings(
+        (rating_users, rating_products, rating_values, np.zeros(len(rating_values))))
+    _, recent_products, recent_values, recent_ts = merge_ratings(
+        ratings_log.rating_arrays_since(ratings_as_of - TRENDING_WINDOW))
+    arrays, names = build_fallback(
+        products.ids, categories, rating_products, rating_values, recent_products, recent_values, recent_ts,
+        now=ratings_as_of,
+    )
+    save_fallback(FALLBACK_DIR, arrays, names)
+    return arrays
+
+@contextmanager
+def build_lock(engine: str):
+    """
+    Hold the build lock of an engine while the enclosed code runs.
+    
+    Yields False, without waiting, if another process holds it: builds can
+    be requested from any API worker, and the leader saves incremental
+    updates of the neighbour model under the same lock.
+    """
+    lock = FileLock(DATA_DIR / f"{engine}.build.lock")
+    try:
+        yield lock.acquire(blocking=False)
+    finally:
+        lock.close()
+
+# Details of a build skipped because another process was running it
+BUILD_SKIPPED = {"skipped": "Another worker process is building this model"}
+
+def run_model_build():
+    """Build and save the model in a worker process, returning a summary for the job status."""
+    with build_lock("neighbors") as locked:
+        if not locked:
+            return BUILD_SKIPPED
+        stages = StageTimer()
+        model = generate_recommendation_model(stages)
+    return {
+        "version": model["version"],
+        "users": len(model["user_to_idx"]),
+        "products": len(model["product_to_idx"]),
+        "ratings": int(model["matrix"].nnz),
+        "stage_seconds": stages.seconds,
+    }
+
+def generate_svd_model(stages: Optional[StageTimer] = None):
+    """Generate the low-rank SVD model from the ratings of catalog users and products."""
+    stages = stages or StageTimer()
+    ratings_as_of = time.time()
+    data = load_data(stages)
+    with stages.stage("build"):
+        model = build_svd_model(*data, ratings_as_of=ratings_as_of)
+    with stages.stage("save"):
+        save_svd_model(model, SVD_MODEL_DIR)
+    return model
+
+def run_svd_build():
+    """Build and save the SVD model in a worker process, returning a summary for the job status."""
+    with build_lock("svd") as locked:
+        if not locked:
+            return BUILD_SKIPPED
+        stages = StageTimer()
+        model = generate_svd_model(stages)
+    return {
+        "version": model["version"],
+        "users": len(model["user_to_idx"]),
+        "products": len(model["product_ids"]),
+        "factors": model["item_factors"].shape[1],
+        "stage_seconds": stages.seconds,
+    }
+
+def generate_item_model(stages: Optional[StageTimer] = None):
+    """Generate the item-item neighbour table from the ratings of catalog products."""
+    stages = stages or StageTimer()
+    ratings_as_of = time.time()
+    data = load_data(stages)
+    with stages.stage("build"):
+        model = build_item_model(*data, ratings_as_of=ratings_as_of, workers=TRAINING_WORKERS)
+    with stages.stage("save"):
+        save_item_model(model, ITEM_MODEL_DIR)
+    return model
+
+def run_item_build():
+    """Build and save the item model in a worker process, returning a summary for the job status."""
+    with build_lock("items") as locked:
+        if not locked:
+            return BUILD_SKIPPED
+        stages = StageTimer()
+        model = generate_item_model(stages)
+    return {
+        "version": model["version"],
+        "products": len(model["product_ids"]),
+        "neighbors": model["neighbor_idx"].shape[1],
+        "stage_seconds": stages.seconds,
+    }
+
+def load_model(keep=None):
+    """
+    Open the memory-mapped recommendation model.
+    
+    Returns None if it has not been built yet, in which case a new one has
+    to be built. If it cannot be read, `keep` is returned instead.
+    """
+    try:
+        return open_model(MODEL_DIR, verify=MODEL_VERIFY_CHECKSUMS)
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        return keep
+
+def load_svd_snapshot():
+    """Load the SVD model; the catalog is served from the main registry."""
+    try:
+        model = open_svd_model(SVD_MODEL_DIR, verify=MODEL_VERIFY_CHECKSUMS)
+    except Exception as e:
+        print(f"Error loading SVD model: {e}")
+        model = svd_registry.current_model()
+    return model, [], []
+
+def load_item_snapshot():
+    """Load the item model; ratings and the catalog are served from the main registry."""
+    try:
+        model = open_item_model(ITEM_MODEL_DIR, verify=MODEL_VERIFY_CHECKSUMS)
+    except Exception as e:
+        print(f"Error loading item model: {e}")
+        model = item_registry.current_model()
+    return model, [], []
+
+def load_fallback_snapshot():
+    """Load the fallback lists; the catalog is served from the main registry."""
+    try:
+        fallback = open_fallback(FALLBACK_DIR, verify=MODEL_VERIFY_CHECKSUMS)
+    except Exception as e:
+        print(f"Error loading fallback lists: {e}")
+        fallback = fallback_registry.current_model()
+    return fallback, [], []
+
+def following():
+    """Return True if another worker process applies new ratings and publishes the model."""
+    return SERVER_WORKERS > 1 and not leader_lock.held
+
+def load_snapshot():
+    """
+    Load everything the request path needs into memory.
+    
+    A stored model that cannot be read leaves the served model in place,
+    rather than serving none until the next build.
+    """
+    current = registry.current_model()
+    model = load_model(keep=current)
+    users, products = load_catalog()
+    
+    if model is None or model is current:
+        # Not built yet, or kept as it is
+        pass
+    elif following():
+        # The leader has applied the ratings; applying them here too would
+        # give this process a private copy of the model
+        forget_published_changes(model)
+    else:
+        # Catch up with the ratings written since the model was trained
+        recent = ratings_log.ratings_since(model.get("ratings_as_of", 0))
+        updated, changed_user_ids = apply_rating_updates(
+            model, [(r["userId"], r["productId"], r["rating"]) for r in recent])
+        model = with_unpublished_changes(model, updated, changed_user_ids, recent)
+    users = Catalog(users, encode=encode_json)
+    products = Catalog(products, category_column="category", encode=encode_json, rating_column="rating")
+    return model, users, products
+
+# The model and catalog are loaded once and served from memory. The registry
+# reloads them in the background whenever one of the files changes on disk;
+# a new model is published by rewriting its CURRENT pointer.
+registry = ModelRegistry(load_snapshot, watched_files=[USERS_DIR / "CURRENT", PRODUCTS_DIR / "CURRENT",
+                                                             MODEL_DIR / "CURRENT"])
+
+# Recent recommendations, keyed by model version so that a new model never
+# serves results computed from an old one
+recommendation_cache = RecommendationCache(RECOMMENDATION_CACHE_BYTES)
+
+# Blocking work of the request handlers, see REQUEST_THREADS
+blocking_pool = BlockingPool(REQUEST_THREADS, name="request")
+
+# Metrics exported by /metrics. Model builds run in worker processes, so
+# their stage timings travel back in the job details and are recorded here
+# once the job has finished.
+metrics = Metrics()
+http_request_seconds = metrics.histogram("http_request_duration_seconds", "Time to handle a request",
+                                         ["method", "route"])
+http_requests = metrics.counter("http_requests_total", "Requests handled", ["method", "route", "status"])
+recommendation_stage_seconds = metrics.histogram(
+    "recommendation_stage_seconds", "Time spent in each stage of a recommendation request", ["engine", "stage"])
+rating_stage_seconds = metrics.histogram("rating_stage_seconds", "Time spent in each stage of adding a rating",
+                                         ["stage"])
+model_build_seconds = metrics.histogram("model_build_duration_seconds", "Time to build and save a model",
+                                        ["engine"])
+model_build_stage_seconds = metrics.histogram("model_build_stage_seconds",
+                                              "Time spent in each stage of a model build", ["engine", "stage"])
+model_builds = metrics.counter("model_builds_total", "Finished model builds", ["engine", "status"])
+for stat in ("hits", "misses", "evictions", "invalidations"):
+    metrics.counter(f"recommendation_cache_{stat}_total", f"Recommendation cache {stat}",
+                    collect=lambda stat=stat: {(): recommendation_cache.stats()[stat]})
+metrics.gauge("recommendation_cache_entries", "Entries in the recommendation cache",
+              collect=lambda: {(): recommendation_cache.stats()["entries"]})
+metrics.gauge("recommendation_cache_bytes", "Estimated size of the recommendation cache",
+              collect=lambda: {(): recommendation_cache.stats()["bytes"]})
+metrics.gauge("ratings_log_records", "Ratings in the log since the last compaction, as seen by the leader",
+              collect=lambda: {(): ratings_tail.records})
+metrics.gauge("blocking_pool_tasks", "Request handler calls running or waiting on the blocking pool",
+              collect=lambda: {(): blocking_pool.tasks})
+metrics.gauge("worker_is_leader", "Whether this worker process builds models and applies new ratings",
+              collect=lambda: {(): int(leader_lock.held)})
+
+# Time every request; see RequestMetrics for profiling with X-Profile
+app.add_middleware(RequestMetrics, histogram=http_request_seconds, counter=http_requests, profile=PROFILE_REQUESTS)
+
+def record_build(engine: str):
+    """Return a callback recording the timings of a finished build of an engine."""
+    def on_finish(job):
+        model_builds.inc(engine=engine, status=job["status"])
+        if job["build_seconds"] is not None:
+            model_build_seconds.observe(job["build_seconds"], engine=engine)
+        for stage, seconds in ((job["details"] or {}).get("stage_seconds") or {}).items():
+            model_build_stage_seconds.observe(seconds, engine=engine, stage=stage)
+    return on_finish
+
+# Popular, per-category and trending products, saved with every build of the
+# neighbour model and served to users it has no recommendations for
+fallback_registry = ModelRegistry(load_fallback_snapshot, watched_files=[FALLBACK_DIR / "CURRENT"])
+
+def publish_model():
+    """Serve a freshly built neighbour model and its fallback lists."""
+    registry.reload()
+    fallback_registry.reload()
+
+# Full rebuilds run in a worker process so that they never block the event
+# loop; the new model replaces the served one once it has been saved
+model_jobs = ModelBuildJobs(run_model_build, publish_model, on_finish=record_build("neighbors"))
+
+# The SVD model is not updated incrementally; new ratings reach it with the
+# next rebuild
+svd_registry = ModelRegistry(load_svd_snapshot, watched_files=[SVD_MODEL_DIR / "CURRENT"])
+svd_jobs = ModelBuildJobs(run_svd_build, svd_registry.reload, on_finish=record_build("svd"))
+
+# The item table only holds product neighbours; the ratings it is applied to
+# are read from the served neighbour model, which new ratings reach within
+# seconds
+item_registry = ModelRegistry(load_item_snapshot, watched_files=[ITEM_MODEL_DIR / "CURRENT"])
+item_jobs = ModelBuildJobs(run_item_build, item_registry.reload, on_finish=record_build("items"))
+
+def jobs_for(engine: str) -> ModelBuildJobs:
+    """Return the build jobs of an engine."""
+    return {"svd": svd_jobs, "items": item_jobs}.get(engine, model_jobs)
+
+def model_versions():
+    """Return the version of the model served by each engine, in seconds since the epoch."""
+    registries = {"neighbors": registry, "svd": svd_registry, "items": item_registry}
+    return {(engine,): (r.get().model or {}).get("version", 0) / 1e9 for engine, r in registries.items()}
+
+metrics.gauge("model_version_timestamp_seconds", "Time the served model of each engine was built",
+              ["engine"], collect=model_versions)
+
+def apply_pending_updates():
+    """
+    Apply the ratings added to the log since the last update to the served model and publish the result.
+    
+    At most INCREMENTAL_UPDATE_BATCH ratings are applied at once, so that a
+    burst of ratings is spread over several updates rather than holding up
+    the next one.
+    """
+    records = ratings_tail.read(INCREMENTAL_UPDATE_BATCH)
+    if not records:
+        return 0
+    updates = [(r["userId"], r["productId"], r["rating"]) for r in records]
+    
+    # Retry on top of the new model if one was published meanwhile
+    while True:
+        snapshot = registry.get()
+        if snapshot.model is None:
+            # The first build reads the log, so it includes these ratings
+            return 0
+        updated, changed_user_ids = apply_rating_updates(snapshot.model, updates)
+        model = with_unpublished_changes(snapshot.model, updated, changed_user_ids, records)
+        if model is snapshot.model or registry.replace_model(snapshot.model, model):
+            break
+    
+    # Only the users whose ratings or neighbours changed, and the users who
+    # have them as a neighbour, can see different recommendations
+    for user_id in changed_user_ids:
+        recommendation_cache.invalidate_user(user_id)
+    return len(updates)
+
+def with_unpublished_changes(model, updated, changed_user_ids, records):
+    """
+    Record on an updated model what changed since it was last saved.
     
-    print("Creating new recommendation model")
-    return generate_recommendation_model()
+    With several workers, the leader saves the model with the users whose
+    recommendations may have changed and the time of the latest rating
+    applied, see `publish_updated_model`.
+    """
+    if updated is model or SERVER_WORKERS == 1:
+        return updated
+    return dict(updated,
+                unpublished_user_ids=model.get("unpublished_user_ids", frozenset()) | frozenset(changed_user_ids),
+                ratings_as_of=max([model["ratings_as_of"]] + [r.get("ts", 0) for r in records]))
 
-def get_recommendations(user_id: int, num_recommendations: int = 5):
-    """Get recommendations for a user based on collaborative filtering."""
-    model = load_or_create_model()
-    users, products, _ = load_data()
+def publish_updated_model():
+    """
+    Save the neighbour model served by the leader, if new ratings were applied to it.
     
-    # Check if the user exists
-    if user_id not in model["user_to_idx"]:
+    The other worker processes switch to the saved model as soon as they
+    notice it, dropping only the cached recommendations of the users it
+    changed. The leader serves the saved, memory-mapped model in place of its
+    own copy unless it has applied more ratings meanwhile.
+    
+    Returns:
+        True if a model was saved
+    """
+    snapshot = registry.get()
+    model = snapshot.model
+    if model is None or model.get("revision", 0) == model.get("stored_revision", 0):
+        return False
+    with build_lock("neighbors") as locked:
+        # A freshly built model may be waiting to be loaded: it is not to be
+        # replaced by an older model it has not seen yet
+        stored = load_model()
+        if not locked or stored is None or stored["version"] != model["version"]:
+            return False
+        save_model(model, MODEL_DIR, changes={
+            "previous_revision": model.get("stored_revision", 0),
+            "changed_user_ids": sorted(model.get("unpublished_user_ids", ())),
+        })
+        registry.acknowledge(MODEL_DIR / "CURRENT")
+        stored = load_model()
+    if stored is not None:
+        registry.replace_model(model, stored)
+    return True
+
+# Version and revision of the neighbour model whose recommendations a
+# follower has cached
+cached_model_revision = None
+
+def forget_published_changes(model):
+    """
+    Drop the cached recommendations a model published by the leader changes.
+    
+    A follower that missed a revision drops every cached recommendation of
+    the model. Recommendations of an older model version are never read
+    again, since the cache is keyed by version.
+    """
+    global cached_model_revision
+    version, revision = model["version"], model.get("revision", 0)
+    if cached_model_revision == (version, model.get("previous_revision")):
+        for user_id in model["changed_user_ids"]:
+            recommendation_cache.invalidate_user(int(user_id))
+    elif cached_model_revision is not None and cached_model_revision[0] == version \
+            and cached_model_revision[1] != revision:
+        recommendation_cache.clear()
+    cached_model_revision = (version, revision)
+
+def lookup_products(products: Catalog, product_ids: List[int]):
+    """Return the details of the given products that are in the catalog, in order."""
+    found = (products.get(product_id) for product_id in product_ids)
+    return [product for product in found if product is not None]
+
+def get_recommendations(user_id: int, num_recommendations: int = 5, n_neighbors: int = N_NEIGHBORS,
+                        engine: Optional[str] = None, stages: Optional[StageTimer] = None,
+                        product_filter: Optional[ProductFilter] = None):
+    """
+    Get recommendations for a user based on collaborative filtering.
+    
+    The time spent in each stage is recorded in `stages`, or directly in the
+    recommendation stage metrics if it is omitted. Products a
+    `product_filter` rejects are left out while scoring, so up to
+    `num_recommendations` of the allowed products are returned.
+    """
+    engine = engine or RECOMMENDATION_ENGINE
+    stages = stages or StageTimer(recommendation_stage_seconds, engine=engine)
+    if engine == "svd":
+        with stages.stage("scoring"):
+            return get_svd_recommendations(user_id, num_recommendations, product_filter)
+    if engine == "items":
+        with stages.stage("scoring"):
+            return get_item_recommendations(user_id, num_recommendations, product_filter)
+    
+    with stages.stage("snapshot"):
+        snapshot = registry.get()
+        model = snapshot.model
+        products = snapshot.products
+    
+    # Check if the model has been built and the user exists
+    if model is None or user_id not in model["user_to_idx"]:
         return []
     
-    user_idx = model["user_to_idx"][user_id]
-    similarity = model["similarity"][user_idx]
-    matrix = model["matrix"]
+    with stages.stage("cache"):
+        recommended_product_ids = recommendation_cache.get(user_id, num_recommendations, n_neighbors,
+                                                           model.get("version"), product_filter)
+    if recommended_product_ids is None:
+        user_idx = model["user_to_idx"][user_id]
+        with stages.stage("neighbors"):
+            neighbors, sims = select_neighbors(model["neighbor_idx"], model["neighbor_sim"], user_idx, n_neighbors)
+        recommended_product_ids = score_recommendations(model, user_idx, neighbors, sims, num_recommendations,
+                                                        n_neighbors, stages, products, product_filter)
     
-    # Get the most similar users
-    # Exclude the user's own similarity (which is 1.0)
-    similar_users = [(i, sim) for i, sim in enumerate(similarity) if i != user_idx]
-    similar_users.sort(key=lambda x: x[1], reverse=True)
-    similar_users = similar_users[:3]  # Top 3 similar users
-    
-    # Get products the user hasn't rated yet
-    user_ratings = matrix[user_idx]
-    unrated_products = [i for i, rating in enumerate(user_ratings) if rating == 0]
-    
-    # Compute weighted ratings for unrated products
-    product_scores = {}
-    for product_idx in unrated_products:
-        weighted_sum = 0
-        sim_sum = 0
-        
-        for sim_user_idx, sim_score in similar_users:
-            # Get the similar user's rating for this product
-            rating = matrix[sim_user_idx, product_idx]
-            if rating > 0:  # The similar user has rated this product
-                weighted_sum += rating * sim_score
-                sim_sum += sim_score
-        
-        # Calculate the predicted rating if we have data
-        if sim_sum > 0:
-            product_scores[product_idx] = weighted_sum / sim_sum
+    # Get full product details
+    with stages.stage("lookup"):
+        return lookup_products(products, recommended_product_ids)
+
+async def get_recommendations_async(user_id: int, num_recommendations: int = 5, n_neighbors: int = N_NEIGHBORS,
+                                    engine: Optional[str] = None, stages: Optional[StageTimer] = None,
+                                    product_filter: Optional[ProductFilter] = None):
+    """
+    Get recommendations like `get_recommendations`, without blocking the event loop.
+    
+    Scoring is handed to the blocking pool only when it reads more ratings
+    or products than SCORING_INLINE_RATINGS or SCORING_INLINE_PRODUCTS.
+    Anything faster, including every cached result, runs on the event loop:
+    the hand-off to a thread and back costs more, and threads running
+    Python code slow the event loop down as they compete for the GIL.
+    """
+    engine = engine or RECOMMENDATION_ENGINE
+    stages = stages or StageTimer(recommendation_stage_seconds, engine=engine)
+    if engine != "neighbors":
+        # The SVD engine scores the whole catalog; the item engine only the
+        # neighbours of the user's own products
+        svd_model = svd_registry.get().model
+        if engine == "svd" and svd_model is not None and len(svd_model["product_ids"]) > SCORING_INLINE_PRODUCTS:
+            return await blocking_pool.run(get_recommendations, user_id, num_recommendations, n_neighbors,
+                                           engine, stages, product_filter)
+        return get_recommendations(user_id, num_recommendations, n_neighbors, engine, stages, product_filter)
+    
+    with stages.stage("snapshot"):
+        snapshot = registry.get()
+        model = snapshot.model
+        products = snapshot.products
+    if model is None or user_id not in model["user_to_idx"]:
+        return []
+    
+    with stages.stage("cache"):
+        recommended_product_ids = recommendation_cache.get(user_id, num_recommendations, n_neighbors,
+                                                           model.get("version"), product_filter)
+    if recommended_product_ids is None:
+        user_idx = model["user_to_idx"][user_id]
+        with stages.stage("neighbors"):
+            neighbors, sims = select_neighbors(model["neighbor_idx"], model["neighbor_sim"], user_idx, n_neighbors)
+        args = (model, user_idx, neighbors, sims, num_recommendations, n_neighbors, stages, products, product_filter)
+        indptr = model["matrix"].indptr
+        if int((indptr[neighbors + 1] - indptr[neighbors]).sum()) > SCORING_INLINE_RATINGS:
+            recommended_product_ids = await blocking_pool.run(score_recommendations, *args)
+        else:
+            recommended_product_ids = score_recommendations(*args)
+    
+    with stages.stage("lookup"):
+        return lookup_products(products, recommended_product_ids)
+
+def score_recommendations(model, user_idx: int, neighbors, sims, num_recommendations: int, n_neighbors: int,
+                          stages: StageTimer, products: Catalog,
+                          product_filter: Optional[ProductFilter] = None) -> List[int]:
+    """Score a user's products from their selected neighbours, cache the best ones and return their ids."""
+    allowed = None
+    if product_filter is not None:
+        with stages.stage("filter"):
+            allowed = products.mask(product_filter, model["product_ids"])
     
-    # Sort products by predicted rating
-    recommended_product_indices = sorted(product_scores.keys(), 
-                                        key=lambda x: product_scores[x],
-                                        reverse=True)[:num_recommendations]
+    # Score every unrated product from the ratings of the most similar
+    # users and keep the best ones
+    with stages.stage("scoring"):
+        product_indices, scores = score_products(model["matrix"], user_idx, neighbors, sims, allowed)
+        recommended_product_indices = product_indices[top_k_indices(scores, num_recommendations)]
     
     # Convert indices back to product IDs
-    recommended_product_ids = [model["idx_to_product"][idx] for idx in recommended_product_indices]
+    recommended_product_ids = [int(model["product_ids"][idx]) for idx in recommended_product_indices]
     
-    # Get full product details
-    product_lookup = {product["id"]: product for product in products}
-    recommendations = [product_lookup[product_id] for product_id in recommended_product_ids 
-                    if product_id in product_lookup]
+    # Remember which users the result depends on so that a new rating
+    # from any of them invalidates it
+    with stages.stage("cache"):
+        user_id = int(model["user_ids"][user_idx])
+        neighbor_ids = [int(model["user_ids"][i]) for i in model["neighbor_idx"][user_idx] if i >= 0]
+        recommendation_cache.put(user_id, num_recommendations, n_neighbors, model.get("version"),
+                                 recommended_product_ids, neighbor_ids, product_filter)
+        # New ratings keep the model version, so a model updated while this
+        # one was being scored has the same cache keys, and its invalidations
+        # may have run before the put. The result is only kept if the model
+        # is still the one served
+        if registry.current_model() is not model:
+            recommendation_cache.invalidate_user(user_id)
+    return recommended_product_ids
+
+def get_svd_recommendations(user_id: int, num_recommendations: int = 5,
+                            product_filter: Optional[ProductFilter] = None):
+    """Get recommendations for a user from the low-rank SVD model, optionally filtered."""
+    model = svd_registry.get().model
+    if model is None or user_id not in model["user_to_idx"]:
+        return []
+    
+    # Users without ratings have no factors to score with
+    user_idx = model["user_to_idx"][user_id]
+    if model["matrix"].indptr[user_idx] == model["matrix"].indptr[user_idx + 1]:
+        return []
     
-    return recommendations
+    products = registry.get().products
+    allowed = None if product_filter is None else products.mask(product_filter, model["product_ids"])
+    product_indices, _ = recommend_svd(model, user_idx, num_recommendations, allowed)
+    recommended_product_ids = [int(model["product_ids"][idx]) for idx in product_indices]
+    
+    return lookup_products(products, recommended_product_ids)
 
-def add_rating(rating: Rating):
-    """Add a new rating and update the data file."""
-    try:
-        _, _, ratings = load_data()
+def get_item_recommendations(user_id: int, num_recommendations: int = 5,
+                             product_filter: Optional[ProductFilter] = None):
+    """Get recommendations for a user from the products similar to those they rated, optionally filtered."""
+    return next(get_item_recommendations_batch([user_id], num_recommendations, product_filter))[1]
+
+def get_recommendations_batch(user_ids: List[int], num_recommendations: int = 5,
+                              n_neighbors: int = N_NEIGHBORS, block_size: int = BATCH_BLOCK_SIZE,
+                              engine: Optional[str] = None):
+    """
+    Get recommendations for many users.
+    
+    Users are scored in blocks of `block_size` with one matrix product per
+    block, and results are yielded as soon as a block is done, so memory
+    stays bounded however many users are requested.
+    
+    Yields:
+        Tuple of (user_id, recommendations) for each user, in input order
+    """
+    if (engine or RECOMMENDATION_ENGINE) == "svd":
+        yield from get_svd_recommendations_batch(user_ids, num_recommendations, block_size)
+        return
+    if (engine or RECOMMENDATION_ENGINE) == "items":
+        yield from get_item_recommendations_batch(user_ids, num_recommendations)
+        return
+    
+    # Use the same snapshot for the whole batch
+    snapshot = registry.get()
+    model = snapshot.model
+    if model is None:
+        for user_id in user_ids:
+            yield user_id, []
+        return
+    products = snapshot.products
+    product_ids = model["product_ids"]
+    
+    for start in range(0, len(user_ids), block_size):
+        block_ids = user_ids[start:start + block_size]
+        known = [user_id for user_id in block_ids if user_id in model["user_to_idx"]]
+        ranked = recommend_batch(model, [model["user_to_idx"][user_id] for user_id in known],
+                                 n_neighbors, num_recommendations)
+        results = {user_id: product_indices for user_id, (product_indices, _) in zip(known, ranked)}
         
-        # Check if this rating already exists
-        for i, r in enumerate(ratings):
-            if r["userId"] == rating.userId and r["productId"] == rating.productId:
-                # Update existing rating
-                ratings[i]["rating"] = rating.rating
-                break
-        else:
-            # Add new rating
-            ratings.append({
-                "userId": rating.userId,
-                "productId": rating.productId,
-                "rating": rating.rating
-            })
+        for user_id in block_ids:
+            recommended_ids = [int(product_ids[idx]) for idx in results.get(user_id, [])]
+            yield user_id, lookup_products(products, recommended_ids)
+
+def get_svd_recommendations_batch(user_ids: List[int], num_recommendations: int = 5,
+                                  block_size: int = BATCH_BLOCK_SIZE):
+    """Get recommendations for many users from the low-rank SVD model."""
+    model = svd_registry.get().model
+    if model is None:
+        for user_id in user_ids:
+            yield user_id, []
+        return
+    products = registry.get().products
+    indptr = model["matrix"].indptr
+    
+    for start in range(0, len(user_ids), block_size):
+        block_ids = user_ids[start:start + block_size]
+        # Users without ratings have no factors to score with
+        known = [user_id for user_id in block_ids if user_id in model["user_to_idx"]
+                 and indptr[model["user_to_idx"][user_id]] < indptr[model["user_to_idx"][user_id] + 1]]
+        ranked = recommend_svd_batch(model, [model["user_to_idx"][user_id] for user_id in known],
+                                     num_recommendations)
+        results = {user_id: product_indices for user_id, (product_indices, _) in zip(known, ranked)}
         
-        # Save updated ratings
-        with open(RATINGS_FILE, 'w') as f:
-            json.dump(ratings, f)
+        for user_id in block_ids:
+            recommended_ids = [int(model["product_ids"][idx]) for idx in results.get(user_id, [])]
+            yield user_id, lookup_products(products, recommended_ids)
+
+def get_item_recommendations_batch(user_ids: List[int], num_recommendations: int = 5,
+                                   product_filter: Optional[ProductFilter] = None):
+    """
+    Get recommendations for many users from the item-item neighbour table.
+    
+    Each user costs one lookup of the neighbours of every product they
+    rated, so users are simply scored one after the other.
+    """
+    item_model = item_registry.get().model
+    snapshot = registry.get()
+    model = snapshot.model
+    if item_model is None or model is None:
+        for user_id in user_ids:
+            yield user_id, []
+        return
+    products = snapshot.products
+    matrix = model["matrix"]
+    allowed = None if product_filter is None else products.mask(product_filter, item_model["product_ids"])
+    
+    for user_id in user_ids:
+        user_idx = model["user_to_idx"].get(user_id)
+        if user_idx is None:
+            yield user_id, []
+            continue
         
-        # We could regenerate the model here, but for simplicity
-        # we'll skip that for now since it could be computationally expensive
+        # The user's latest ratings, including those applied incrementally
+        row = slice(matrix.indptr[user_idx], matrix.indptr[user_idx + 1])
+        product_indices, _ = recommend_items(item_model, model["product_ids"][matrix.indices[row]],
+                                             matrix.data[row], num_recommendations, allowed)
+        recommended_ids = [int(item_model["product_ids"][idx]) for idx in product_indices]
+        yield user_id, lookup_products(products, recommended_ids)
+
+def add_rating(rating: Rating):
+    """Add a new rating to the ratings log."""
+    stages = StageTimer(rating_stage_seconds)
+    try:
+        # Appending to the log replaces any previous rating of the same
+        # product by the same user when the ratings are replayed. The leader
+        # reads it back from the log and applies it to the served model with
+        # the next incremental update, a full rebuild being far too expensive
+        # to run per rating.
+        with stages.stage("log"):
+            ratings_log.upsert(rating.userId, rating.productId, rating.rating)
         return True
     except Exception as e:
         print(f"Error adding rating: {e}")
@@ -372,61 +1072,365 @@ def add_rating(rating: Rating):
 @app.on_event("startup")
 async def startup_event():
     """Initialize data and model when the API starts."""
-    initialize_data()
-    load_or_create_model()
+    # Worker processes start together; the first one creates missing data
+    init_lock = FileLock(DATA_DIR / "init.lock")
+    with init_lock.locked():
+        initialize_data()
+    init_lock.close()
+    ratings_log.open()
+    leading = acquire_leadership()
+    registry.reload()
+    svd_registry.reload()
+    item_registry.reload()
+    fallback_registry.reload()
+    if leading:
+        build_missing_models()
+    asyncio.create_task(apply_updates_periodically())
+    asyncio.create_task(rebuild_model_periodically())
+    asyncio.create_task(rebuild_item_model_periodically())
+
+def acquire_leadership() -> bool:
+    """
+    Become the leader if no other worker process is, see SERVER_WORKERS.
+    
+    Returns:
+        True if this process has just become the leader
+    """
+    if leader_lock.held or not leader_lock.acquire(blocking=False):
+        return False
+    print(f"Worker process {os.getpid()} is the leader")
+    # Ratings already in the log are caught up with by loading the model,
+    # which must happen after this
+    ratings_tail.start()
+    return True
+
+def build_missing_models():
+    """Start building the models that have not been built yet."""
+    # Serve fallback recommendations until the first models are built
+    if registry.get().model is None:
+        print("Creating new recommendation model")
+        model_jobs.submit()
+    if svd_registry.get().model is None:
+        print("Creating new SVD model")
+        svd_jobs.submit()
+    if item_registry.get().model is None:
+        print("Creating new item model")
+        item_jobs.submit()
+
+async def apply_updates_periodically():
+    """
+    Apply new ratings to the served model every few seconds, in the leader.
+    
+    The leader also compacts the ratings log, and with several workers
+    publishes the updated model. The other workers take over as leader when
+    it stops.
+    """
+    last_publish = time.monotonic()
+    while True:
+        await asyncio.sleep(INCREMENTAL_UPDATE_INTERVAL)
+        try:
+            if acquire_leadership():
+                # Catch up with the ratings the previous leader left unapplied
+                await asyncio.to_thread(registry.reload)
+                build_missing_models()
+            # Start loading any model saved by another process now rather
+            # than on the next request, which would still get the old one
+            for models in (registry, fallback_registry, svd_registry, item_registry):
+                models.get()
+            if not leader_lock.held:
+                continue
+            await asyncio.to_thread(apply_pending_updates)
+            if ratings_tail.records >= RATINGS_COMPACT_THRESHOLD:
+                ratings_log.compact_in_background()
+            if SERVER_WORKERS > 1 and time.monotonic() - last_publish >= MODEL_PUBLISH_INTERVAL:
+                last_publish = time.monotonic()
+                await asyncio.to_thread(publish_updated_model)
+        except Exception as e:
+            print(f"Error applying rating updates: {e}")
+
+async def rebuild_model_periodically():
+    """Rebuild the model from scratch now and then, as a consistency check."""
+    while True:
+        await asyncio.sleep(MODEL_REBUILD_INTERVAL)
+        try:
+            if leader_lock.held:
+                model_jobs.submit()
+                svd_jobs.submit()
+        except Exception as e:
+            print(f"Error rebuilding model: {e}")
+
+async def rebuild_item_model_periodically():
+    """Rebuild the item-item table on its own, slower schedule."""
+    while True:
+        await asyncio.sleep(ITEM_MODEL_REBUILD_INTERVAL)
+        try:
+            if leader_lock.held:
+                item_jobs.submit()
+        except Exception as e:
+            print(f"Error rebuilding item model: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Make sure every rating is on disk before the API stops."""
+    model_jobs.shutdown()
+    svd_jobs.shutdown()
+    item_jobs.shutdown()
+    blocking_pool.shutdown()
+    ratings_log.close()
+    ratings_tail.close()
+    # Let another worker process take over at once
+    leader_lock.close()
 
 # API Endpoints
+def json_response(content: bytes, total: Optional[int] = None):
+    """Send pre-serialized JSON, bypassing response model validation."""
+    headers = None if total is None else {"X-Total-Count": str(total)}
+    return Response(content=content, media_type="application/json", headers=headers)
+
 @app.get("/users", response_model=List[User])
-async def get_users():
-    """Get all users."""
-    users, _, _ = load_data()
-    return users
+async def get_users(offset: int = 0, limit: Optional[int] = None):
+    """Get all users, or the page of `limit` users starting at `offset`."""
+    users = registry.get().users
+    limit = None if limit is None else max(limit, 0)
+    if limit is not None and limit <= INLINE_PAGE_SIZE:
+        return catalog_page(users, offset, limit)
+    return await blocking_pool.run(catalog_page, users, offset, limit)
 
 @app.get("/products", response_model=List[Product])
-async def get_products():
-    """Get all products."""
-    _, products, _ = load_data()
-    return products
+async def get_products(offset: int = 0, limit: int = PRODUCTS_PAGE_SIZE, category: Optional[str] = None):
+    """
+    Get a page of products, optionally of a single category.
+    
+    The total number of matching products is sent in the X-Total-Count
+    header.
+    """
+    limit = min(max(limit, 0), MAX_PAGE_SIZE)  # Cap the page size
+    products = registry.get().products
+    if limit <= INLINE_PAGE_SIZE:
+        return catalog_page(products, offset, limit, category)
+    return await blocking_pool.run(catalog_page, products, offset, limit, category)
+
+def catalog_page(catalog: Catalog, offset: int, limit: Optional[int], category: Optional[str] = None):
+    """Render a page of users or products, with their total number in the X-Total-Count header."""
+    positions, total = catalog.page(max(offset, 0), limit, category)
+    return json_response(catalog.to_json(positions), total)
+
+def fallback_product_ids(limit: int, category: Optional[str] = None, trending: bool = False) -> List[int]:
+    """
+    Return the ids of `limit` products for users we cannot recommend for.
+    
+    The precomputed lists are sliced, so this costs O(limit) whatever the
+    size of the catalog. A short trending list is padded with popular
+    products; until the lists are built, or if they still hold fewer than
+    `limit` products, they are padded with products in catalog order.
+    """
+    fallback = fallback_registry.get().model
+    ids = []
+    if fallback is not None:
+        ids = fallback.trending(limit) if trending else fallback.popular(limit, category)
+        if trending and len(ids) < limit:
+            seen = set(ids)
+            popular = fallback.popular(limit + len(ids))
+            ids.extend(islice((i for i in popular if i not in seen), limit - len(ids)))
+    if len(ids) < limit:
+        products = registry.get().products
+        positions, _ = products.page(0, limit + len(ids), category)
+        seen = set(ids)
+        padding = (int(product_id) for product_id in products.table.ids[positions] if int(product_id) not in seen)
+        ids.extend(islice(padding, limit - len(ids)))
+    return ids
+
+def fallback_recommendations(limit: int):
+    """Return the most popular products for users we cannot recommend for."""
+    return lookup_products(registry.get().products, fallback_product_ids(limit))
+
+def filtered_fallback_product_ids(limit: int, product_filter: ProductFilter, skip: List[int]) -> List[int]:
+    """
+    Return the ids of the `limit` most popular products a filter allows.
+    
+    The popularity ranking of the filter's category is scanned a chunk at a
+    time until enough allowed products are found, so a filter rejecting few
+    products costs about as much as slicing the list. Allowed products that
+    were never rated follow, in catalog order.
+    
+    Args:
+        limit: Number of products to return
+        product_filter: Filter the products must pass
+        skip: Ids not to return, such as products already recommended
+    """
+    products = registry.get().products
+    if limit <= 0 or not len(products):
+        return []
+    allowed = products.mask(product_filter)
+    skipped = products.table.index.lookup(np.fromiter(skip, dtype=np.int64))
+    allowed[skipped[skipped >= 0]] = False
+    
+    ids = []
+    fallback = fallback_registry.get().model
+    ranked = fallback.ranked(product_filter.category) if fallback is not None else []
+    chunk_size = max(4 * limit, 256)
+    for start in range(0, len(ranked), chunk_size):
+        positions = products.table.index.lookup(np.asarray(ranked[start:start + chunk_size], dtype=np.int64))
+        positions = positions[positions >= 0]
+        positions = positions[allowed[positions]][:limit - len(ids)]
+        allowed[positions] = False
+        ids.extend(products.table.ids[positions].tolist())
+        if len(ids) == limit:
+            return ids
+    
+    ids.extend(products.table.ids[np.flatnonzero(allowed)[:limit - len(ids)]].tolist())
+    return ids
+
+def fill_filtered_recommendations(user_id: int, recommendations: List[Dict[str, Any]], limit: int,
+                                  product_filter: ProductFilter):
+    """
+    Top up filtered recommendations to `limit` products with popular products passing the filter.
+    
+    Products the user has rated are not added.
+    """
+    skip = [product["id"] for product in recommendations]
+    model = registry.get().model
+    user_idx = None if model is None else model["user_to_idx"].get(user_id)
+    if user_idx is not None:
+        matrix = model["matrix"]
+        skip.extend(model["product_ids"][matrix.indices[matrix.indptr[user_idx]:matrix.indptr[user_idx + 1]]].tolist())
+    padding = filtered_fallback_product_ids(limit - len(recommendations), product_filter, skip)
+    return recommendations + lookup_products(registry.get().products, padding)
+
+def check_engine(engine: Optional[str]):
+    """Reject unknown recommendation engines."""
+    if engine is not None and engine not in ENGINES:
+        raise HTTPException(status_code=400, detail=f"Unknown engine '{engine}', expected one of {list(ENGINES)}")
 
 @app.get("/recommendations/{user_id}", response_model=List[Product])
-async def get_user_recommendations(user_id: int, limit: int = 8):
-    """Get recommendations for a specific user."""
+async def get_user_recommendations(user_id: int, limit: int = Query(8, ge=1), engine: Optional[str] = None,
+                                   category: Optional[str] = None, exclude: List[int] = Query(default=[]),
+                                   min_rating: Optional[float] = None):
+    """
+    Get recommendations for a specific user, optionally from a given engine.
+    
+    `category`, `exclude` (repeatable) and `min_rating` restrict the
+    recommended products to a category, without the given ids, or to those
+    rated at least `min_rating` in the catalog. Filtered recommendations
+    are topped up with the most popular products passing the filter, so
+    they fill `limit` whenever enough products pass it.
+    """
+    check_engine(engine)
     if limit > 20:
         limit = 20  # Cap the number of recommendations
+    product_filter = None
+    if category is not None or exclude or min_rating is not None:
+        product_filter = ProductFilter(category, tuple(sorted(set(exclude))), min_rating)
     
-    recommendations = get_recommendations(user_id, limit)
-    if not recommendations:
-        # If no recommendations, return some random products
-        _, products, _ = load_data()
-        import random
-        random.shuffle(products)
-        return products[:limit]
+    stages = StageTimer(recommendation_stage_seconds, engine=engine or RECOMMENDATION_ENGINE)
+    recommendations = await get_recommendations_async(user_id, limit, engine=engine, stages=stages,
+                                                      product_filter=product_filter)
+    if product_filter is not None and len(recommendations) < limit:
+        with stages.stage("fallback"):
+            recommendations = fill_filtered_recommendations(user_id, recommendations, limit, product_filter)
+    elif not recommendations:
+        with stages.stage("fallback"):
+            recommendations = fallback_recommendations(limit)
     
-    return recommendations
+    with stages.stage("serialization"):
+        content = registry.get().products.to_json_ids(product["id"] for product in recommendations)
+    return json_response(content)
+
+@app.post("/recommendations/batch")
+async def get_batch_recommendations(request: BatchRecommendationRequest):
+    """
+    Get recommendations for many users at once.
+    
+    The response is streamed as NDJSON, one
+    {"user_id": ..., "recommendations": [...]} object per line.
+    """
+    check_engine(request.engine)
+    limit = min(request.limit, 20)  # Cap the number of recommendations
+    
+    def lines():
+        products = registry.get().products
+        for user_id, recommendations in get_recommendations_batch(request.user_ids, limit,
+                                                                  engine=request.engine):
+            if not recommendations:
+                recommendations = fallback_recommendations(limit)
+            # Assembled from the cached JSON of each product
+            yield (b'{"user_id": %d, "recommendations": ' % user_id
+                   + products.to_json_ids(product["id"] for product in recommendations) + b"}\n")
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/popular", response_model=List[Product])
+async def get_popular_products(limit: int = 8, category: Optional[str] = None):
+    """
+    Get the best rated products, optionally of a single category.
+    
+    Products are ranked by their average rating shrunk towards the global
+    average, so that products with few ratings do not top the list.
+    """
+    limit = min(max(limit, 0), MAX_PAGE_SIZE)
+    return json_response(registry.get().products.to_json_ids(fallback_product_ids(limit, category)))
+
+@app.get("/trending", response_model=List[Product])
+async def get_trending_products(limit: int = 8):
+    """Get the products rated well most often in the last days."""
+    limit = min(max(limit, 0), MAX_PAGE_SIZE)
+    return json_response(registry.get().products.to_json_ids(fallback_product_ids(limit, trending=True)))
 
 @app.post("/ratings")
 async def add_user_rating(rating: Rating):
     """Add or update a rating from a user."""
+    # Appending a record costs microseconds: the log is fsynced on another
+    # thread, outside the lock writers take
     success = add_rating(rating)
     if not success:
         raise HTTPException(status_code=500, detail="Failed to save rating")
     return {"success": True}
 
-@app.post("/generate_model")
-async def regenerate_model():
-    """Manually trigger model regeneration."""
+@app.post("/generate_model", status_code=202)
+async def regenerate_model(engine: Optional[str] = None):
+    """
+    Manually trigger model regeneration.
+    
+    The model of the given engine, or of the default one, is rebuilt in the
+    background and the current one keeps being served until the new one is
+    ready. If a rebuild is already queued or running, its job is returned
+    instead of starting another one.
+    """
+    check_engine(engine)
     try:
-        generate_recommendation_model()
-        return {"success": True, "message": "Model regenerated successfully"}
+        job = jobs_for(engine or RECOMMENDATION_ENGINE).submit()
+        return {"success": True, "message": "Model regeneration started", "job_id": job["id"], "job": job}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to regenerate model: {str(e)}")
 
+@app.get("/generate_model/{job_id}")
+async def get_model_job(job_id: str):
+    """Get the status and timings of a model regeneration job."""
+    job = model_jobs.get(job_id) or svd_jobs.get(job_id) or item_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/metrics")
+async def get_metrics():
+    """Export request, recommendation, rating, model build and cache metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Get hit, miss and eviction counters of the recommendation cache."""
+    return recommendation_cache.stats()
+
 # Route to check if the API is running
 @app.get("/")
 async def root():
     return {"status": "Recommendation API is running", "version": "1.0"}
 
 # Run the API with: uvicorn main:app --reload
+# or, with several worker processes: WEB_CONCURRENCY=4 uvicorn main:app
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if SERVER_WORKERS > 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=SERVER_WORKERS)
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
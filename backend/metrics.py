@@ -0,0 +1,350 @@
+import bisect
+import cProfile
+import io
+import math
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+# pyinstrument is optional: it samples the stack every few milliseconds and
+# follows await chains, so its reports of async endpoints are far more
+# readable and it slows the request down much less than cProfile, which is
+# used otherwise
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+# Seconds between two stack samples of the sampling profiler
+PROFILE_INTERVAL = 0.001
+
+# Number of functions listed in a cProfile report
+PROFILE_TOP_FUNCTIONS = 40
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values.
+
+    Args:
+        name: Metric name
+        help: One-line description
+        labels: Names of the labels every sample is identified by
+        collect: Function returning the current {label values: value} of
+            every sample, for metrics read from elsewhere at scrape time
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._collect = collect
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes the labels {list(self.labels)}, got {sorted(labels)}")
+        return tuple([labels[name] for name in self.labels])
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        """Yield (name, labels, value) for every sample."""
+        if self._collect is not None:
+            values = self._collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items(), key=_label_order):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, counted into cumulative buckets.
+
+    Args:
+        buckets: Increasing upper bounds of the buckets; values above the
+            last one are only counted in the implicit +Inf bucket
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum of the values
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the number of seconds the enclosed code takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items(), key=_label_order):
+            labels = dict(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                yield f"{self.name}_bucket", dict(labels, le=_format_value(bound)), total
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, total
+
+
+class Metrics:
+    """Set of metrics exported together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Counter:
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.help, quote=False)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    pairs = ",".join(f'{label}="{_escape(str(v))}"' for label, v in labels.items())
+                    name = f"{name}{{{pairs}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """
+    Times the stages of one operation, such as one recommendation request.
+
+    The seconds spent in each stage are kept in `seconds`, and observed into
+    a histogram labelled by stage if one is given.
+
+    Args:
+        histogram: Histogram with a "stage" label, plus the given `labels`
+        labels: Values of the other labels of the histogram
+    """
+
+    def __init__(self, histogram: Optional[Histogram] = None, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.seconds: Dict[str, float] = {}
+
+    def stage(self, name: str) -> "_Stage":
+        """Return a context manager timing the enclosed code as stage `name`."""
+        return _Stage(self, name)
+
+    def record(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=name, **self.labels)
+
+
+class _Stage:
+    # A plain class rather than a @contextmanager generator, which costs a
+    # few microseconds more per stage on the request path
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer: StageTimer, name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+
+
+class Profiler:
+    """
+    Profiles the code run between `start` and `stop`.
+
+    Uses pyinstrument's sampling profiler if it is installed, cProfile
+    otherwise. Only one profile can run at a time in a process; `start`
+    returns False while another one is running.
+    """
+
+    _running = threading.Lock()
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._profiler = None
+
+    def start(self) -> bool:
+        if not self._running.acquire(blocking=False):
+            return False
+        if pyinstrument is not None:
+            self._profiler = pyinstrument.Profiler(interval=self.interval, async_mode="enabled")
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return True
+
+    def stop(self):
+        try:
+            if pyinstrument is not None:
+                self._profiler.stop()
+            else:
+                self._profiler.disable()
+        finally:
+            self._running.release()
+
+    def report(self) -> str:
+        """Return the profile as text, slowest call paths or functions first."""
+        if pyinstrument is not None:
+            return self._profiler.output_text(unicode=True)
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        return out.getvalue()
+
+
+class RequestMetrics:
+    """
+    ASGI middleware timing every HTTP request, and profiling it on demand.
+
+    Requests are labelled by method and route template, so that requests for
+    different users of the same endpoint fall into the same series. The time
+    covers the whole response, including streamed bodies.
+
+    With `profile` set, a request sent with an X-Profile header gets the
+    profile report of its handling instead of its response.
+
+    Args:
+        app: ASGI application to wrap
+        histogram: Histogram with "method" and "route" labels
+        counter: Counter with "method", "route" and "status" labels
+        profile: Honour the X-Profile header
+    """
+
+    def __init__(self, app, histogram: Histogram, counter: Counter, profile: bool = False):
+        self.app = app
+        self.histogram = histogram
+        self.counter = counter
+        self.profile = profile
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profiler = None
+        if self.profile and any(name == b"x-profile" for name, _ in scope["headers"]):
+            profiler = Profiler()
+            if not profiler.start():
+                await _send_text(send, 409, b"Another request is being profiled")
+                return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            if profiler is None:
+                await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.stop()
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.histogram.observe(elapsed, method=scope["method"], route=route)
+            self.counter.inc(method=scope["method"], route=route, status=status)
+
+        if profiler is not None:
+            await _send_text(send, 200, profiler.report().encode(),
+                             [(b"x-profile-seconds", f"{elapsed:.6f}".encode())])
+
+
+async def _send_text(send, status: int, body: bytes, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _label_order(item):
+    return tuple(str(value) for value in item[0])
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quote else value
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
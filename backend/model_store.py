@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+from scipy import sparse
+
+# Version of the on-disk layout. Bump it whenever the set or meaning of the
+# stored arrays changes; models in another format are rebuilt, not loaded.
+FORMAT_VERSION = 1
+
+# Name of the file holding the directory name of the current model
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+
+class IdIndex:
+    """
+    Read-only mapping from ids to matrix positions.
+
+    The ids are kept in matrix order next to a sorted copy and the positions
+    that sort them, so a lookup is a binary search instead of a dict probe.
+    The three arrays can be memory-mapped, which lets a model be opened
+    without building one Python object per user or product.
+
+    Args:
+        ids: Ids in matrix order
+        order: Positions that sort `ids`; computed if omitted
+        sorted_ids: `ids[order]`; computed if omitted
+    """
+
+    def __init__(self, ids, order=None, sorted_ids=None):
+        self.ids = np.asarray(ids)
+        if order is None:
+            order = np.argsort(self.ids, kind="stable")
+        self.order = order
+        self.sorted_ids = self.ids[order] if sorted_ids is None else sorted_ids
+
+    def get(self, id_, default=None):
+        """Return the position of an id, or `default` if it is unknown."""
+        if len(self.ids) == 0:
+            return default
+        pos = int(np.searchsorted(self.sorted_ids, id_))
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == id_:
+            return int(self.order[pos])
+        return default
+
+    def lookup(self, values):
+        """Return the position of every value, or -1 for unknown ones."""
+        values = np.asarray(values)
+        if len(self.ids) == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, values), len(self.ids) - 1)
+        return np.where(self.sorted_ids[pos] == values, self.order[pos], -1)
+
+    def __getitem__(self, id_):
+        position = self.get(id_)
+        if position is None:
+            raise KeyError(id_)
+        return position
+
+    def __contains__(self, id_):
+        return self.get(id_) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def save_model(model: Dict[str, Any], model_dir: Path, keep: int = 2,
+               changes: Optional[Dict[str, Any]] = None) -> Path:
+    """
+    Write a neighbour model and publish it.
+
+    A model that new ratings were applied to since it was built is saved
+    with `changes`, as a new stored version that keeps the model's own
+    version and records which users' recommendations the new ratings may
+    have changed. Processes serving the previously saved revision can then
+    keep their cached recommendations for every other user.
+
+    Args:
+        model: Recommendation model as built by `build_neighbor_model`
+        model_dir: Directory holding every stored model version
+        keep: Number of model versions to keep, the new one included
+        changes: For an updated model, the "previous_revision" saved and the
+            "changed_user_ids" since
+
+    Returns:
+        Path of the new model version
+    """
+    matrix = model["matrix"]
+    users = model["user_to_idx"]
+    products = model["product_to_idx"]
+    arrays = {
+        "matrix_data": matrix.data,
+        "matrix_indices": matrix.indices,
+        "matrix_indptr": matrix.indptr,
+        "norms": model["norms"],
+        "neighbor_idx": model["neighbor_idx"],
+        "neighbor_sim": model["neighbor_sim"],
+        "user_ids": users.ids,
+        "user_order": users.order,
+        "user_sorted_ids": users.sorted_ids,
+        "product_ids": products.ids,
+        "product_order": products.order,
+        "product_sorted_ids": products.sorted_ids,
+    }
+    metadata = {"ratings_as_of": model["ratings_as_of"], "shape": list(matrix.shape),
+                "revision": model.get("revision", 0)}
+    stored_version = model["version"]
+    if changes is not None:
+        # The version names the directory, so each revision needs its own
+        stored_version = max(time.time_ns(), model["version"] + 1)
+        metadata.update(model_version=model["version"], previous_revision=changes["previous_revision"])
+        arrays["changed_user_ids"] = np.asarray(changes["changed_user_ids"], dtype=np.int64)
+    return save_arrays(model_dir, "neighbors", stored_version, arrays, metadata, keep)
+
+
+def open_model(model_dir: Path, verify: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Open the current neighbour model with every array memory-mapped.
+
+    Args:
+        model_dir: Directory the model was saved to
+        verify: Check every array against its checksum, which reads it in full
+
+    Returns:
+        The model, or None if none has been saved yet
+
+    Raises:
+        ValueError: If the stored model is damaged or in an unknown format
+    """
+    stored = open_arrays(model_dir, "neighbors", verify)
+    if stored is None:
+        return None
+    arrays, manifest = stored
+
+    matrix = sparse.csr_matrix(
+        (arrays["matrix_data"], arrays["matrix_indices"], arrays["matrix_indptr"]),
+        shape=tuple(manifest["shape"]),
+    )
+    return {
+        "matrix": matrix,
+        "norms": arrays["norms"],
+        "neighbor_idx": arrays["neighbor_idx"],
+        "neighbor_sim": arrays["neighbor_sim"],
+        "user_ids": arrays["user_ids"],
+        "product_ids": arrays["product_ids"],
+        "user_to_idx": IdIndex(arrays["user_ids"], arrays["user_order"], arrays["user_sorted_ids"]),
+        "product_to_idx": IdIndex(arrays["product_ids"], arrays["product_order"],
+                                  arrays["product_sorted_ids"]),
+        "version": manifest.get("model_version", manifest["version"]),
+        "revision": manifest.get("revision", 0),
+        "stored_revision": manifest.get("revision", 0),
+        "previous_revision": manifest.get("previous_revision"),
+        "changed_user_ids": arrays.get("changed_user_ids"),
+        "ratings_as_of": manifest["ratings_as_of"],
+    }
+
+
+def save_arrays(model_dir: Path, kind: str, version: int, arrays: Dict[str, np.ndarray],
+                metadata: Dict[str, Any], keep: int = 2) -> Path:
+    """
+    Write a set of arrays as a new model version and publish it.
+
+    The arrays and a manifest with their sizes and SHA-256 checksums are
+    written to a temporary directory, which is renamed into place before
+    the CURRENT pointer is atomically switched to it. Readers therefore see
+    either the previous version or the complete new one.
+
+    Args:
+        model_dir: Directory holding every stored version
+        kind: Kind of model, checked when the arrays are opened
+        version: Model version, also used as the directory name
+        arrays: Arrays to store, by name
+        metadata: JSON-serializable values stored in the manifest
+        keep: Number of versions to keep, the new one included
+
+    Returns:
+        Path of the new version
+    """
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    name = str(version)
+    tmp_dir = model_dir / f".tmp-{name}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+
+    files = {}
+    for key, array in arrays.items():
+        path = tmp_dir / f"{key}.npy"
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+            f.flush()
+            os.fsync(f.fileno())
+        files[key] = {"file": path.name, "bytes": path.stat().st_size, "sha256": _sha256(path)}
+
+    manifest = dict(metadata, format=FORMAT_VERSION, kind=kind, version=version, arrays=files)
+    _write_atomically(tmp_dir / MANIFEST_FILE, json.dumps(manifest, indent=2))
+
+    version_dir = model_dir / name
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(tmp_dir, version_dir)
+    _write_atomically(model_dir / CURRENT_FILE, name)
+    _prune(model_dir, keep)
+    return version_dir
+
+
+def open_arrays(model_dir: Path, kind: str, verify: bool = False):
+    """
+    Memory-map the arrays of the current version.
+
+    Nothing is read up front apart from the manifest and the array headers,
+    so opening takes the same time whatever the size of the model, and
+    processes that open the same version share its pages through the OS
+    page cache.
+
+    Args:
+        model_dir: Directory the arrays were saved to
+        kind: Expected kind of model
+        verify: Check every array against its checksum, which reads it in full
+
+    Returns:
+        Tuple of (arrays, manifest), or None if nothing has been saved yet
+
+    Raises:
+        ValueError: If the stored arrays are damaged or in an unknown format
+    """
+    model_dir = Path(model_dir)
+    try:
+        name = (model_dir / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+    version_dir = model_dir / name
+    with open(version_dir / MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_VERSION or manifest.get("kind") != kind:
+        raise ValueError(f"Unsupported model format {manifest.get('format')} "
+                         f"of kind {manifest.get('kind')} in {version_dir}")
+
+    arrays = {}
+    for key, entry in manifest["arrays"].items():
+        path = version_dir / entry["file"]
+        if path.stat().st_size != entry["bytes"]:
+            raise ValueError(f"Size mismatch for {path}")
+        if verify and _sha256(path) != entry["sha256"]:
+            raise ValueError(f"Checksum mismatch for {path}")
+        arrays[key] = np.load(path, mmap_mode="r")
+    return arrays, manifest
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomically(path: Path, text: str):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _prune(model_dir: Path, keep: int):
+    """Delete all but the `keep` newest model versions."""
+    versions = sorted((p for p in model_dir.iterdir() if p.is_dir() and p.name.isdigit()),
+                      key=lambda p: int(p.name))
+    # Processes that still have an old version mapped keep reading it; its
+    # pages are only released once they let go of it
+    for path in versions[:-keep]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,67 +1,240 @@
-
 import pandas as pd
 import numpy as np
-from scipy.sparse.linalg import svds
-import pickle
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator, svds
+import os
+import sys
+import time
 from pathlib import Path
 
-def create_recommendation_model(ratings_df):
+from ingest import INGEST_CHUNK_SIZE, collect_ratings, read_rating_chunks
+
+from model_store import IdIndex, open_arrays, save_arrays
+from similarity import build_rating_matrix, top_k_indices
+
+# Number of latent factors kept by the truncated SVD
+N_FACTORS = 10
+
+# Data directory the API serves (DATA_DIR, as in main.py), and directory the
+# SVD model is saved to in it, next to the neighbour model
+DATA_DIR = Path(os.environ.get("DATA_DIR", Path(__file__).parent / "data"))
+SVD_MODEL_DIR = DATA_DIR / "svd_model"
+
+# Maximum number of (user, product) scores held in memory at once when
+# scoring a block of users
+SCORE_BLOCK_ELEMENTS = 2**22
+
+def build_svd_model(user_ids, product_ids, rating_users, rating_products, rating_values,
+                    n_factors=N_FACTORS, ratings_as_of=None):
     """
-    Create and save a collaborative filtering recommendation model.
+    Factorize the user-item matrix with a truncated SVD.
+    
+    Only the factors are kept: a user's predicted ratings are computed on
+    demand from their factor row, so memory is O((users + products) * k)
+    instead of the O(users * products) of a full prediction matrix.
     
     Args:
-        ratings_df: DataFrame with columns userId, productId, rating
+        user_ids: Array of user ids, in matrix order
+        product_ids: Array of product ids, in matrix order
+        rating_users: User id of every rating
+        rating_products: Product id of every rating
+        rating_values: Value of every rating
+        n_factors: Number of latent factors
+        ratings_as_of: Time the ratings were read
     
     Returns:
         The trained model
     """
-    print("Creating user-item matrix...")
-    # Create user-item matrix
-    user_item_matrix = ratings_df.pivot(
-        index='userId', 
-        columns='productId', 
-        values='rating'
-    ).fillna(0)
+    matrix = build_rating_matrix(user_ids, product_ids, rating_users, rating_products, rating_values)
     
-    # Normalize the data (subtract mean rating for each user)
-    user_ratings_mean = np.mean(user_item_matrix.values, axis=1)
-    ratings_demeaned = user_item_matrix.values - user_ratings_mean.reshape(-1, 1)
+    # Normalize the data (subtract mean rating for each user, unrated
+    # products counting as zero). The demeaned matrix is dense, so it is only
+    # ever applied through matrix-vector products on the sparse one
+    user_ratings_mean = np.asarray(matrix.sum(axis=1)).ravel() / max(matrix.shape[1], 1)
+    ratings_demeaned = _demeaned_operator(matrix, user_ratings_mean)
     
-    print("Performing SVD decomposition...")
-    # Perform SVD
-    U, sigma, Vt = svds(ratings_demeaned, k=min(min(ratings_demeaned.shape)-1, 10))
+    k = min(min(matrix.shape) - 1, n_factors)
+    if k < 1:
+        raise ValueError("At least two users and two products are needed to factorize the ratings")
+    U, sigma, Vt = svds(ratings_demeaned, k=k, random_state=0)
     
-    # Convert sigma to diagonal matrix
-    sigma = np.diag(sigma)
+    return {
+        'matrix': matrix,
+        'user_factors': U * sigma,
+        'item_factors': np.ascontiguousarray(Vt.T),
+        'user_ratings_mean': user_ratings_mean,
+        'user_to_idx': IdIndex(user_ids),
+        'product_ids': np.asarray(product_ids),
+        'version': time.time_ns(),
+        'ratings_as_of': time.time() if ratings_as_of is None else ratings_as_of,
+    }
+
+def _demeaned_operator(matrix, row_means):
+    """The dense matrix `matrix - row_means[:, None]` as a linear operator."""
+    def matvec(x):
+        x = np.ravel(x)
+        return matrix @ x - row_means * x.sum()
     
-    # Predict ratings for all users
-    all_user_predicted_ratings = np.dot(np.dot(U, sigma), Vt) + user_ratings_mean.reshape(-1, 1)
+    def rmatvec(y):
+        y = np.ravel(y)
+        return matrix.T @ y - row_means @ y
     
-    # Convert to DataFrame
-    preds = pd.DataFrame(
-        all_user_predicted_ratings, 
-        index=user_item_matrix.index,
-        columns=user_item_matrix.columns
-    )
+    return LinearOperator(matrix.shape, matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
+
+def create_recommendation_model(ratings_df, n_factors=N_FACTORS, model_dir=SVD_MODEL_DIR):
+    """
+    Create and save a collaborative filtering recommendation model.
     
-    # Create a model dictionary
-    model = {
-        'user_item_matrix': user_item_matrix,
-        'predictions': preds,
-        'user_ids': list(user_item_matrix.index),
-        'product_ids': list(user_item_matrix.columns),
-        'user_ratings_mean': user_ratings_mean
-    }
+    Args:
+        ratings_df: DataFrame with columns userId, productId, rating
+        n_factors: Number of latent factors
+        model_dir: Directory to save the model to
+    
+    Returns:
+        The trained model
+    """
+    print("Performing SVD decomposition...")
+    model = build_svd_model(
+        np.unique(ratings_df['userId'].to_numpy()),
+        np.unique(ratings_df['productId'].to_numpy()),
+        ratings_df['userId'].to_numpy(),
+        ratings_df['productId'].to_numpy(),
+        ratings_df['rating'].to_numpy(dtype=np.float64),
+        n_factors=n_factors,
+    )
     
     # Save the model to disk
-    model_path = Path(__file__).parent / 'data' / 'recommendation_model.pkl'
-    with open(model_path, 'wb') as f:
-        pickle.dump(model, f)
-        
+    model_path = save_svd_model(model, model_dir)
     print(f"Model saved to {model_path}")
     
     return model
 
+def create_recommendation_model_from_file(ratings_file, n_factors=N_FACTORS, model_dir=SVD_MODEL_DIR,
+                                          chunk_size=INGEST_CHUNK_SIZE):
+    """
+    Create and save an SVD model from a ratings dump of any size.
+    
+    The file (JSON array, NDJSON or CSV) is streamed in chunks of
+    `chunk_size` ratings straight into arrays, so parsing never holds more
+    than one chunk of Python objects and no DataFrame is built.
+    
+    Args:
+        ratings_file: Path of the ratings dump
+        n_factors: Number of latent factors
+        model_dir: Directory to save the model to
+        chunk_size: Number of ratings parsed at once
+    
+    Returns:
+        The trained model
+    """
+    rating_users, rating_products, rating_values = collect_ratings(read_rating_chunks(ratings_file, chunk_size))
+    print(f"Read {len(rating_values)} ratings, performing SVD decomposition...")
+    model = build_svd_model(np.unique(rating_users), np.unique(rating_products),
+                            rating_users, rating_products, rating_values, n_factors=n_factors)
+    
+    model_path = save_svd_model(model, model_dir)
+    print(f"Model saved to {model_path}")
+    
+    return model
+
+def save_svd_model(model, model_dir=SVD_MODEL_DIR):
+    """Save the factors and rating matrix of an SVD model as memory-mappable arrays."""
+    matrix = model['matrix']
+    users = model['user_to_idx']
+    arrays = {
+        'matrix_data': matrix.data,
+        'matrix_indices': matrix.indices,
+        'matrix_indptr': matrix.indptr,
+        'user_factors': model['user_factors'],
+        'item_factors': model['item_factors'],
+        'user_ratings_mean': model['user_ratings_mean'],
+        'user_ids': users.ids,
+        'user_order': users.order,
+        'user_sorted_ids': users.sorted_ids,
+        'product_ids': model['product_ids'],
+    }
+    metadata = {'ratings_as_of': model['ratings_as_of'], 'shape': list(matrix.shape)}
+    return save_arrays(model_dir, 'svd', model['version'], arrays, metadata)
+
+def open_svd_model(model_dir=SVD_MODEL_DIR, verify=False):
+    """
+    Open a saved SVD model with its arrays memory-mapped.
+    
+    Returns:
+        The model, or None if none has been saved yet
+    """
+    stored = open_arrays(model_dir, 'svd', verify)
+    if stored is None:
+        return None
+    arrays, manifest = stored
+    
+    matrix = sparse.csr_matrix(
+        (arrays['matrix_data'], arrays['matrix_indices'], arrays['matrix_indptr']),
+        shape=tuple(manifest['shape']),
+    )
+    return {
+        'matrix': matrix,
+        'user_factors': arrays['user_factors'],
+        'item_factors': arrays['item_factors'],
+        'user_ratings_mean': arrays['user_ratings_mean'],
+        'user_to_idx': IdIndex(arrays['user_ids'], arrays['user_order'], arrays['user_sorted_ids']),
+        'product_ids': arrays['product_ids'],
+        'version': manifest['version'],
+        'ratings_as_of': manifest['ratings_as_of'],
+    }
+
+def recommend(model, user_idx, limit, allowed=None):
+    """
+    Rank the best unrated products for a user.
+    
+    The predicted ratings are one k-length dot product per product, and only
+    the top `limit` of them are sorted.
+    
+    Args:
+        model: Trained SVD model
+        user_idx: Matrix row of the user
+        limit: Number of products to return
+        allowed: Boolean mask of the products that may be returned; all if omitted
+    
+    Returns:
+        Tuple of (product_indices, scores) ordered by decreasing score, ties
+        broken by the lower product index
+    """
+    scores = model['item_factors'] @ model['user_factors'][user_idx] + model['user_ratings_mean'][user_idx]
+    return _top_unrated(model['matrix'], user_idx, scores, limit, allowed)
+
+def recommend_batch(model, user_indices, limit):
+    """
+    Rank the best unrated products for many users.
+    
+    Users are scored in blocks with one matrix product each, the block size
+    keeping at most SCORE_BLOCK_ELEMENTS scores in memory.
+    
+    Yields:
+        Tuple of (product_indices, scores) for each user, in input order
+    """
+    user_indices = np.asarray(user_indices, dtype=np.int64)
+    n_products = model['item_factors'].shape[0]
+    block_size = max(1, SCORE_BLOCK_ELEMENTS // max(n_products, 1))
+    
+    for start in range(0, len(user_indices), block_size):
+        block = user_indices[start:start + block_size]
+        scores = model['user_factors'][block] @ model['item_factors'].T
+        scores += model['user_ratings_mean'][block][:, None]
+        for row, user_idx in enumerate(block):
+            yield _top_unrated(model['matrix'], user_idx, scores[row], limit)
+
+def _top_unrated(matrix, user_idx, scores, limit, allowed=None):
+    # Leave out the products the user has already rated
+    row = slice(matrix.indptr[user_idx], matrix.indptr[user_idx + 1])
+    rated = matrix.indices[row][matrix.data[row] > 0]
+    candidates = np.ones(len(scores), dtype=bool) if allowed is None else allowed.copy()
+    candidates[rated] = False
+    
+    product_indices = np.flatnonzero(candidates)
+    top = top_k_indices(scores[product_indices], limit)
+    return product_indices[top], scores[product_indices[top]]
+
 def recommend_products(model, user_id, n_recommendations=5):
     """
     Recommend products for a user based on the trained model.
@@ -75,26 +248,13 @@ def recommend_products(model, user_id, n_recommendations=5):
         List of product IDs
     """
     # Get user's index
-    try:
-        user_idx = model['user_ids'].index(user_id)
-    except ValueError:
+    user_idx = model['user_to_idx'].get(user_id)
+    if user_idx is None:
         print(f"User {user_id} not found in the model")
         return []
     
-    # Get products the user has already rated
-    user_data = model['user_item_matrix'].iloc[user_idx]
-    rated_products = user_data[user_data > 0].index.tolist()
-    
-    # Get predictions for this user
-    user_predictions = model['predictions'].iloc[user_idx]
-    
-    # Filter out products the user has already rated
-    unrated_products = user_predictions.drop(rated_products)
-    
-    # Get top n recommendations
-    top_recommendations = unrated_products.sort_values(ascending=False).index[:n_recommendations]
-    
-    return top_recommendations.tolist()
+    product_indices, _ = recommend(model, user_idx, n_recommendations)
+    return [int(model['product_ids'][idx]) for idx in product_indices]
 
 def create_sample_dataset():
     """
@@ -153,10 +313,17 @@ def create_sample_dataset():
 def main():
     """
     Main function to demonstrate creating a recommendation model.
+    
+    With a ratings file as argument, the model is trained on that file
+    instead of the sample dataset.
     """
+    if len(sys.argv) > 1:
+        create_recommendation_model_from_file(sys.argv[1])
+        return
+    
     # Create a data directory if it doesn't exist
-    data_dir = Path(__file__).parent / 'data'
-    data_dir.mkdir(exist_ok=True)
+    data_dir = DATA_DIR
+    data_dir.mkdir(parents=True, exist_ok=True)
     
     # Create sample dataset
     users, products, ratings = create_sample_dataset()
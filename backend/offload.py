@@ -0,0 +1,54 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class BlockingPool:
+    """
+    Bounded thread pool running the blocking work of async request handlers.
+
+    File I/O and NumPy scoring run on one of `max_workers` threads while the
+    event loop keeps serving other requests; work submitted beyond that
+    waits in the pool's queue. NumPy and file I/O release the GIL, so
+    requests overlap rather than take turns on the event loop.
+
+    Handing work to a thread and back costs tens of microseconds, more than
+    a cache hit or a small page of the catalog, so handlers only offload the
+    work that can take longer.
+
+    Args:
+        max_workers: Number of threads
+        name: Prefix of the thread names
+    """
+
+    def __init__(self, max_workers: int, name: str = "blocking"):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Only changed on the event loop thread
+        self._tasks = 0
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Run `fn(*args, **kwargs)` on the pool and return its result."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        self._tasks += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            self._tasks -= 1
+
+    @property
+    def tasks(self) -> int:
+        """Number of calls running or waiting for a thread."""
+        return self._tasks
+
+    def shutdown(self):
+        """Wait for the submitted calls; the pool starts again on the next `run`."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,505 @@
+import json
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ingest import INGEST_CHUNK_SIZE, chunk_ratings
+from locks import FileLock
+from storage import RATING_COLUMNS, merge_ratings, open_ratings, rating_records, save_ratings
+
+# Ids the columns of the ratings snapshot can hold
+STORABLE_IDS = range(np.iinfo(RATING_COLUMNS["userId"]).min, np.iinfo(RATING_COLUMNS["userId"]).max + 1)
+
+
+class RatingsLog:
+    """
+    Append-only ratings storage on top of a columnar snapshot.
+
+    Every upsert appends one NDJSON record to the log file, so a write costs
+    O(1) no matter how many ratings exist. Records are flushed to the OS on
+    every write and fsynced in batches by a background thread at most
+    `fsync_interval` seconds later.
+
+    Once the log holds more than `compact_threshold` records it is compacted
+    in the background: the log is rotated to a pending file, writers carry on
+    with a fresh log, and the pending records are merged into a new snapshot.
+    The snapshot is a set of memory-mapped typed arrays (see storage.py), so
+    reading it costs no parsing. Reading the ratings replays the snapshot,
+    any pending file and the log, with the latest record for each
+    (userId, productId) pair winning.
+
+    A `shared` log may be written by several processes at once. Every append
+    is a single write to a file opened for appending, made under a shared
+    flock on a lock file next to the log; a compaction rotates the log under
+    the exclusive lock, and writers that find the log rotated reopen it. Once
+    the log is open, its record count only includes this process's own writes,
+    so compactions are left to the caller (see `LogTail.records`).
+
+    Args:
+        snapshot_dir: Directory of the stored ratings
+        log_file: NDJSON log of ratings written since the last compaction
+        fsync_interval: Maximum number of seconds between fsyncs
+        compact_threshold: Number of log records that triggers a compaction
+        shared: Let several processes write to the log
+    """
+
+    def __init__(self, snapshot_dir: Path, log_file: Path, fsync_interval: float = 0.05,
+                 compact_threshold: int = 100_000, shared: bool = False):
+        self.snapshot_dir = Path(snapshot_dir)
+        self.log_file = Path(log_file)
+        self.pending_file = self.log_file.with_suffix(self.log_file.suffix + ".pending")
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.shared = shared
+
+        self._file = None
+        self._size = 0
+        self._records = 0
+        self._dirty = False
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._file_lock = FileLock(self.log_file.with_suffix(self.log_file.suffix + ".lock")) if shared else None
+
+        # Guards the log file handle, its size and the file lock
+        self._lock = threading.Lock()
+        # Guards the set of files while they are being replayed or compacted
+        self._files_lock = threading.Lock()
+        self._compacting = threading.Lock()
+
+    def open(self):
+        """Open the log, counting the records it holds."""
+        with self._lock:
+            if self._file is not None:
+                return
+            with self._exclusive_locked():
+                self._size, self._records = self._scan_log()
+                self._file = open(self.log_file, "ab")
+            self._closed.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name="ratings-log-fsync", daemon=True)
+            self._flusher.start()
+
+    def close(self):
+        """Fsync any outstanding records and close the log."""
+        # Let a running compaction finish first
+        with self._compacting:
+            pass
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        with self._lock:
+            if self._file is not None:
+                self._fsync_locked()
+                self._file.close()
+                self._file = None
+            if self._file_lock is not None:
+                self._file_lock.close()
+
+    def upsert(self, user_id: int, product_id: int, rating: float, ts: Optional[float] = None):
+        """Add a rating, replacing any previous rating of the same product by the same user."""
+        if self._file is None:
+            self.open()
+        with self._lock:
+            # Timestamps are taken under the lock so that they follow the
+            # order of the records in the log
+            record = {"userId": user_id, "productId": product_id, "rating": rating,
+                      "ts": time.time() if ts is None else ts}
+            line = (json.dumps(record) + "\n").encode()
+            if self._file_lock is None:
+                self._file.write(line)
+                self._file.flush()
+            else:
+                with self._file_lock.locked(shared=True):
+                    self._reopen_if_rotated_locked()
+                    self._file.write(line)
+                    self._file.flush()
+            self._size += len(line)
+            self._records += 1
+            self._dirty = True
+            needs_compaction = not self.shared and self._records >= self.compact_threshold
+
+        if needs_compaction:
+            self.compact_in_background()
+
+    def ratings(self) -> List[dict]:
+        """Replay the snapshot and the log into a list of ratings."""
+        with self._files_lock, self._open_files() as (snapshot, pending, log):
+            merged = {}
+            if snapshot is not None:
+                _apply_records(merged, rating_records(snapshot))
+            _apply_records(merged, _read_records(pending))
+            _apply_records(merged, _read_records(log))
+        return list(merged.values())
+
+    def rating_chunks(self, chunk_size: int = INGEST_CHUNK_SIZE):
+        """
+        Stream the snapshot and the log as chunks of rating arrays.
+
+        Records come in replay order, so keeping the last rating of each
+        (userId, productId) pair gives the same result as `ratings`. Nothing
+        but one chunk of the log is parsed at a time, and the snapshot is
+        sliced straight from its memory-mapped arrays.
+
+        Yields:
+            Tuple of (rating_users, rating_products, rating_values) arrays
+        """
+        with self._files_lock, self._open_files() as (snapshot, pending, log):
+            if snapshot is not None:
+                for start in range(0, len(snapshot["userId"]), chunk_size):
+                    part = slice(start, start + chunk_size)
+                    yield (snapshot["userId"][part].astype(np.int64), snapshot["productId"][part].astype(np.int64),
+                           snapshot["rating"][part].astype(np.float64))
+            records = (r for part in (_read_records(pending), _read_records(log)) for r in part)
+            yield from chunk_ratings(((r["userId"], r["productId"], r["rating"]) for r in records), chunk_size)
+
+    def rating_arrays(self):
+        """
+        Replay the snapshot and the log into rating arrays.
+
+        Unlike `ratings`, this keeps the time every rating was written and
+        builds no dict per stored rating.
+
+        Returns:
+            Tuple of (users, products, values, ts) arrays, see `merge_ratings`
+        """
+        with self._files_lock, self._open_files() as (snapshot, pending, log):
+            parts = []
+            if snapshot is not None:
+                parts.append((snapshot["userId"], snapshot["productId"], snapshot["rating"], snapshot["ts"]))
+            parts.append(_record_arrays(r for part in (_read_records(pending), _read_records(log)) for r in part))
+            return merge_ratings(*parts)
+
+    def ratings_since(self, ts: float) -> List[dict]:
+        """
+        Return the ratings written after `ts`, oldest first.
+
+        The snapshot is only searched if it was written after `ts`; otherwise
+        only the log is replayed.
+        """
+        records = []
+        with self._files_lock, self._open_files() as (snapshot, pending, log):
+            if snapshot is not None and snapshot["version"] / 1e9 >= ts:
+                records.extend(rating_records(snapshot, np.flatnonzero(snapshot["ts"] > ts)))
+            records.extend(r for r in _read_records(pending) if r.get("ts", 0) > ts)
+            records.extend(r for r in _read_records(log) if r.get("ts", 0) > ts)
+        return records
+
+    def rating_arrays_since(self, ts: float):
+        """
+        Return the ratings written after `ts` as arrays.
+
+        Unlike `ratings_since`, the snapshot is searched with a mask over its
+        `ts` column, building no dict per stored rating.
+
+        Returns:
+            Tuple of (users, products, values, ts) arrays, including every
+            rating of a (user, product) pair written after `ts`
+        """
+        with self._files_lock, self._open_files() as (snapshot, pending, log):
+            parts = []
+            if snapshot is not None and snapshot["version"] / 1e9 >= ts:
+                rows = np.flatnonzero(snapshot["ts"] > ts)
+                parts.append(tuple(snapshot[name][rows] for name in RATING_COLUMNS))
+            parts.append(_record_arrays(r for part in (_read_records(pending), _read_records(log)) for r in part
+                                        if r.get("ts", 0) > ts))
+            return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def sync(self):
+        """
+        Fsync the log now.
+
+        Writers are not held up by the fsync, which can take milliseconds:
+        it runs on a duplicate of the file descriptor, outside the lock.
+        """
+        with self._lock:
+            if not self._dirty or self._file is None:
+                return
+            fd = os.dup(self._file.fileno())
+            self._dirty = False
+        try:
+            os.fsync(fd)
+        except OSError:
+            self._dirty = True
+            raise
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """Merge the log into a new snapshot and start a fresh log."""
+        with self._compacting:
+            self._compact_locked()
+
+    def compact_in_background(self):
+        """Start a compaction on a background thread unless one is running."""
+        if not self._compacting.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._compact_locked()
+            except Exception as e:
+                print(f"Error compacting ratings log: {e}")
+            finally:
+                self._compacting.release()
+
+        threading.Thread(target=run, name="ratings-log-compaction", daemon=True).start()
+
+    def _compact_locked(self):
+        if self._file is None:
+            self.open()
+        with self._files_lock:
+            # Rotate the log unless a previous compaction left a pending file
+            with self._lock, self._exclusive_locked():
+                if not self.pending_file.exists():
+                    self._fsync_locked()
+                    self._file.close()
+                    os.replace(self.log_file, self.pending_file)
+                    self._file = open(self.log_file, "ab")
+                    self._size, self._records = 0, 0
+
+            with open(self.pending_file, "rb") as pending:
+                records = list(_read_records(pending))
+            # A record that cannot be stored would fail every compaction
+            # from now on, keeping the pending file forever
+            storable = [r for r in records if r["userId"] in STORABLE_IDS and r["productId"] in STORABLE_IDS]
+            if len(storable) < len(records):
+                print(f"Dropping {len(records) - len(storable)} ratings with ids out of range from {self.pending_file}")
+            records = storable
+            parts = []
+            snapshot = open_ratings(self.snapshot_dir)
+            if snapshot is not None:
+                parts.append((snapshot["userId"], snapshot["productId"], snapshot["rating"], snapshot["ts"]))
+            parts.append(_record_arrays(records))
+
+            # Written to a new version, so readers of the current one are
+            # unaffected until the pointer to it is switched
+            save_ratings(self.snapshot_dir, *merge_ratings(*parts))
+            self.pending_file.unlink()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            self.sync()
+
+    def _fsync_locked(self):
+        if self._dirty and self._file is not None:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    @contextmanager
+    def _exclusive_locked(self):
+        """Keep every other process from writing to the log, if it is shared."""
+        if self._file_lock is None:
+            yield
+        else:
+            with self._file_lock.locked():
+                yield
+
+    def _reopen_if_rotated_locked(self):
+        """Switch to the new log if another process rotated this one."""
+        try:
+            rotated = os.stat(self.log_file).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self._fsync_locked()
+            self._file.close()
+            self._file = open(self.log_file, "ab")
+
+    def _scan_log(self):
+        """Count the records of the log, dropping a torn record left by a crash."""
+        if not self.log_file.exists():
+            return 0, 0
+
+        offset = records = 0
+        with open(self.log_file, "rb") as f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    break
+                offset += len(line)
+                records += 1
+
+        if offset != self.log_file.stat().st_size:
+            print(f"Truncating torn record at offset {offset} of {self.log_file}")
+            os.truncate(self.log_file, offset)
+        return offset, records
+
+    @contextmanager
+    def _open_files(self):
+        """
+        Open the log, the pending file and the snapshot, in that order.
+
+        Other processes (such as a model build) read the files without the
+        locks of the process that compacts them. Because a compaction renames
+        the log to the pending file and replaces the snapshot before deleting
+        the pending file, opening the files newest first means every record
+        is in at least one of the open files. The snapshot is yielded as the
+        arrays returned by `open_ratings`.
+        """
+        # Other processes append to a shared log; their records past this
+        # process's writes are read as well, up to a record being written
+        with self._lock:
+            log_size = self._size if self._file is not None and not self.shared else None
+        with ExitStack() as stack:
+            files = []
+            for path in (self.log_file, self.pending_file):
+                try:
+                    files.append(stack.enter_context(open(path, "rb")))
+                except FileNotFoundError:
+                    files.append(None)
+            log, pending = files
+            snapshot = open_ratings(self.snapshot_dir)
+            if log is not None and log_size is not None:
+                log = _LimitedReader(log, log_size)
+            yield snapshot, pending, log
+
+
+class LogTail:
+    """
+    Follows the records appended to a ratings log by every process writing to it.
+
+    Each `read` returns the complete records appended since the previous
+    one. When the log is rotated by a compaction, the rest of the rotated
+    file is read before moving on to the new log, so no record is skipped.
+    Records are only ever read once, whichever process wrote them.
+
+    Args:
+        log_file: Ratings log to follow
+    """
+
+    def __init__(self, log_file: Path):
+        self.log_file = Path(log_file)
+        # Complete records in the current log file, including those that
+        # were there before the tail was started
+        self.records = 0
+        self._file = None
+        self._partial = b""
+        # Records read from the file but not returned yet
+        self._backlog = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Skip the records already in the log; `read` otherwise starts from the first one."""
+        with self._lock:
+            self._close_locked()
+            self._backlog = []
+            if self._open_locked():
+                offset = 0
+                for line in self._file:
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    self.records += 1
+                self._file.seek(offset)
+
+    def read(self, limit: Optional[int] = None) -> List[dict]:
+        """
+        Return the records appended since the last call, oldest first.
+
+        Args:
+            limit: Maximum number of records to return, the others being
+                returned by the next calls
+        """
+        with self._lock:
+            records = self._backlog
+            if (limit is None or len(records) < limit) and (self._file is not None or self._open_locked()):
+                records.extend(self._read_locked())
+                if self._rotated_locked():
+                    # Nothing is written to the rotated file any more
+                    records.extend(self._read_locked())
+                    self._close_locked()
+                    if self._open_locked():
+                        records.extend(self._read_locked())
+            if limit is None:
+                limit = len(records)
+            self._backlog = records[limit:]
+            return records[:limit]
+
+    def close(self):
+        with self._lock:
+            self._close_locked()
+
+    def _open_locked(self) -> bool:
+        try:
+            self._file = open(self.log_file, "rb")
+        except FileNotFoundError:
+            return False
+        self.records = 0
+        self._partial = b""
+        return True
+
+    def _close_locked(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_locked(self) -> List[dict]:
+        data = self._partial + self._file.read()
+        # A record being written is left for the next read
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        records = [r for r in map(_decode, data[:end].splitlines(keepends=True)) if r is not None]
+        self.records += len(records)
+        return records
+
+    def _rotated_locked(self) -> bool:
+        try:
+            return os.stat(self.log_file).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            # Renamed away, and the new log is not there yet
+            return False
+
+
+class _LimitedReader:
+    """Iterate over the lines of a file that lie within its first `size` bytes."""
+
+    def __init__(self, f, size: int):
+        self._f = f
+        self._size = size
+
+    def __iter__(self):
+        read = 0
+        for line in self._f:
+            read += len(line)
+            if read > self._size:
+                return
+            yield line
+
+
+def _read_records(f):
+    if f is None:
+        return
+    for line in f:
+        record = _decode(line)
+        if record is None:
+            break
+        yield record
+
+
+def _decode(line: bytes) -> Optional[dict]:
+    if not line.endswith(b"\n"):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _record_arrays(records):
+    records = list(records)
+    return (
+        np.array([r["userId"] for r in records], dtype=np.int64),
+        np.array([r["productId"] for r in records], dtype=np.int64),
+        np.array([r["rating"] for r in records], dtype=np.float64),
+        np.array([r.get("ts", 0) for r in records], dtype=np.float64),
+    )
+
+
+def _apply_records(merged: Dict[Tuple[int, int], dict], records):
+    for record in records:
+        merged[(record["userId"], record["productId"])] = record
@@ -0,0 +1,171 @@
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+
+class Snapshot:
+    """
+    An immutable view of everything the request path needs.
+
+    A snapshot is never modified after it has been published; updates build a
+    new snapshot and swap it in, so a reader holding a reference always sees a
+    consistent model and catalog.
+    """
+
+    __slots__ = ("version", "model", "users", "products", "loaded_at")
+
+    def __init__(self, version: int, model: Optional[Dict[str, Any]], users: Sequence, products: Sequence):
+        self.version = version
+        self.model = model
+        self.users = users
+        self.products = products
+        self.loaded_at = time.time()
+
+
+class ModelRegistry:
+    """
+    Holds the current model/catalog snapshot and swaps it copy-on-write.
+
+    Readers call `get()`, which is a plain attribute read and never blocks.
+    Writers build a complete new snapshot off to the side and publish it with
+    a single reference assignment. When any of the watched files changes on
+    disk, the next reader schedules a reload on a background thread and keeps
+    serving the previous snapshot until the new one is ready.
+
+    Args:
+        loader: Callable returning (model, users, products); model may be
+            None until one has been built
+        watched_files: Files whose modification invalidates the snapshot
+        check_interval: Minimum number of seconds between file checks
+    """
+
+    def __init__(self, loader: Callable[[], Tuple[Dict[str, Any], list, list]],
+                 watched_files: Iterable[Path] = (), check_interval: float = 1.0):
+        self._loader = loader
+        self._watched_files = list(watched_files)
+        self._check_interval = check_interval
+        self._snapshot: Optional[Snapshot] = None
+        self._signature = None
+        self._next_check = 0.0
+        self._version = 0
+        self._publish_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def get(self) -> Snapshot:
+        """Return the current snapshot, loading it on first use."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.reload()
+
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self._check_interval
+            if self._files_signature() != self._signature:
+                self._reload_in_background()
+
+        return snapshot
+
+    def current_model(self) -> Optional[Dict[str, Any]]:
+        """Return the model being served, or None before the first load, without checking the watched files."""
+        snapshot = self._snapshot
+        return None if snapshot is None else snapshot.model
+
+    def reload(self) -> Snapshot:
+        """Rebuild the snapshot from disk and publish it."""
+        with self._reload_lock:
+            return self._reload_locked()
+
+    def publish(self, model: Dict[str, Any], users: Optional[Sequence] = None,
+                products: Optional[Sequence] = None) -> Snapshot:
+        """
+        Atomically replace the current snapshot.
+
+        Omitted parts are carried over from the current snapshot, which lets a
+        freshly trained model be published without re-reading the catalog.
+        """
+        with self._publish_lock:
+            return self._publish_locked(model, users, products)
+
+    def replace_model(self, expected: Dict[str, Any], model: Dict[str, Any]) -> Optional[Snapshot]:
+        """
+        Publish `model` only if the current snapshot still serves `expected`.
+
+        This lets an update derived from the current model be published
+        without overwriting a model that was swapped in meanwhile.
+
+        Returns:
+            The new snapshot, or None if the model had changed
+        """
+        with self._publish_lock:
+            current = self._snapshot
+            if current is None or current.model is not expected:
+                return None
+            return self._publish_locked(model, None, None)
+
+    def acknowledge(self, path: Path):
+        """
+        Take the current state of a watched file as already loaded.
+
+        For a file this process wrote after publishing what it points to
+        itself, so that the change does not trigger a reload.
+        """
+        with self._publish_lock:
+            if self._signature is None or path not in self._watched_files:
+                return
+            signature = list(self._signature)
+            signature[self._watched_files.index(path)] = self._file_signature(path)
+            self._signature = tuple(signature)
+
+    def _publish_locked(self, model, users, products) -> Snapshot:
+        current = self._snapshot
+        if current is not None:
+            users = current.users if users is None else users
+            products = current.products if products is None else products
+        self._version += 1
+        snapshot = Snapshot(self._version, model, users or [], products or [])
+        self._snapshot = snapshot
+        return snapshot
+
+    def _reload_locked(self) -> Snapshot:
+        # Take the signature before loading so that a change made while we are
+        # loading is picked up by the next check
+        signature = self._files_signature()
+        while True:
+            expected = self.current_model()
+            model, users, products = self._loader()
+            # A model swapped in while loading, such as one with new ratings
+            # applied by `replace_model`, is not overwritten with one loaded
+            # before it: the loader runs again and starts from it
+            with self._publish_lock:
+                current = self._snapshot
+                if (None if current is None else current.model) is expected:
+                    snapshot = self._publish_locked(model, users, products)
+                    break
+        self._signature = signature
+        return snapshot
+
+    def _reload_in_background(self):
+        if not self._reload_lock.acquire(blocking=False):
+            return  # A reload is already in progress
+
+        def run():
+            try:
+                self._reload_locked()
+            except Exception as e:
+                print(f"Error reloading model: {e}")
+            finally:
+                self._reload_lock.release()
+
+        threading.Thread(target=run, name="model-registry-reload", daemon=True).start()
+
+    def _files_signature(self):
+        return tuple(self._file_signature(path) for path in self._watched_files)
+
+    @staticmethod
+    def _file_signature(path: Path):
+        try:
+            stat = path.stat()
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
@@ -0,0 +1,197 @@
+import time
+
+import numpy as np
+from scipy import sparse
+
+from ann import LSHIndex, embed_rows, top_k_neighbors_lsh
+from model_store import IdIndex
+from similarity import build_rating_matrix, normalize_rows, row_norms, top_k_indices, top_k_neighbors
+
+
+def build_neighbor_model(user_ids, product_ids, rating_users, rating_products, rating_values, k,
+                         search="exact", workers=1, ratings_as_of=None):
+    """
+    Build the user-based collaborative filtering model from rating arrays.
+
+    Args:
+        user_ids: Array of user ids, in matrix order
+        product_ids: Array of product ids, in matrix order
+        rating_users: User id of every rating
+        rating_products: Product id of every rating
+        rating_values: Value of every rating
+        k: Number of most similar users stored per user
+        search: "exact" or "lsh", see NEIGHBOR_SEARCH in main.py
+        workers: Number of processes the exact neighbour lists are computed with
+        ratings_as_of: Time the ratings were read
+
+    Returns:
+        The model
+    """
+    # Create the sparse ratings matrix (users x products) in a single
+    # vectorized COO construction instead of filling it rating by rating
+    matrix = build_rating_matrix(user_ids, product_ids, rating_users, rating_products, rating_values)
+
+    # Compute cosine similarity, keeping only the top neighbours of each
+    # user instead of the full users x users matrix
+    norms = row_norms(matrix)
+    normalized = normalize_rows(matrix, norms)
+    if search == "lsh":
+        embedding = embed_rows(normalized)
+        index = LSHIndex(embedding.shape[1])
+        index.add(embedding)
+        neighbor_idx, neighbor_sim = top_k_neighbors_lsh(normalized, k, index, embedding)
+    else:
+        neighbor_idx, neighbor_sim = top_k_neighbors(normalized, k, workers=workers)
+
+    return {
+        "matrix": matrix,
+        "norms": norms,
+        "neighbor_idx": neighbor_idx,
+        "neighbor_sim": neighbor_sim,
+        "user_ids": user_ids,
+        "product_ids": product_ids,
+        "user_to_idx": IdIndex(user_ids),
+        "product_to_idx": IdIndex(product_ids),
+        "version": time.time_ns(),
+        "ratings_as_of": time.time() if ratings_as_of is None else ratings_as_of,
+    }
+
+
+def select_neighbors(neighbor_idx, neighbor_sim, user_idx, n_neighbors):
+    """
+    Pick the most similar users from a user's stored neighbour list.
+
+    Args:
+        neighbor_idx: Neighbour indices of every user, padded with -1
+        neighbor_sim: Matching similarities
+        user_idx: Matrix row of the user
+        n_neighbors: Maximum number of neighbours to use
+
+    Returns:
+        Tuple of (indices, similarities) ordered by decreasing similarity
+    """
+    idx = neighbor_idx[user_idx]
+    sims = neighbor_sim[user_idx]
+    valid = np.flatnonzero(idx >= 0)
+    top = valid[top_k_indices(sims[valid], n_neighbors)]
+    return idx[top], sims[top]
+
+
+def score_products(matrix, user_idx, neighbors, sims, allowed=None):
+    """
+    Predict a rating for every product the user has not rated yet.
+
+    The prediction is the similarity-weighted average of the neighbours'
+    ratings, computed over the neighbours' rating block in one pass. Only
+    neighbours that rated a product contribute to its weights.
+
+    Args:
+        matrix: CSR user-item matrix
+        user_idx: Matrix row of the user
+        neighbors: Matrix rows of the neighbours
+        sims: Similarity of each neighbour
+        allowed: Boolean mask of the products that may be scored; all if omitted
+
+    Returns:
+        Tuple of (product_indices, scores) for every product that can be scored
+    """
+    n_products = matrix.shape[1]
+    block = matrix[neighbors]
+
+    # Weight of every stored rating in the block: the similarity of the
+    # neighbour who gave it, or zero if the rating is not positive
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    weights = np.where(block.data > 0, sims[rows], 0.0)
+
+    weighted_sum = np.bincount(block.indices, weights=weights * block.data, minlength=n_products)
+    sim_sum = np.bincount(block.indices, weights=weights, minlength=n_products)
+
+    candidates = sim_sum > 0
+    if allowed is not None:
+        candidates &= allowed
+    rated = matrix.indices[matrix.indptr[user_idx]:matrix.indptr[user_idx + 1]]
+    candidates[rated] = False
+
+    product_indices = np.flatnonzero(candidates)
+    return product_indices, weighted_sum[product_indices] / sim_sum[product_indices]
+
+
+def recommend(model, user_idx, n_neighbors, limit):
+    """
+    Rank the best products for a user.
+
+    Args:
+        model: Recommendation model as built by `build_neighbor_model`
+        user_idx: Matrix row of the user
+        n_neighbors: Number of similar users to take into account
+        limit: Number of products to return
+
+    Returns:
+        Tuple of (product_indices, scores) ordered by decreasing score, ties
+        broken by the lower product index
+    """
+    neighbors, sims = select_neighbors(model["neighbor_idx"], model["neighbor_sim"], user_idx, n_neighbors)
+    product_indices, scores = score_products(model["matrix"], user_idx, neighbors, sims)
+    top = top_k_indices(scores, limit)
+    return product_indices[top], scores[top]
+
+
+def recommend_batch(model, user_indices, n_neighbors, limit):
+    """
+    Rank the best products for a block of users at once.
+
+    The neighbour similarities of the whole block are gathered into a sparse
+    (users x neighbours) weight matrix, which is multiplied with the
+    neighbours' rating block in a single matrix product. Only the per-user
+    top N selection is done row by row.
+
+    Args:
+        model: Recommendation model as built by `build_neighbor_model`
+        user_indices: Matrix rows of the users
+        n_neighbors: Number of similar users to take into account
+        limit: Number of products to return per user
+
+    Yields:
+        Tuple of (product_indices, scores) for each user, in input order
+    """
+    matrix = model["matrix"]
+    user_indices = np.asarray(user_indices, dtype=np.int64)
+    n_block = len(user_indices)
+
+    # Pick the top neighbours of every user in the block
+    idx = model["neighbor_idx"][user_indices]
+    sims = np.where(idx >= 0, model["neighbor_sim"][user_indices], -np.inf)
+    top = np.argsort(-sims, axis=1, kind="stable")[:, :n_neighbors]
+    idx = np.take_along_axis(idx, top, axis=1)
+    sims = np.take_along_axis(sims, top, axis=1)
+    valid = idx >= 0
+
+    # Weight matrix over the distinct neighbours of the block, keeping each
+    # row in neighbour order so sums accumulate as in `score_products`
+    neighbors, columns = np.unique(idx[valid], return_inverse=True)
+    indptr = np.r_[0, np.cumsum(valid.sum(axis=1))]
+    weights = sparse.csr_matrix((sims[valid], columns, indptr), shape=(n_block, len(neighbors)))
+
+    # Only positive ratings contribute to the weighted average
+    block = matrix[neighbors]
+    block.data = np.where(block.data > 0, block.data, 0.0)
+    block.eliminate_zeros()
+    rated = block.copy()
+    rated.data = np.ones_like(rated.data)
+
+    weighted_sum = weights @ block
+    sim_sum = weights @ rated
+    weighted_sum.sort_indices()
+    sim_sum.sort_indices()
+
+    for row, user_idx in enumerate(user_indices):
+        lo, hi = sim_sum.indptr[row], sim_sum.indptr[row + 1]
+        product_indices = sim_sum.indices[lo:hi]
+        scores = weighted_sum.data[lo:hi] / sim_sum.data[lo:hi]
+
+        user_rated = matrix.indices[matrix.indptr[user_idx]:matrix.indptr[user_idx + 1]]
+        unrated = ~np.isin(product_indices, user_rated)
+        product_indices, scores = product_indices[unrated], scores[unrated]
+
+        top = top_k_indices(scores, limit)
+        yield product_indices[top], scores[top]
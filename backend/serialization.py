@@ -0,0 +1,30 @@
+import json
+from typing import Any, Callable
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+# orjson is optional: it encodes several times faster than the json module
+# but is a compiled dependency, so it is only used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_encoder(fast: bool = False) -> Callable[[Any], bytes]:
+    """
+    Return a function that serializes a value to JSON bytes.
+
+    Args:
+        fast: Encode with orjson if it is installed
+    """
+    if fast and orjson is not None:
+        return orjson.dumps
+    return lambda value: json.dumps(value).encode()
+
+
+def response_class(fast: bool = False):
+    """Return the response class for endpoints returning plain values, see `json_encoder`."""
+    if fast and orjson is not None:
+        return ORJSONResponse
+    return JSONResponse
@@ -0,0 +1,246 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+# Number of users whose similarity rows are computed at once. Peak memory of
+# the similarity step is proportional to this times the number of co-raters.
+SIMILARITY_BLOCK_SIZE = 1024
+
+
+def map_ids(ids, values):
+    """
+    Map ids to their positions without building a Python dict.
+
+    Args:
+        ids: Array of known ids, in matrix order
+        values: Array of ids to look up
+
+    Returns:
+        Array with the position of each value in `ids`, or -1 if unknown
+    """
+    ids = np.asarray(ids)
+    values = np.asarray(values)
+    if len(ids) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    pos = np.minimum(np.searchsorted(sorted_ids, values), len(ids) - 1)
+    return np.where(sorted_ids[pos] == values, order[pos], -1)
+
+
+def build_rating_matrix(user_ids, product_ids, rating_users, rating_products, rating_values):
+    """
+    Build the sparse user-item matrix from parallel rating arrays.
+
+    Ratings for unknown users or products are dropped. When the same
+    (user, product) pair appears more than once the last rating wins, exactly
+    like filling a dense matrix in order.
+
+    Args:
+        user_ids: User ids, one per matrix row
+        product_ids: Product ids, one per matrix column
+        rating_users: User id of each rating
+        rating_products: Product id of each rating
+        rating_values: Value of each rating
+
+    Returns:
+        CSR matrix of shape (len(user_ids), len(product_ids))
+    """
+    n_users, n_products = len(user_ids), len(product_ids)
+    rows = map_ids(user_ids, rating_users)
+    cols = map_ids(product_ids, rating_products)
+    values = np.asarray(rating_values, dtype=np.float64)
+
+    known = (rows >= 0) & (cols >= 0)
+    rows, cols, values = rows[known], cols[known], values[known]
+
+    # Keep only the last rating for each (user, product) pair
+    keys = rows * n_products + cols
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    rows, cols, values = rows[last], cols[last], values[last]
+
+    matrix = sparse.csr_matrix((values, (rows, cols)), shape=(n_users, n_products))
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix
+
+
+def row_norms(matrix):
+    """Euclidean norm of each row, with empty rows reported as 1."""
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1  # Avoid division by zero
+    return norms
+
+
+def normalize_rows(matrix, norms):
+    """Scale each row of a sparse matrix to unit length."""
+    return sparse.csr_matrix(sparse.diags(1.0 / norms) @ matrix)
+
+
+def top_k_neighbors(normalized, k, block_size=SIMILARITY_BLOCK_SIZE, workers=1):
+    """
+    Find the k most similar users for every user.
+
+    The full user-user similarity matrix is never materialized. Rows are
+    processed in blocks of `block_size` users: each block is multiplied with
+    the transposed matrix, and only the top k positive similarities of each
+    row are kept. Users never appear in their own neighbour list.
+
+    With `workers` > 1 the blocks are spread over a pool of processes that
+    read the matrix from shared memory and write their rows of the result
+    in place, see `_top_k_neighbors_parallel`. The result is the same.
+
+    Args:
+        normalized: CSR matrix of unit-length user rows
+        k: Number of neighbours to keep per user
+        block_size: Number of users per block
+        workers: Number of processes to use
+
+    Returns:
+        Tuple of (neighbor_idx, neighbor_sim), both of shape (n_users, k).
+        Each row is ordered by decreasing similarity, ties broken by the lower
+        user index, and padded with index -1 and similarity 0.
+    """
+    n_users = normalized.shape[0]
+    if k > 0 and workers > 1 and n_users > block_size:
+        return _top_k_neighbors_parallel(normalized, k, block_size, workers)
+
+    neighbor_idx = np.full((n_users, k), -1, dtype=np.int32)
+    neighbor_sim = np.zeros((n_users, k), dtype=np.float64)
+    if k == 0:
+        return neighbor_idx, neighbor_sim
+
+    transposed = sparse.csr_matrix(normalized.T)
+    for start in range(0, n_users, block_size):
+        _fill_top_k(normalized, transposed, start, block_size, neighbor_idx, neighbor_sim)
+
+    return neighbor_idx, neighbor_sim
+
+
+def _fill_top_k(normalized, transposed, start, block_size, neighbor_idx, neighbor_sim):
+    # Compute the neighbour lists of the users in one block
+    k = neighbor_idx.shape[1]
+    block = sparse.csr_matrix(normalized[start:start + block_size] @ transposed)
+    block.sort_indices()
+    indptr, cols, sims = _drop_self_and_zeros(block, start)
+    for row in range(block.shape[0]):
+        lo, hi = indptr[row], indptr[row + 1]
+        if lo == hi:
+            continue
+        top = top_k_indices(sims[lo:hi], k)
+        neighbor_idx[start + row, :len(top)] = cols[lo:hi][top]
+        neighbor_sim[start + row, :len(top)] = sims[lo:hi][top]
+
+
+def _top_k_neighbors_parallel(normalized, k, block_size, workers):
+    """
+    Run `top_k_neighbors` over a pool of processes.
+
+    The CSR arrays of the matrix and of its transpose are copied once into
+    shared memory, as are the two result arrays. Each task is one block of
+    users: the worker multiplies it with the shared transpose and writes the
+    block's rows of the result, so nothing but block offsets goes through
+    the pool's pipes and the per-block results need no merging. Peak memory
+    is the shared matrix plus one block product per worker.
+    """
+    n_users = normalized.shape[0]
+    transposed = sparse.csr_matrix(normalized.T)
+    with ExitStack() as stack:
+        specs = {}
+        views = {}
+        arrays = {
+            "data": normalized.data, "indices": normalized.indices, "indptr": normalized.indptr,
+            "t_data": transposed.data, "t_indices": transposed.indices, "t_indptr": transposed.indptr,
+            "neighbor_idx": np.full((n_users, k), -1, dtype=np.int32),
+            "neighbor_sim": np.zeros((n_users, k), dtype=np.float64),
+        }
+        for name, array in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            stack.callback(shm.unlink)
+            stack.callback(shm.close)
+            views[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            views[name][...] = array
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+
+        shapes = (normalized.shape, transposed.shape)
+        # Spawn rather than fork so that workers do not inherit the caller's
+        # threads and locks
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_attach_shared, initargs=(specs, shapes)) as pool:
+            for _ in pool.map(_fill_shared_block, range(0, n_users, block_size), repeat(block_size)):
+                pass
+
+        # Copy the results out before the shared memory is released
+        neighbor_idx = np.array(views["neighbor_idx"])
+        neighbor_sim = np.array(views["neighbor_sim"])
+        views.clear()
+    return neighbor_idx, neighbor_sim
+
+
+# Shared arrays attached by a worker process of `_top_k_neighbors_parallel`
+_shared = {}
+
+
+def _attach_shared(specs, shapes):
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared.setdefault("segments", []).append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    shape, t_shape = shapes
+    _shared["normalized"] = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape)
+    _shared["transposed"] = sparse.csr_matrix((arrays["t_data"], arrays["t_indices"], arrays["t_indptr"]),
+                                              shape=t_shape)
+    _shared["neighbor_idx"] = arrays["neighbor_idx"]
+    _shared["neighbor_sim"] = arrays["neighbor_sim"]
+
+
+def _fill_shared_block(start, block_size):
+    _fill_top_k(_shared["normalized"], _shared["transposed"], start, block_size,
+                _shared["neighbor_idx"], _shared["neighbor_sim"])
+
+
+def top_k_indices(values, k):
+    """
+    Positions of the k largest values, without fully sorting `values`.
+
+    The candidates are selected with `argpartition` and only those are sorted.
+    The result is ordered by decreasing value with ties broken by the lower
+    position, which is the order a stable descending sort would produce.
+
+    Args:
+        values: 1-D array of scores
+        k: Number of positions to return
+
+    Returns:
+        Array of at most k positions into `values`
+    """
+    n = len(values)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        kth = values[np.argpartition(values, n - k)[n - k]]
+        # Keep every value tied with the k-th largest so that the tie break
+        # below does not depend on the partition order
+        candidates = np.flatnonzero(values >= kth)
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -values[candidates]))
+    return candidates[order[:k]]
+
+
+def _drop_self_and_zeros(block, start):
+    # Remove each user's similarity with themselves and any non-positive
+    # similarity, returning the remaining entries as CSR arrays
+    n_rows = block.shape[0]
+    rows = np.repeat(np.arange(n_rows), np.diff(block.indptr))
+    keep = (block.data > 0) & (block.indices != rows + start)
+    indptr = np.searchsorted(rows[keep], np.arange(n_rows + 1))
+    return indptr, block.indices[keep], block.data[keep]
@@ -0,0 +1,317 @@
+import csv
+import json
+import sys
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from ingest import collect_ratings, read_rating_chunks
+from model_store import IdIndex, open_arrays, save_arrays
+
+# Column types of the stored tables. Strings are kept once in a string table
+# per table and referenced by int32 codes, -1 standing for a missing value.
+USER_COLUMNS = {"id": "int32", "name": "str"}
+PRODUCT_COLUMNS = {
+    "id": "int32",
+    "name": "str",
+    "category": "str",
+    "description": "str",
+    "rating": "float64",
+    "image_url": "str",
+}
+
+# Ratings are stored as parallel arrays, 12 bytes per rating plus the time
+# it was written, which incremental model updates need
+RATING_COLUMNS = {"userId": "int32", "productId": "int32", "rating": "float32", "ts": "float64"}
+
+
+class StringTable:
+    """
+    Strings stored back to back as UTF-8, with their start offsets.
+
+    Args:
+        offsets: Start of every string in `data`, followed by the end of the last
+        data: Concatenated UTF-8 bytes
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def build(cls, strings: List[str]) -> "StringTable":
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, code: int) -> Optional[str]:
+        if code < 0:
+            return None
+        return bytes(self.data[self.offsets[code]:self.offsets[code + 1]]).decode("utf-8")
+
+    def code(self, value: str) -> int:
+        """Return the code of a string, or -1 if the table does not hold it."""
+        for code in range(len(self)):
+            if self[code] == value:
+                return code
+        return -1
+
+
+class Table(Sequence):
+    """
+    Read-only struct-of-arrays table.
+
+    Every column is one typed array, string columns holding codes into a
+    shared `StringTable`. Rows are only turned into dicts when they are
+    accessed, so a table opened from memory-mapped arrays costs nothing per
+    row until it is read. Rows can be looked up by their id column.
+
+    Args:
+        columns: Column types, as in USER_COLUMNS
+        arrays: One array per column
+        strings: String table of the string columns
+        index: Index of the id column; built if omitted
+    """
+
+    def __init__(self, columns: Dict[str, str], arrays: Dict[str, np.ndarray], strings: StringTable,
+                 index: Optional[IdIndex] = None):
+        self.columns = columns
+        self.arrays = arrays
+        self.strings = strings
+        self.index = IdIndex(arrays["id"]) if index is None else index
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], columns: Dict[str, str]) -> "Table":
+        """Build a table from a list of dicts, such as one loaded from JSON."""
+        records = list(records)
+        codes: Dict[str, int] = {}
+        arrays = {}
+        for name, kind in columns.items():
+            values = [record.get(name) for record in records]
+            if kind == "str":
+                values = [-1 if value is None else codes.setdefault(value, len(codes)) for value in values]
+                kind = "int32"
+            elif np.issubdtype(np.dtype(kind), np.integer):
+                info = np.iinfo(kind)
+                if values and not (info.min <= min(values) and max(values) <= info.max):
+                    raise ValueError(f"Values of column {name} do not fit in {kind}")
+            arrays[name] = np.array(values, dtype=kind)
+        return cls(columns, arrays, StringTable.build(list(codes)))
+
+    def __len__(self):
+        return len(self.arrays["id"])
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+
+        row = {}
+        for name, kind in self.columns.items():
+            value = self.arrays[name][position]
+            if kind == "str":
+                row[name] = self.strings[int(value)]
+            elif kind.startswith("int"):
+                row[name] = int(value)
+            else:
+                row[name] = float(value)
+        return row
+
+    def get(self, id_, default=None):
+        """Return the row with the given id, or `default` if there is none."""
+        position = self.index.get(id_)
+        return default if position is None else self[position]
+
+    @property
+    def ids(self):
+        return self.arrays["id"]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return [self[i] for i in range(len(self))]
+
+
+def save_table(table_dir: Path, kind: str, table: Table) -> Path:
+    """Write a table as memory-mappable arrays, replacing the current one atomically."""
+    arrays = {f"column_{name}": array for name, array in table.arrays.items()}
+    arrays.update(
+        strings_offsets=table.strings.offsets,
+        strings_data=table.strings.data,
+        id_order=table.index.order,
+        id_sorted=table.index.sorted_ids,
+    )
+    return save_arrays(table_dir, kind, time.time_ns(), arrays, {"columns": table.columns})
+
+
+def open_table(table_dir: Path, kind: str) -> Optional[Table]:
+    """
+    Open a stored table with its arrays memory-mapped.
+
+    Returns:
+        The table, or None if none has been saved yet
+    """
+    stored = open_arrays(table_dir, kind)
+    if stored is None:
+        return None
+    arrays, manifest = stored
+    columns = manifest["columns"]
+    return Table(
+        columns,
+        {name: arrays[f"column_{name}"] for name in columns},
+        StringTable(arrays["strings_offsets"], arrays["strings_data"]),
+        IdIndex(arrays["column_id"], arrays["id_order"], arrays["id_sorted"]),
+    )
+
+
+def save_ratings(ratings_dir: Path, users, products, values, ts, version: Optional[int] = None) -> Path:
+    """
+    Write ratings as parallel typed arrays, replacing the current ones atomically.
+
+    Args:
+        ratings_dir: Directory of the stored ratings
+        users: User id of every rating
+        products: Product id of every rating
+        values: Value of every rating
+        ts: Time every rating was written
+        version: Version of the ratings; the current time if omitted
+
+    Raises:
+        ValueError: If an id does not fit in 32 bits
+    """
+    arrays = {}
+    for (name, kind), column in zip(RATING_COLUMNS.items(), (users, products, values, ts)):
+        column = np.asarray(column)
+        if np.issubdtype(np.dtype(kind), np.integer) and len(column):
+            info = np.iinfo(kind)
+            if column.min() < info.min or column.max() > info.max:
+                raise ValueError(f"Values of {name} do not fit in {kind}")
+        arrays[name] = column.astype(kind, copy=False)
+    version = time.time_ns() if version is None else version
+    return save_arrays(ratings_dir, "ratings", version, arrays, {"count": len(arrays["userId"])})
+
+
+def open_ratings(ratings_dir: Path) -> Optional[Dict[str, Any]]:
+    """
+    Memory-map the stored ratings.
+
+    Returns:
+        Dict of the RATING_COLUMNS arrays plus the "version" of the ratings,
+        the time_ns at which they were written, or None if none are stored
+    """
+    stored = open_arrays(ratings_dir, "ratings")
+    if stored is None:
+        return None
+    arrays, manifest = stored
+    return dict(arrays, version=manifest["version"])
+
+
+def merge_ratings(*parts):
+    """
+    Concatenate rating arrays, keeping the last rating of each (user, product) pair.
+
+    Args:
+        parts: Tuples of (users, products, values, ts) arrays, oldest first
+
+    Returns:
+        Tuple of (users, products, values, ts) sorted by user, then product
+    """
+    users, products, values, ts = (np.concatenate([np.asarray(part[i]) for part in parts]) for i in range(4))
+    keys = (users.astype(np.int64) << 32) | (products.astype(np.int64) & 0xFFFFFFFF)
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    return users[last], products[last], values[last], ts[last]
+
+
+def import_json(json_file: Path, table_dir: Path, kind: str, columns: Dict[str, str]) -> Path:
+    """Store a JSON list of users or products as a table."""
+    with open(json_file) as f:
+        return save_table(table_dir, kind, Table.from_records(json.load(f), columns))
+
+
+def import_ratings(ratings_file: Path, ratings_dir: Path) -> Path:
+    """
+    Store a ratings dump (JSON array, NDJSON or CSV) as typed arrays.
+
+    The dump is streamed in chunks, see `ingest.read_rating_chunks`. Imported
+    ratings count as written at time 0.
+    """
+    users, products, values = collect_ratings(read_rating_chunks(ratings_file))
+    return save_ratings(ratings_dir, *merge_ratings((users, products, values, np.zeros(len(values)))))
+
+
+def rating_records(ratings, positions=None):
+    """
+    Yield stored ratings as dicts, like the records of the ratings log.
+
+    Args:
+        ratings: Ratings as returned by `open_ratings`
+        positions: Positions of the ratings to yield; all if omitted
+    """
+    if positions is None:
+        positions = slice(None)
+    users = ratings["userId"][positions].tolist()
+    products = ratings["productId"][positions].tolist()
+    # Shortest representation of each float32 value, so that 4.3 comes out
+    # as 4.3 rather than 4.300000190734863
+    values = ratings["rating"][positions].astype(str)
+    ts = ratings["ts"][positions].tolist()
+    for user, product, value, written in zip(users, products, values, ts):
+        yield {"userId": user, "productId": product, "rating": float(value), "ts": written}
+
+
+def export_ratings(ratings: Iterable[Dict[str, Any]], ratings_file: Path):
+    """Write rating dicts as a JSON list, NDJSON or CSV file, depending on its suffix."""
+    columns = ("userId", "productId", "rating")
+    ratings_file = Path(ratings_file)
+    with open(ratings_file, "w", newline="") as f:
+        if ratings_file.suffix == ".csv":
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows([rating[name] for name in columns] for rating in ratings)
+        elif ratings_file.suffix in (".ndjson", ".jsonl"):
+            for rating in ratings:
+                f.write(json.dumps({name: rating[name] for name in columns}) + "\n")
+        else:
+            json.dump([{name: rating[name] for name in columns} for rating in ratings], f)
+
+
+def main():
+    """
+    Import JSON data into the binary data directories, or export it back.
+
+    Usage:
+        python storage.py import|export [data_dir]
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print(main.__doc__)
+        sys.exit(1)
+    data_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path(__file__).parent / "data"
+
+    tables = [("users", USER_COLUMNS), ("products", PRODUCT_COLUMNS)]
+    if sys.argv[1] == "import":
+        for kind, columns in tables:
+            import_json(data_dir / f"{kind}.json", data_dir / kind, kind, columns)
+        import_ratings(data_dir / "ratings.json", data_dir / "ratings")
+    else:
+        for kind, _ in tables:
+            table = open_table(data_dir / kind, kind)
+            with open(data_dir / f"{kind}.json", "w") as f:
+                json.dump([] if table is None else table.to_list(), f)
+        # Include the ratings still in the log
+        from ratings_log import RatingsLog
+        export_ratings(RatingsLog(data_dir / "ratings", data_dir / "ratings.log").ratings(),
+                       data_dir / "ratings.json")
+    print(f"{sys.argv[1].capitalize()}ed data in {data_dir}")
+
+
+if __name__ == "__main__":
+    main()
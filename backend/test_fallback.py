@@ -0,0 +1,33 @@
+import time
+
+import main
+from ingest import collect_ratings
+from ratings_log import RatingsLog
+from storage import PRODUCT_COLUMNS, USER_COLUMNS, Table
+
+
+def generate(tmp_path, monkeypatch, name, repeats):
+    """Build the fallback lists from the sample ratings, re-posting one of them `repeats` times."""
+    (tmp_path / name).mkdir()
+    log = RatingsLog(tmp_path / name / "ratings", tmp_path / name / "ratings.ndjson")
+    now = time.time()
+    for r in main.sample_ratings:
+        log.upsert(r["userId"], r["productId"], r["rating"], ts=now - 60)
+    for _ in range(repeats):
+        log.upsert(8, 11, 5.0, ts=now - 60)
+    ratings = collect_ratings(log.rating_chunks())
+    log.close()
+
+    monkeypatch.setattr(main, "ratings_log", log)
+    monkeypatch.setattr(main, "FALLBACK_DIR", tmp_path / name / "fallback")
+    monkeypatch.setattr(main, "load_catalog", lambda: (Table.from_records(main.sample_users, USER_COLUMNS),
+                                                       Table.from_records(main.sample_products, PRODUCT_COLUMNS)))
+    return main.generate_fallback(*ratings, ratings_as_of=now)
+
+
+def test_repeated_upserts_do_not_change_ranking(tmp_path, monkeypatch):
+    once = generate(tmp_path, monkeypatch, "once", 1)
+    repeated = generate(tmp_path, monkeypatch, "repeated", 30)
+    for name in ("popular_ids", "popular_scores", "category_ids", "category_offsets", "trending_ids",
+                 "trending_scores"):
+        assert once[name].tolist() == repeated[name].tolist(), name